@@ -0,0 +1,97 @@
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+entry_points = [
+    "check_nodes",
+    "report_results",
+    "rollup_health_and_sanity_metrics",
+    "rollup_plugin_counts",
+    "rollup_upload_counts",
+    "rollup_daily_and_weekly",
+    "run_rollups",
+]
+
+
+def parse_importtime(output):
+    """
+    Parses the output of python -X importtime into a list of (cumulative_us, depth, module).
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        imports.append((int(cumulative), depth, module.strip()))
+    return imports
+
+
+def get_import_times(module):
+    """
+    Imports module in a fresh interpreter, as a cron run would, and returns its total import time
+    along with the times of the imports it made directly.
+    """
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+
+    # imports are reported after the imports they make, so we collect the direct imports until
+    # we reach module itself.
+    children = {}
+    for us, depth, name in parse_importtime(output):
+        if depth == 1:
+            children[name] = us
+        elif depth == 0 and name == module:
+            return us, children
+        elif depth == 0:
+            children = {}
+
+    raise ValueError(f"no import time reported for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="measure the cold import time of each entry point"
+    )
+    parser.add_argument("-n", default=5, type=int, help="number of runs per entry point")
+    parser.add_argument("--top", default=5, type=int, help="number of slowest imports to show")
+    parser.add_argument(
+        "--budget",
+        default=None,
+        type=float,
+        help="exit with an error if any entry point's median import time exceeds this many ms",
+    )
+    parser.add_argument("entry_points", nargs="*", default=entry_points)
+    args = parser.parse_args()
+
+    over_budget = []
+
+    for module in args.entry_points:
+        runs = [get_import_times(module) for _ in range(args.n)]
+        total = statistics.median(us for us, _ in runs) / 1000
+        print(f"{module}: {total:0.1f}ms")
+
+        # modules already imported by an earlier import are not counted again, so this shows
+        # which of module's own imports pulled in the slow dependencies.
+        _, children = runs[0]
+        slowest = sorted(((us, name) for name, us in children.items()), reverse=True)
+        for us, name in slowest[: args.top]:
+            print(f"  {name}: {us / 1000:0.1f}ms")
+
+        if args.budget is not None and total > args.budget:
+            over_budget.append(module)
+
+    if over_budget:
+        sys.exit(f"over startup budget of {args.budget}ms: {', '.join(over_budget)}")
+
+
+if __name__ == "__main__":
+    main()
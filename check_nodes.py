@@ -1,20 +1,45 @@
 import argparse
-import json
+import io
+import logging
 import multiprocessing
 from pathlib import Path
 import subprocess
-from urllib.request import urlopen
 import os
 import pandas as pd
-import sage_data_client
-
-def read_json_from_url(url):
-    with urlopen(url) as f:
-        return json.load(f)
-
+from utils import (
+    add_node_selection_arguments,
+    has_node_selection,
+    select_nodes,
+    load_node_table_item,
+    get_vsn_filter,
+    http_get,
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+    get_reporter_run_record,
+    write_results_to_influxdb,
+    iter_response_text,
+    iter_json_object_items,
+    get_data_source,
+    add_data_source_arguments,
+    set_data_source_from_args,
+    SAGE_PORTAL_URL,
+)
+from series_registry import (
+    checked_sys_from_nxcore,
+    checked_sys_from_nxagent,
+    sys_from_rpi,
+    sys_from_dellblade,
+    outputs_from_bme,
+    outputs_from_raingauge,
+    series_classifier,
+)
 
 def get_monitoring_info_from_url(url):
-    df = pd.read_json(url)
+    with profiler.stage("monitoring_info") as stage:
+        df = pd.read_json(io.StringIO(http_get(url).text))
+        stage["rows"] = len(df)
     df["node_id"] = df["node_id"].str.lower()
     df["vsn"] = df["vsn"].str.upper()
     df["node_type"] = df["node_type"].str.lower()
@@ -31,178 +56,56 @@ def check_ssh(node):
         return (node, False)
 
 
-def read_json_from_url(url):
-    with urlopen(url) as f:
-        return json.load(f)
+def get_expected_plugins():
+    # NOTE latest-status.json is large, so we stream it and only keep the deployment names
+    url = f"{SAGE_PORTAL_URL}/ses-plugin-data/latest-status.json"
+    with profiler.stage("expected_plugins"), http_get(url, stream=True) as r:
+        resources_by_node = iter_json_object_items(iter_response_text(r))
+        return {node.lower(): {r["meta"]["deployment"] or "" for r in resources} for node, resources in resources_by_node}
+
 
+# uploads are published hourly, so the uploads check looks back further than the series check
+upload_lookback = pd.Timedelta("2h")
+
+
+def query_latest(now, window, filter=None):
+    """
+    Queries the latest record of each series in the window before now.
+    """
+    return get_data_source().query(now - window, now, tail=1, filter=filter)
+
+
+def query_latest_uploads(now, filter=None):
+    """
+    Queries the latest upload of each series in the upload_lookback before now. The data API
+    takes one start time per query, so a single query with per name lookbacks would scan every
+    series in the fleet over the longer lookback. Uploads are queried on their own instead, which
+    keeps the series query to its window and this one to only the upload series.
+    """
+    return query_latest(now, upload_lookback, filter={**(filter or {}), "name": "upload"})
+
+
+def get_expected_uploads(expected_plugins):
+    """
+    Returns a frame of the (node, plugin) pairs for the sampler plugins deployed to each node.
+    """
+    expected = pd.Series(
+        {node: sorted(plugins) for node, plugins in expected_plugins.items()}, dtype=object
+    ).explode()
+    expected = pd.DataFrame({"node": expected.index, "plugin": expected.to_numpy()})
+    # NOTE eventually, plugins can contain some metadata on what their outputs will be. this will help eliminate this special case.
+    return expected[expected["plugin"].str.contains("sampler", na=False)].reset_index(drop=True)
 
-def get_expected_plugins():
-    resources_by_node = read_json_from_url("https://portal.sagecontinuum.org/ses-plugin-data/latest-status.json")
-    return {node.lower(): {r["meta"]["deployment"] or "" for r in resources} for node, resources in resources_by_node.items()}
-
-
-sys_from_nx = {
-    "sys.boot_time",
-    "sys.cooling",
-    "sys.cooling_max",
-    "sys.cpu_seconds",
-    "sys.freq.ape",
-    "sys.freq.cpu",
-    "sys.freq.cpu_max",
-    "sys.freq.cpu_min",
-    "sys.freq.cpu_perc",
-    "sys.freq.emc",
-    "sys.freq.emc_max",
-    "sys.freq.emc_min",
-    "sys.freq.emc_perc",
-    "sys.freq.gpu",
-    "sys.freq.gpu_max",
-    "sys.freq.gpu_min",
-    "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.power",
-    "sys.rssh_up",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-    # "sys.gps.lat", # not sent with no GPS fix
-    # "sys.gps.lon", # not sent with no GPS fix
-    # "sys.gps.alt", # not sent with no GPS fix
-    # "sys.gps.epx", # not sent with no GPS fix
-    # "sys.gps.epy", # not sent with no GPS fix
-    # "sys.gps.epv", # not sent with no GPS fix
-    # "sys.gps.satellites", # not sent with no GPS fix
-    "sys.gps.mode",
-}
-
-sys_from_dellblade = {
-    "sys.boot_time",
-    # "sys.cooling",
-    # "sys.cooling_max",
-    "sys.cpu_seconds",
-    # "sys.freq.ape",
-    # "sys.freq.cpu",
-    # "sys.freq.cpu_max",
-    # "sys.freq.cpu_min",
-    # "sys.freq.cpu_perc",
-    # "sys.freq.emc",
-    # "sys.freq.emc_max",
-    # "sys.freq.emc_min",
-    # "sys.freq.emc_perc",
-    # "sys.freq.gpu",
-    # "sys.freq.gpu_max",
-    # "sys.freq.gpu_min",
-    # "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    # "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    # "sys.power",
-    # "sys.rssh_up", # no network watchdog
-    # "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-sys_from_nxagent = {
-    "sys.boot_time",
-    "sys.cooling",
-    "sys.cooling_max",
-    "sys.cpu_seconds",
-    "sys.freq.ape",
-    "sys.freq.cpu",
-    "sys.freq.cpu_max",
-    "sys.freq.cpu_min",
-    "sys.freq.cpu_perc",
-    "sys.freq.emc",
-    "sys.freq.emc_max",
-    "sys.freq.emc_min",
-    "sys.freq.emc_perc",
-    "sys.freq.gpu",
-    "sys.freq.gpu_max",
-    "sys.freq.gpu_min",
-    "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.power",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-sys_from_rpi = {
-    "sys.boot_time",
-    "sys.cpu_seconds",
-    "sys.freq.cpu",
-    "sys.freq.cpu_max",
-    "sys.freq.cpu_min",
-    "sys.freq.cpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-bme_names = {
-    "env.temperature",
-    "env.relative_humidity",
-    "env.pressure",
-}
-
-raingauge_names = {
-    # "env.raingauge.acc", # we decided this measurement didn't make sense and that user's should use total_acc
-    "env.raingauge.event_acc",
-    "env.raingauge.rint",
-    "env.raingauge.total_acc",
-}
+
+def get_missing_uploads(expected, uploads):
+    """
+    Returns the expected (node, plugin) pairs which have no upload from a matching (node, task).
+    """
+    # empty results don't have meta columns
+    observed = uploads.reindex(columns=["meta.node", "meta.task"]).drop_duplicates()
+    observed.columns = ["node", "plugin"]
+    df = expected.merge(observed, on=["node", "plugin"], how="left", indicator=True)
+    return df.loc[df["_merge"] == "left_only", ["node", "plugin"]].reset_index(drop=True)
 
 
 def main():
@@ -211,10 +114,46 @@ def main():
     parser.add_argument("--window", default="5m", help="time window to check")
     parser.add_argument("--ssh", action="store_true", default=False, help="include ssh check")
     parser.add_argument("--uploads", action="store_true", default=False, help="include uploads check")
+    parser.add_argument(
+        "--reporter-bucket",
+        default=None,
+        help="write a reporter_run record for this run to this influxdb bucket. requires INFLUXDB_TOKEN.",
+    )
+    add_node_selection_arguments(parser)
+    add_data_source_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
+    if args.reporter_bucket is not None and "INFLUXDB_TOKEN" not in os.environ:
+        parser.error("--reporter-bucket requires INFLUXDB_TOKEN")
+
+    if args.profile or args.profile_textfile is not None:
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s %(message)s",
+            datefmt="%Y/%m/%d %H:%M:%S",
+        )
+
+    enable_profiling(args)
+    set_data_source_from_args(args)
+
     # TODO get the headers from spreadsheet dynamically
     node_info = get_monitoring_info_from_url(os.environ["MONITORING_INFO_URL"])
+
+    # restrict check and queries to selected nodes
+    query_filter = None
+    if has_node_selection(args):
+        nodes = select_nodes(
+            [load_node_table_item(item) for item in node_info.to_dict("records")],
+            vsns=args.vsn,
+            node_types=args.node_type,
+            devices=args.device,
+        )
+        if len(nodes) == 0:
+            parser.error("no nodes match the given selection")
+        node_info = node_info[node_info.node_id.isin({node.id for node in nodes})]
+        query_filter = {"vsn": get_vsn_filter(nodes)}
+
     all_nodes = set(node_info.node_id)
     online_nodes = node_info[node_info.expected_online].node_id
     offline_nodes = set(node_info[~node_info.expected_online].node_id)
@@ -231,78 +170,95 @@ def main():
 
     results = []
 
-    df = sage_data_client.query(
-        start=f"-{args.window}",
-        tail=1,
-    )
+    # the window ends when we query rather than when we started, as fetching the monitoring info
+    # and the ssh checks can take a while
+    now = pd.to_datetime("now", utc=True)
+    df = query_latest(now, pd.Timedelta(args.window), filter=query_filter)
+    if args.uploads:
+        df_uploads = query_latest_uploads(now, filter=query_filter)
 
     total_unexpected = 0
 
     nodes_checked = set()
 
-    for node, df_node in df.groupby("meta.node"):
-        vsn = vsn_for_node.get(node, "???")
-        nodes_checked.add(node)
-
-        # check for multiple vsns. should never happen!
-        vsns = sorted(set(df_node["meta.vsn"]))
-        if vsns != [vsn]:
-            results.append({"node": node, "vsn": vsn, "msg": f"!!! tagged with multiple vsns: {vsns}"})
-
-        # check if an unlisted node is sending data (query *could* return more nodes than in manifest)
-        if node not in all_nodes:
-            results.append({"node": node, "vsn": vsn, "msg": "!!! unlisted node is sending data"})
-            total_unexpected += 1
-            continue
-
-        # check if node is unexpectedly sending data
-        if node in offline_nodes:
-            results.append(
-                {"node": node, "vsn": vsn, "msg": "!!! node marked as offline is sending data"}
-            )
-            total_unexpected += 1
-            continue
-
-        # node is assumed to be online for rest of this section
-
-        if node in wsn_nodes:
-            # check nxcore sys.*
-            found = set(df_node.loc[df_node["meta.host"].str.endswith("nxcore"), "name"])
-            for name in sys_from_nx - found:
-                results.append({"node": node, "vsn": vsn, "msg": f"missing nxcore {name}"})
-
-            if node in expected_nodes_with_rpi:
-                # check rpi sys.*
-                found = set(df_node.loc[df_node["meta.host"].str.endswith("rpi"), "name"])
-                for name in sys_from_rpi - found:
-                    results.append({"node": node, "vsn": vsn, "msg": f"missing rpi {name}"})
-
-            if node in expected_nodes_with_agent:
-                # check nxagent sys.*
-                found = set(df_node.loc[df_node["meta.host"].str.endswith("nxagent"), "name"])
-                for name in sys_from_nxagent - found:
-                    results.append({"node": node, "vsn": vsn, "msg": f"missing nxagent {name}"})
-
-            # check bme280
-            found = set(df_node[df_node["meta.sensor"] == "bme280"].name)
-            for name in bme_names - found:
-                results.append({"node": node, "vsn": vsn, "msg": f"missing bme280 {name}"})
-
-            if node in expected_nodes_with_rpi:
-                # check bme680
-                found = set(df_node[df_node["meta.sensor"] == "bme680"].name)
-                for name in bme_names - found:
-                    results.append({"node": node, "vsn": vsn, "msg": f"missing bme680 {name}"})
-
-                # check raingauge
-                found = set(df_node.loc[:, "name"])
-                for name in raingauge_names - found:
-                    results.append({"node": node, "vsn": vsn, "msg": f"missing raingauge {name}"})
-        elif node in blade_nodes:
-            # check dellblade sys.*
-            found = set(df_node.loc[df_node["meta.host"].str.endswith("sb-core"), "name"])
-            for name in sys_from_dellblade - found:
-                results.append({"node": node, "vsn": vsn, "msg": f"missing sb-core {name}"})
+    with profiler.stage("node_checks") as stage:
+        # attribute each row to a device once, then collect the names found for each node's devices
+        found_names = (
+            df[["meta.node", "name"]]
+            .assign(device=series_classifier.get_devices(df))
+            .drop_duplicates()
+            .groupby(["meta.node", "device"])["name"]
+            .agg(set)
+            .to_dict()
+        )
+
+        def get_found_names(node, device):
+            return found_names.get((node, device), set())
+
+        for node, df_node in df.groupby("meta.node"):
+            vsn = vsn_for_node.get(node, "???")
+            nodes_checked.add(node)
+
+            # check for multiple vsns. should never happen!
+            vsns = sorted(set(df_node["meta.vsn"]))
+            if vsns != [vsn]:
+                results.append({"node": node, "vsn": vsn, "msg": f"!!! tagged with multiple vsns: {vsns}"})
+
+            # check if an unlisted node is sending data (query *could* return more nodes than in manifest)
+            if node not in all_nodes:
+                results.append({"node": node, "vsn": vsn, "msg": "!!! unlisted node is sending data"})
+                total_unexpected += 1
+                continue
+
+            # check if node is unexpectedly sending data
+            if node in offline_nodes:
+                results.append(
+                    {"node": node, "vsn": vsn, "msg": "!!! node marked as offline is sending data"}
+                )
+                total_unexpected += 1
+                continue
+
+            # node is assumed to be online for rest of this section
+
+            if node in wsn_nodes:
+                # check nxcore sys.*
+                found = get_found_names(node, "nxcore")
+                for name in checked_sys_from_nxcore - found:
+                    results.append({"node": node, "vsn": vsn, "msg": f"missing nxcore {name}"})
+
+                if node in expected_nodes_with_rpi:
+                    # check rpi sys.*
+                    found = get_found_names(node, "rpi")
+                    for name in sys_from_rpi - found:
+                        results.append({"node": node, "vsn": vsn, "msg": f"missing rpi {name}"})
+
+                if node in expected_nodes_with_agent:
+                    # check nxagent sys.*
+                    found = get_found_names(node, "nxagent")
+                    for name in checked_sys_from_nxagent - found:
+                        results.append({"node": node, "vsn": vsn, "msg": f"missing nxagent {name}"})
+
+                # check bme280
+                found = get_found_names(node, "bme280")
+                for name in outputs_from_bme - found:
+                    results.append({"node": node, "vsn": vsn, "msg": f"missing bme280 {name}"})
+
+                if node in expected_nodes_with_rpi:
+                    # check bme680
+                    found = get_found_names(node, "bme680")
+                    for name in outputs_from_bme - found:
+                        results.append({"node": node, "vsn": vsn, "msg": f"missing bme680 {name}"})
+
+                    # check raingauge
+                    found = get_found_names(node, "raingauge")
+                    for name in outputs_from_raingauge - found:
+                        results.append({"node": node, "vsn": vsn, "msg": f"missing raingauge {name}"})
+            elif node in blade_nodes:
+                # check dellblade sys.*
+                found = get_found_names(node, "dell")
+                for name in sys_from_dellblade - found:
+                    results.append({"node": node, "vsn": vsn, "msg": f"missing sb-core {name}"})
+        stage["rows"] = len(df)
 
     if args.ssh:
         for node in set(online_nodes):
@@ -318,35 +274,19 @@ def main():
         results.append({"node": node, "vsn": vsn, "msg": f"!!! no data"})
 
     if args.uploads:
-        # this is purely a test based on whether and upload exists in last 2h. we can make this more dynamic, if needed.
-        df_uploads = sage_data_client.query(
-            start="-2h",
-            tail=1,
-            filter={
-                "name": "upload",
-            },
-        )
-
-        # get set of all unique (node, task)
-        uploads = set(df_uploads.groupby(["meta.node", "meta.task"]).groups.keys())
-
-        # NOTE this should be moved to a more unified place
-        node_to_vsn = dict(df_uploads.groupby(["meta.node", "meta.vsn"]).groups.keys())
-
-        for node, plugins in get_expected_plugins().items():
-            if node in offline_nodes:
-                continue
-            # TODO centralize where this is being determined
-            if node in missing_nodes:
-                continue
-            for plugin in plugins:
-                # NOTE eventually, plugins can contain some metadata on what their outputs will be. this will help eliminate this special case.
-                if not "sampler" in plugin:
-                    continue
-                if (node, plugin) not in uploads:
-                    results.append({"node": node, "vsn": node_to_vsn.get(node, node), "msg": f"missing upload from {plugin}"})
-
-    results = pd.DataFrame(results)
+        with profiler.stage("uploads_check") as stage:
+            expected = get_expected_uploads(get_expected_plugins())
+            # only check uploads of online nodes with data, and selected nodes if a selection was given
+            expected = expected[
+                ~expected["node"].isin(offline_nodes | missing_nodes)
+                & (expected["node"].isin(all_nodes) | (query_filter is None))
+            ]
+            missing = get_missing_uploads(expected, df_uploads)
+            for r in missing.itertuples(index=False):
+                results.append({"node": r.node, "vsn": vsn_for_node.get(r.node, r.node), "msg": f"missing upload from {r.plugin}"})
+            stage["rows"] = len(expected)
+
+    results = pd.DataFrame(results, columns=["node", "vsn", "msg"])
     for (node, vsn), results_node in results.groupby(["node", "vsn"]):
         print(f"# {node} - {vsn}")
         print()
@@ -369,6 +309,18 @@ def main():
     print("Total unique data series:", len(df))
     print("Total number of issues:", len(results))
 
+    # check_nodes only reports to stdout, so it only records its own run when asked to
+    if args.reporter_bucket is not None:
+        write_results_to_influxdb(
+            url=os.getenv("INFLUXDB_URL", "https://influxdb.sagecontinuum.org"),
+            org=os.getenv("INFLUXDB_ORG", "waggle"),
+            token=os.environ["INFLUXDB_TOKEN"],
+            bucket=args.reporter_bucket,
+            records=[get_reporter_run_record("check_nodes", now)],
+        )
+
+    write_profile_textfile(args, "check_nodes")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,403 @@
+import argparse
+import gzip
+import json
+import logging
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import pandas as pd
+
+from utils import load_node_table_item
+from series_registry import device_output_table
+
+
+# hosts which publish the outputs of each device. sys metrics are attributed to a device by host.
+host_for_device = {
+    "nxcore": "ws-nxcore",
+    "nxagent": "ws-nxagent",
+    "rpi": "ws-rpi",
+    "dell": "sbcore",
+    "bme280": "ws-nxcore",
+    "bme680": "ws-rpi",
+    "raingauge": "ws-rpi",
+    "microphone": "ws-rpi",
+}
+
+cameras = ["top", "bottom", "left", "right"]
+
+sanity_tests = ["sys.sanity_status.bme280", "sys.sanity_status.rpi", "sys.sanity_status.nxagent"]
+
+# names of recorded responses which replace the synthetic ones when found in --responses
+recorded_response_names = {
+    "/production": "production.json",
+    "/monitoring.json": "monitoring.json",
+    "/api/v1/jobs/list": "jobs.json",
+    "/ses-plugin-data/latest-status.json": "latest-status.json",
+    "/api/v1/query": "query.ndjson",
+}
+
+
+def get_node_table_items(n):
+    """
+    Returns a synthetic production node table with n nodes covering each type of node and device.
+    """
+    items = []
+    for i in range(n):
+        item = {
+            "node_id": f"000048B02D{i:06X}",
+            "vsn": f"W{i:03X}" if i % 10 != 0 else f"V{i:03X}",
+            "node_type": "WSN" if i % 10 != 0 else "Dell",
+            "nx_agent": i % 4 == 1,
+            "shield": i % 2 == 1,
+            "expected_online": True,
+        }
+        for j, camera in enumerate(cameras):
+            item[f"{camera}_camera"] = "XNV-8081Z" if (i + j) % 3 == 0 else "none"
+        items.append(item)
+    return items
+
+
+def get_value(name, timestamp, phase):
+    """
+    Returns a plausible value for the named series at timestamp.
+    """
+    seconds = timestamp.value / 1e9
+    if name == "sys.uptime":
+        return seconds - 1600000000 + phase
+    if name in ["sys.time", "sys.boot_time"]:
+        return seconds
+    if name == "env.temperature":
+        return 20.0 + phase % 10
+    if name == "env.relative_humidity":
+        return 50.0 + phase % 10
+    if name == "env.pressure":
+        return 98000.0 + phase % 100
+    return float(int(seconds) % 1000 + phase)
+
+
+class SyntheticData:
+    """
+    SyntheticData generates the series a healthy fleet publishes, following device_output_table.
+    rate scales the number of samples per publishing interval and extra_series adds plugin series
+    to each node, so the payload size of queries can be tuned.
+    """
+
+    def __init__(self, items, rate=1, extra_series=0):
+        self.rate = rate
+        self.series = []
+
+        for i, item in enumerate(items):
+            node = load_node_table_item(item)
+            meta = {"node": node.id, "vsn": node.vsn}
+
+            for device in sorted(node.devices):
+                for task, name, freq in device_output_table[device]:
+                    host = host_for_device.get(device, "ws-nxcore")
+                    series_meta = {**meta, "host": f"{node.id}.{host}"}
+                    if name.startswith("sys."):
+                        series_meta["task"] = "wes-metrics-agent"
+                    else:
+                        series_meta["task"] = task
+                        series_meta["plugin"] = f"waggle/{task}:0.1.0"
+                    if device in ["bme280", "bme680"]:
+                        series_meta["sensor"] = device
+                    if device.endswith("_camera"):
+                        series_meta["camera"] = device[: -len("_camera")]
+                    self.add_series(name, freq, series_meta)
+
+            for test in sanity_tests:
+                self.add_series(test, "1h", {**meta, "host": f"{node.id}.ws-nxcore", "severity": "fatal"})
+
+            for j in range(extra_series):
+                task = f"plugin-extra-{j}"
+                self.add_series(
+                    f"extra.value{j}",
+                    "30s",
+                    {**meta, "host": f"{node.id}.ws-nxcore", "task": task, "plugin": f"waggle/{task}:0.1.0"},
+                )
+
+    def add_series(self, name, freq, meta):
+        phase = len(self.series)
+        self.series.append((name, pd.Timedelta(freq) / self.rate, meta, phase))
+
+    def match(self, name, meta, filter):
+        for k, pattern in filter.items():
+            value = name if k == "name" else meta.get(k)
+            if value is None or re.fullmatch(pattern, value) is None:
+                return False
+        return True
+
+    def query(self, start, end, filter=None, head=None, tail=None, experimental_func=None):
+        """
+        Yields records in the format of the data API for the series matching filter in [start, end).
+        """
+        for name, interval, meta, phase in self.series:
+            if filter is not None and not self.match(name, meta, filter):
+                continue
+
+            # spread out the samples of different series within their interval
+            first = start.ceil(interval) + (phase % 7) * interval / 7
+            if first - interval >= start:
+                first -= interval
+            timestamps = pd.date_range(first, end, freq=interval, inclusive="left")
+
+            if experimental_func == "count":
+                if len(timestamps) > 0:
+                    yield {"timestamp": start, "name": name, "value": len(timestamps), "meta": meta}
+                continue
+            if head is not None:
+                timestamps = timestamps[:head]
+            if tail is not None:
+                timestamps = timestamps[len(timestamps) - tail :] if tail > 0 else timestamps[:0]
+
+            for ts in timestamps:
+                if name == "upload":
+                    value = f"https://storage.sagecontinuum.org/api/v1/data/{meta['node']}/{ts.value}-sample.jpg"
+                elif name.startswith("sys.sanity_status"):
+                    value = 0
+                else:
+                    value = get_value(name, ts, phase)
+                yield {"timestamp": ts, "name": name, "value": value, "meta": meta}
+
+
+def format_record(r):
+    return json.dumps(
+        {
+            "timestamp": r["timestamp"].strftime("%Y-%m-%dT%H:%M:%S.%f") + "000Z",
+            "name": r["name"],
+            "value": r["value"],
+            "meta": r["meta"],
+        }
+    )
+
+
+class WriteSink:
+    """
+    WriteSink counts the points and bytes written to each bucket through the InfluxDB write API.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.points = {}
+        self.bytes = 0
+        self.requests = 0
+
+    def add(self, bucket, body):
+        lines = [line for line in body.split(b"\n") if line.strip() != b""]
+        with self.lock:
+            self.points[bucket] = self.points.get(bucket, 0) + len(lines)
+            self.bytes += len(body)
+            self.requests += 1
+
+    def stats(self):
+        with self.lock:
+            return {"points": dict(self.points), "bytes": self.bytes, "requests": self.requests}
+
+
+class LocalServices:
+    """
+    LocalServices holds the state shared by all requests to the stand-in server.
+    """
+
+    def __init__(self, nodes=100, rate=1, extra_series=0, latency=0.0, responses=None):
+        self.items = get_node_table_items(nodes)
+        self.data = SyntheticData(self.items, rate=rate, extra_series=extra_series)
+        self.latency = latency
+        self.responses = responses
+        self.sink = WriteSink()
+
+    def get_recorded_response(self, path):
+        if self.responses is None or path not in recorded_response_names:
+            return None
+        p = Path(self.responses, recorded_response_names[path])
+        if not p.exists():
+            return None
+        return p.read_bytes()
+
+    def get_jobs(self):
+        jobs = {}
+        for i, item in enumerate(self.items):
+            plugins = [
+                {"name": f"imagesampler-{camera}"}
+                for camera in cameras
+                if item[f"{camera}_camera"] != "none"
+            ]
+            if len(plugins) > 0:
+                jobs[str(i)] = {
+                    "state": {"last_state": "Running"},
+                    "plugins": plugins,
+                    "nodes": {item["vsn"]: True},
+                }
+        return jobs
+
+    def get_plugin_status(self):
+        return {
+            item["node_id"]: [
+                {"meta": {"deployment": f"imagesampler-{camera}"}}
+                for camera in cameras
+                if item[f"{camera}_camera"] != "none"
+            ]
+            for item in self.items
+        }
+
+
+def parse_query_time(s, now):
+    if s is None:
+        return now
+    return pd.to_datetime(s, utc=True)
+
+
+def make_handler(services):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.info("%s %s", self.address_string(), format % args)
+
+        def send_body(self, body, content_type="application/json", status=200):
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzip.compress(body, compresslevel=1)
+                encoding = "gzip"
+            else:
+                encoding = None
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_body(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return body
+
+        def do_GET(self):
+            time.sleep(services.latency)
+            path = urlparse(self.path).path
+
+            recorded = services.get_recorded_response(path)
+            if recorded is not None:
+                self.send_body(recorded)
+            elif path in ["/production", "/monitoring.json"]:
+                self.send_body(json.dumps(services.items).encode())
+            elif path == "/api/v1/jobs/list":
+                self.send_body(json.dumps(services.get_jobs()).encode())
+            elif path == "/ses-plugin-data/latest-status.json":
+                self.send_body(json.dumps(services.get_plugin_status()).encode())
+            elif path == "/sink":
+                self.send_body(json.dumps(services.sink.stats()).encode())
+            else:
+                self.send_body(b'{"error": "not found"}', status=404)
+
+        def do_POST(self):
+            time.sleep(services.latency)
+            url = urlparse(self.path)
+            body = self.read_body()
+
+            if url.path == "/api/v2/write":
+                bucket = parse_qs(url.query).get("bucket", [""])[0]
+                services.sink.add(bucket, body)
+                self.send_response(204)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            elif url.path == "/api/v1/query":
+                recorded = services.get_recorded_response(url.path)
+                if recorded is not None:
+                    self.send_body(recorded, content_type="application/x-ndjson")
+                    return
+                q = json.loads(body)
+                now = pd.Timestamp.now(tz="UTC")
+                records = services.data.query(
+                    parse_query_time(q.get("start"), now),
+                    parse_query_time(q.get("end"), now),
+                    filter=q.get("filter"),
+                    head=q.get("head"),
+                    tail=q.get("tail"),
+                    experimental_func=q.get("experimental_func"),
+                )
+                lines = [format_record(r) for r in records]
+                self.send_body(
+                    "".join(line + "\n" for line in lines).encode(),
+                    content_type="application/x-ndjson",
+                )
+            else:
+                self.send_body(b'{"error": "not found"}', status=404)
+
+    return Handler
+
+
+def start_local_services(services, host="127.0.0.1", port=0):
+    """
+    Starts the stand-in server in a background thread and returns it. The bound port is
+    server.server_address[1].
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(services))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="serve synthetic stand-ins for the sage apis and an influxdb write sink"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", default=8888, type=int, help="port to listen on")
+    parser.add_argument("--nodes", default=100, type=int, help="number of synthetic nodes")
+    parser.add_argument(
+        "--rate", default=1, type=int, help="samples per expected publishing interval"
+    )
+    parser.add_argument(
+        "--extra-series",
+        default=0,
+        type=int,
+        help="number of extra 30s plugin series per node to increase payload size",
+    )
+    parser.add_argument(
+        "--latency", default=0.0, type=float, help="seconds to wait before each response"
+    )
+    parser.add_argument(
+        "--responses",
+        default=None,
+        type=Path,
+        help="directory of recorded responses to serve in place of synthetic ones",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+    )
+
+    services = LocalServices(
+        nodes=args.nodes,
+        rate=args.rate,
+        extra_series=args.extra_series,
+        latency=args.latency,
+        responses=args.responses,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(services))
+    logging.info(
+        "serving %d nodes and %d series on http://%s:%d",
+        args.nodes,
+        len(services.data.series),
+        args.host,
+        args.port,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logging.info("write sink %s", services.sink.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -4,87 +4,128 @@ from pathlib import Path
 import shutil
 import subprocess
 import time
+import logging
 import pandas as pd
-import slack
+from utils import (
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+)
 
 
-def publish_results_to_slack(result_file, save_file, token):
+# slack allows at most 50 blocks per message
+max_blocks_per_message = 50
+
+
+def get_changed_nodes(olddf, newdf):
+    """
+    Compares the previously reported issues with the new ones and returns a frame with the number
+    of recurring, new and resolved issues of each node whose set of issues changed.
+    """
+    mergedf = olddf.merge(newdf, how="outer", indicator="which", sort=True)
+    counts = (
+        pd.crosstab(mergedf["node"], mergedf["which"])
+        .reindex(columns=["both", "right_only", "left_only"], fill_value=0)
+        .rename(columns={"both": "same", "right_only": "new", "left_only": "fixed"})
+    )
+    # prefer the current vsn of a node in case it changed
+    counts["vsn"] = (
+        pd.concat([newdf, olddf]).drop_duplicates("node").set_index("node")["vsn"]
+    )
+    changed = (counts["new"] > 0) | (counts["fixed"] > 0)
+    return counts, counts[changed].reset_index()
+
+
+def split_blocks(blocks, max_blocks=max_blocks_per_message):
+    return [blocks[i : i + max_blocks] for i in range(0, len(blocks), max_blocks)]
+
+
+def publish_results_to_slack(
+    result_file, save_file, client, channel="nodehealth", file_threshold=50
+):
+    """
+    Posts the nodes whose issues changed since the report in save_file, split into as many
+    messages as needed. The results file is only uploaded when at least file_threshold issues
+    are new or resolved.
+    """
     if os.path.exists(save_file):
         olddf = pd.read_csv(filepath_or_buffer=save_file)
     else:
-        olddf = pd.DataFrame(columns=["node", "msg"])
+        olddf = pd.DataFrame(columns=["node", "vsn", "msg"])
 
     newdf = pd.read_csv(filepath_or_buffer=result_file)
-    mergedf = olddf.merge(newdf, how="outer", indicator="which", sort=True)
-    fixeddf = mergedf[mergedf.which == "left_only"].drop(columns="which")
-    brokendf = mergedf[mergedf.which == "right_only"].drop(columns="which")
-    samedf = mergedf[mergedf.which == "both"].drop(columns="which")
-
-    slack_blocks = [
-        {
-            "type": "header",
-            "text": {"type": "plain_text", "text": "Data Pipeline Results", "emoji": True},
-        },
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "The Data Pipeline Checker analyzes the data uploaded from the nodes, compares against an expected set and reports differences.\n\n_Note: the Data Pipeline Checker runs continuously but only reports when there is a difference since the last report._",
-            },
-        },
-        {"type": "divider"},
-    ]
-    total = 0
-    total_same = 0
-    total_new = 0
-    total_fixed = 0
-    for node, df_node in mergedf.groupby("node"):
-        vsn = list(mergedf[mergedf.node == node]["vsn"])[0]
-        same_cnt = samedf[samedf.node == node].count()["node"]
-        new_cnt = brokendf[brokendf.node == node].count()["node"]
-        fixed_cnt = fixeddf[fixeddf.node == node].count()["node"]
-        total += same_cnt + new_cnt
-        total_same += same_cnt
-        total_new += new_cnt
-        total_fixed += fixed_cnt
+    counts, changed = get_changed_nodes(olddf, newdf)
 
-        slack_blocks.append(
+    if len(changed) == 0:
+        print("- no node's issues changed, silent")
+    else:
+        total_same = int(counts["same"].sum())
+        total_new = int(counts["new"].sum())
+        total_fixed = int(counts["fixed"].sum())
+        total = total_same + total_new
+
+        slack_blocks = [
+            {
+                "type": "header",
+                "text": {"type": "plain_text", "text": "Data Pipeline Results", "emoji": True},
+            },
             {
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
-                    "text": f"*{vsn}* ({node})\n```{same_cnt+new_cnt} active issues ({same_cnt} recurring | {new_cnt} new)\n{fixed_cnt} resolved issues```",
+                    "text": "The Data Pipeline Checker analyzes the data uploaded from the nodes, compares against an expected set and reports differences.\n\n_Note: the Data Pipeline Checker runs continuously but only reports nodes whose issues changed since the last report._",
                 },
-                "accessory": {
-                    "type": "button",
-                    "text": {"type": "plain_text", "text": "Node Status", "emoji": True},
-                    "value": f"status_{node}",
-                    "url": f"https://admin.sagecontinuum.org/node/{node}",
-                    "action_id": "button-action",
+            },
+            {"type": "divider"},
+        ]
+
+        for r in changed.itertuples(index=False):
+            slack_blocks.append(
+                {
+                    "type": "section",
+                    "text": {
+                        "type": "mrkdwn",
+                        "text": f"*{r.vsn}* ({r.node})\n```{r.same+r.new} active issues ({r.same} recurring | {r.new} new)\n{r.fixed} resolved issues```",
+                    },
+                    "accessory": {
+                        "type": "button",
+                        "text": {"type": "plain_text", "text": "Node Status", "emoji": True},
+                        "value": f"status_{r.node}",
+                        "url": f"https://admin.sagecontinuum.org/node/{r.node}",
+                        "action_id": "button-action",
+                    },
+                }
+            )
+
+        slack_blocks.append({"type": "divider"})
+        slack_blocks.append(
+            {
+                "type": "section",
+                "text": {
+                    "type": "mrkdwn",
+                    "text": f"*Active Summary*\n\n```{total} active issues ({total_same} recurring | {total_new} new)\n{total_fixed} resolved issues\n{len(changed)} of {len(counts)} nodes changed```",
                 },
-            }
-        )
-
-    slack_blocks.append({"type": "divider"})
-    slack_blocks.append(
-        {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": f"*Active Summary*\n\n```{total} active issues ({total_same} recurring | {total_new} new)\n{total_fixed} resolved issues```",
             },
-        },
-    )
+        )
 
-    client = slack.WebClient(token=token)
-    print("posting report")
-    client.chat_postMessage(
-        channel="nodehealth",
-        blocks=slack_blocks,
-    )
-    print("posting file", result_file)
-    # NOTE slackclient only accepts string based paths
-    client.files_upload(channels="nodehealth", file=str(result_file), title="results file")
+        # post the first part of the report to the channel and the rest in its thread
+        print("posting report")
+        messages = split_blocks(slack_blocks)
+        response = client.chat_postMessage(channel=channel, blocks=messages[0])
+        thread_ts = response["ts"]
+        for blocks in messages[1:]:
+            client.chat_postMessage(channel=channel, blocks=blocks, thread_ts=thread_ts)
+
+        if total_new + total_fixed >= file_threshold:
+            print("posting file", result_file)
+            # NOTE slackclient only accepts string based paths
+            client.files_upload(
+                channels=channel,
+                file=str(result_file),
+                title="results file",
+                thread_ts=thread_ts,
+            )
 
     if os.path.exists(save_file):
         os.remove(save_file)
@@ -115,8 +156,24 @@ def main():
     parser.add_argument("-p", "--path", default=".", help="path to store files")
     parser.add_argument("-c", "--checker", default="check_nodes.py", help="path to checker script")
     parser.add_argument("--window", default="5m", help="data window duration for check")
+    parser.add_argument(
+        "--file-threshold",
+        default=50,
+        type=int,
+        help="only upload the results file when at least this many issues are new or resolved",
+    )
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
+    if args.profile or args.profile_textfile is not None:
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s %(message)s",
+            datefmt="%Y/%m/%d %H:%M:%S",
+        )
+
+    enable_profiling(args)
+
     SLACK_TOKEN = os.environ["SLACK_TOKEN"]
 
     # run the checker and get the results saved to a file
@@ -133,7 +190,8 @@ def main():
         str(result_file),
     ]
     print(f"- run checker: {cmd}")
-    subprocess.check_output(cmd, timeout=120)
+    with profiler.stage("checker"):
+        subprocess.check_output(cmd, timeout=120)
 
     print("- results:")
     print(result_file.read_text())
@@ -146,13 +204,25 @@ def main():
 
     if files_equal(result_file, report_file):
         print("- results do NOT differ from last report, silent")
+        write_profile_textfile(args, "report_results")
         return
 
     print("- results differ from last report")
-    publish_results_to_slack(result_file, report_file, token=SLACK_TOKEN)
+    # only import the slack client when there are results to publish
+    import slack
+
+    with profiler.stage("publish"):
+        publish_results_to_slack(
+            result_file,
+            report_file,
+            client=slack.WebClient(token=SLACK_TOKEN),
+            file_threshold=args.file_threshold,
+        )
 
     clean_up_old_files(args)
 
+    write_profile_textfile(args, "report_results")
+
 
 if __name__ == "__main__":
     main()
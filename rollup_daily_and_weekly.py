@@ -0,0 +1,268 @@
+import argparse
+import os
+import sys
+from os import getenv
+from pathlib import Path
+import pandas as pd
+import logging
+
+from utils import (
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+    parse_time,
+    write_results_to_influxdb,
+    open_write_index,
+    WriteSpool,
+    replay_spool,
+    parse_write_index_tags,
+)
+
+
+# aggregations describes how the hourly values of each measurement are combined into
+# longer periods. health checks become the fraction of healthy hours and counts are summed.
+aggregations = {
+    "node_health_check": "mean",
+    "device_health_check": "mean",
+    "sanity_test_total": "sum",
+    "sanity_test_pass_total": "sum",
+    "sanity_test_fail_total": "sum",
+    "sanity_test_name_pass_total": "sum",
+    "sanity_test_name_fail_total": "sum",
+    "total": "sum",
+}
+
+periods = ["1d", "1w"]
+
+
+def get_period_start(timestamps, period):
+    """
+    Returns the start of the period containing each timestamp. Weeks start on Monday.
+    """
+    if period == "1w":
+        timestamps = timestamps - pd.to_timedelta(timestamps.dt.dayofweek, unit="D")
+        return timestamps.dt.floor("1d")
+    return timestamps.dt.floor(period)
+
+
+def get_period_range(start, end, period):
+    start = get_period_start(pd.Series([start]), period)[0]
+    end = get_period_start(pd.Series([end]), period)[0]
+    return start, end
+
+
+def get_missing_periods(df, period_starts, period):
+    """
+    Returns the period starts which are missing any hour in df. Hours with no records at all
+    weren't rolled up yet, or were rolled up into another index.
+    """
+    hours = set(df["timestamp"])
+    return [
+        p
+        for p in period_starts
+        if any(
+            h not in hours
+            for h in pd.date_range(p, p + pd.Timedelta(period), freq="1h", inclusive="left")
+        )
+    ]
+
+
+def get_period_records_for_bucket(indexes, bucket, start, end, period):
+    """
+    Derives period records from the hourly records last written to bucket in [start, end).
+    No raw data is queried. Returns the records and the starts of any periods in the range which
+    are skipped because the indexes don't cover them.
+
+    Each index is expected to hold every hour of each period it has records for, such as the
+    per shard indexes of sharded rollups, so a shard which is behind skips the period.
+    """
+    period_starts = get_period_start(
+        pd.Series(pd.date_range(start, end, freq="1h", inclusive="left")), period
+    ).unique()
+
+    frames = []
+    incomplete = set()
+
+    for index in indexes:
+        df = index.get_frame(bucket, list(aggregations), start, end)
+        # only rollup periods where every hour was written. otherwise the index doesn't cover
+        # the whole period, for example if the hourly rollups are behind, and its values would be
+        # partial.
+        incomplete.update(get_missing_periods(df, period_starts, period))
+        frames.append(df)
+
+    incomplete = sorted(incomplete)
+
+    # the same point may be in several indexes, for example after changing the number of shards
+    df = pd.concat(frames).drop_duplicates(["measurement", "tags", "timestamp"], keep="last")
+    df["period"] = get_period_start(df["timestamp"], period)
+    df = df[~df["period"].isin(incomplete)]
+
+    if len(df) == 0:
+        return [], incomplete
+
+    table = (
+        df.groupby(["measurement", "tags", "period"])["value"]
+        .agg(["mean", "sum", "count"])
+        .reset_index()
+    )
+
+    # counts are only written for hours with data, so missing hours of a count series are zero.
+    # health checks are written every hour, so a series missing hours, such as a node added
+    # during the period, would have a partial mean and is left out.
+    hours = pd.Timedelta(period) // pd.Timedelta("1h")
+    partial = table["measurement"].map(aggregations).eq("mean") & (table["count"] < hours)
+    if partial.any():
+        logging.warning(
+            "leaving out %d %s series in %s missing hours", partial.sum(), period, bucket
+        )
+        table = table[~partial]
+
+    records = []
+
+    for r in table.itertuples(index=False):
+        agg = aggregations[r.measurement]
+        value = float(r.mean) if agg == "mean" else int(r.sum)
+        records.append(
+            {
+                "measurement": f"{r.measurement}_{period}",
+                "tags": parse_write_index_tags(r.tags),
+                "fields": {
+                    "value": value,
+                },
+                "timestamp": r.period,
+            }
+        )
+
+    return records, incomplete
+
+
+def main():
+    now = pd.to_datetime("now", utc=True)
+
+    def time_arg(s):
+        return parse_time(s, now=now)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="perform dry run to view logs. will skip writing results to influxdb.",
+    )
+    parser.add_argument(
+        "--start", default="-8d", type=time_arg, help="relative start time"
+    )
+    parser.add_argument("--end", default="now", type=time_arg, help="relative end time")
+    parser.add_argument(
+        "--period",
+        action="append",
+        choices=periods,
+        help="period to rollup. may be repeated. defaults to all periods.",
+    )
+    parser.add_argument(
+        "--write-index",
+        required=True,
+        action="append",
+        type=Path,
+        help="path to local index of values written by the hourly rollups. may be repeated, such as once per shard. results are indexed in the first.",
+    )
+    parser.add_argument(
+        "--spool",
+        default=None,
+        type=Path,
+        help="path to local spool of records waiting to be written. failed writes are replayed on later runs.",
+    )
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+    )
+
+    enable_profiling(args)
+
+    buckets = [
+        getenv("INFLUXDB_BUCKET_HEALTH", "health-check-test"),
+        getenv("INFLUXDB_BUCKET_SANITY", "downsampled-test"),
+        getenv("INFLUXDB_BUCKET_PLUGIN", "plugin-stats"),
+        getenv("INFLUXDB_BUCKET_UPLOAD", "upload-stats"),
+    ]
+
+    if not args.dry_run:
+        INFLUXDB_URL = getenv("INFLUXDB_URL", "https://influxdb.sagecontinuum.org")
+        INFLUXDB_ORG = getenv("INFLUXDB_ORG", "waggle")
+        INFLUXDB_TOKEN = os.environ["INFLUXDB_TOKEN"]
+
+    logging.info("current time is %s", now)
+
+    # the indexes are the only source of hourly records, so they must not be created empty
+    for path in args.write_index:
+        if not path.exists():
+            parser.error(f"write index {path} does not exist")
+
+    index = open_write_index(args.write_index[0], dry_run=args.dry_run)
+    indexes = [index] + [open_write_index(path, dry_run=True) for path in args.write_index[1:]]
+
+    spool = None
+    if args.spool is not None and not args.dry_run:
+        spool = WriteSpool(args.spool)
+        replay_spool(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            spool=spool,
+            index=index,
+        )
+
+    skipped = []
+
+    for period in args.period or periods:
+        # only rollup complete periods
+        start, end = get_period_range(args.start, args.end, period)
+
+        for bucket in buckets:
+            logging.info("getting %s records for %s in %s %s", period, bucket, start, end)
+            with profiler.stage("period_records", period=period, bucket=bucket) as stage:
+                records, incomplete = get_period_records_for_bucket(
+                    indexes, bucket, start, end, period
+                )
+                stage["rows"] = len(records)
+
+            for period_start in incomplete:
+                logging.error(
+                    "write index doesn't cover %s period %s for %s. skipping.",
+                    period,
+                    period_start,
+                    bucket,
+                )
+                skipped.append((period, period_start, bucket))
+
+            if not args.dry_run:
+                logging.info("writing %d %s records...", len(records), period)
+                write_results_to_influxdb(
+                    url=INFLUXDB_URL,
+                    org=INFLUXDB_ORG,
+                    token=INFLUXDB_TOKEN,
+                    bucket=bucket,
+                    records=records,
+                    index=index,
+                    spool=spool,
+                )
+
+    logging.info("suppressed %d unchanged points", index.suppressed)
+    for index in indexes:
+        index.close()
+
+    write_profile_textfile(args, "rollup_daily_and_weekly")
+
+    if len(skipped) > 0:
+        sys.exit(f"skipped {len(skipped)} periods not covered by the write index")
+
+    logging.info("done!")
+
+
+if __name__ == "__main__":
+    main()
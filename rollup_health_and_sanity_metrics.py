@@ -1,248 +1,430 @@
 import argparse
 import os
+from pathlib import Path
 from os import getenv
+import numpy as np
 import pandas as pd
 import logging
-import sage_data_client
-import requests
+import heapq
+import itertools
+import time
 from utils import (
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+    get_reporter_run_record,
+    get_data_source,
+    add_data_source_arguments,
+    set_data_source_from_args,
+    http_get,
+    iter_response_text,
+    iter_json_object_items,
     load_node_table,
     parse_time,
     get_rollup_range,
     get_time_windows,
     write_results_to_influxdb,
+    open_write_index,
+    WriteSpool,
+    replay_spool,
+    add_node_selection_arguments,
+    has_node_selection,
+    select_nodes,
+    parse_shard,
+    get_nodes_in_shard,
+    get_vsn_filter,
     check_publishing_frequency,
+    stream_records,
+    replay_records,
+    get_node_frame,
+    get_records_from_frame,
+    Fleet,
+    SAGE_SCHEDULER_URL,
 )
+from series_registry import (
+    device_output_table,
+    bme_tasks,
+    sys_tasks,
+    series_classifier,
+)
+
+
+# value_rule_table describes the valid values of a series, in addition to its publishing policy
+# in device_output_table. each rule is (task, name, min, max, stale) where min and max bound every
+# value and a series whose samples span at least stale in a window without changing value is
+# considered stuck. None disables a check. a series which breaks its rule fails the health check
+# of its device.
+value_rule_table = [
+    *[(task, "env.temperature", -60, 70, None) for task in bme_tasks],
+    *[(task, "env.relative_humidity", 0, 100, None) for task in bme_tasks],
+    *[(task, "env.pressure", 30000, 110000, None) for task in bme_tasks],
+    ("wes-raingauge", "env.raingauge.event_acc", 0, None, None),
+    ("wes-raingauge", "env.raingauge.rint", 0, None, None),
+    ("wes-raingauge", "env.raingauge.total_acc", 0, None, None),
+    *[(task, "sys.uptime", 0, None, "10min") for task in sys_tasks],
+    *[(task, "sys.time", None, None, "10min") for task in sys_tasks],
+    # read-only and static filesystems report a constant avail, so it's never considered stuck
+    *[(task, "sys.fs.avail", 0, None, None) for task in sys_tasks],
+    *[(task, "sys.mem.avail", 0, None, None) for task in sys_tasks],
+]
+
+
+# instance_meta are the meta fields which tell apart instances of a series which a device publishes
+# more than once, such as sys.fs.avail for each filesystem. value rules are checked per instance,
+# as the values of different instances can't be compared.
+instance_meta = ["fs", "device", "mountpoint"]
+
+
+def get_series_instances(df):
+    """
+    Returns the instance of each sample's series from its instance_meta fields. Series which are
+    only published once have the same instance.
+    """
+    instance = pd.Series("", index=df.index, name="instance")
+    for field in instance_meta:
+        values = df.get(f"meta.{field}")
+        if values is not None:
+            instance = instance + "/" + values.fillna("").astype(str)
+        else:
+            instance = instance + "/"
+    return instance
+
+
+def get_series_instance(meta):
+    """
+    Returns the instance of a stream record's series in the same format as get_series_instances.
+    """
+    return "".join("/" + str(meta.get(field) or "") for field in instance_meta)
+
+
+def get_rule_for_series():
+    """
+    Returns a map of (task, name) -> (min, max) from value_rule_table, with unbounded sides as infinities.
+    """
+    return {
+        (task, name): (
+            float("-inf") if low is None else low,
+            float("inf") if high is None else high,
+        )
+        for task, name, low, high, _ in value_rule_table
+    }
+
 
+def get_value_rule_frame():
+    return pd.DataFrame(
+        [
+            (task, name, low, high, None if stale is None else pd.Timedelta(stale))
+            for task, name, low, high, stale in value_rule_table
+        ],
+        columns=["task", "name", "min", "max", "stale"],
+    ).astype({"min": float, "max": float, "stale": "timedelta64[ns]"})
 
-# these metrics are coming in inconsistently. we should debug later
-# but to make the health report less red, we'll comment them out.
-# sys.cooling*
-# sys.freq*
-# sys.gps*
-
-sys_from_nxcore = {
-    "sys.boot_time",
-    # "sys.cooling",
-    # "sys.cooling_max",
-    "sys.cpu_seconds",
-    # "sys.freq.ape",
-    # "sys.freq.cpu",
-    # "sys.freq.cpu_max",
-    # "sys.freq.cpu_min",
-    # "sys.freq.cpu_perc",
-    # "sys.freq.emc",
-    # "sys.freq.emc_max",
-    # "sys.freq.emc_min",
-    # "sys.freq.emc_perc",
-    # "sys.freq.gpu",
-    # "sys.freq.gpu_max",
-    # "sys.freq.gpu_min",
-    # "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.power",
-    "sys.rssh_up",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-    # "sys.gps.lat", # not sent with no GPS fix
-    # "sys.gps.lon", # not sent with no GPS fix
-    # "sys.gps.alt", # not sent with no GPS fix
-    # "sys.gps.epx", # not sent with no GPS fix
-    # "sys.gps.epy", # not sent with no GPS fix
-    # "sys.gps.epv", # not sent with no GPS fix
-    # "sys.gps.satellites", # not sent with no GPS fix
-    # "sys.gps.mode",
-}
-
-sys_from_dellblade = {
-    "sys.boot_time",
-    # "sys.cooling",
-    # "sys.cooling_max",
-    "sys.cpu_seconds",
-    # "sys.freq.ape",
-    # "sys.freq.cpu",
-    # "sys.freq.cpu_max",
-    # "sys.freq.cpu_min",
-    # "sys.freq.cpu_perc",
-    # "sys.freq.emc",
-    # "sys.freq.emc_max",
-    # "sys.freq.emc_min",
-    # "sys.freq.emc_perc",
-    # "sys.freq.gpu",
-    # "sys.freq.gpu_max",
-    # "sys.freq.gpu_min",
-    # "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    # "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    # "sys.power",
-    # "sys.rssh_up", # no network watchdog
-    # "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-sys_from_nxagent = {
-    "sys.boot_time",
-    # "sys.cooling",
-    # "sys.cooling_max",
-    "sys.cpu_seconds",
-    # "sys.freq.ape",
-    # "sys.freq.cpu",
-    # "sys.freq.cpu_max",
-    # "sys.freq.cpu_min",
-    # "sys.freq.cpu_perc",
-    # "sys.freq.emc",
-    # "sys.freq.emc_max",
-    # "sys.freq.emc_min",
-    # "sys.freq.emc_perc",
-    # "sys.freq.gpu",
-    # "sys.freq.gpu_max",
-    # "sys.freq.gpu_min",
-    # "sys.freq.gpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.power",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-sys_from_rpi = {
-    "sys.boot_time",
-    "sys.cpu_seconds",
-    "sys.freq.cpu",
-    "sys.freq.cpu_max",
-    "sys.freq.cpu_min",
-    "sys.freq.cpu_perc",
-    "sys.fs.avail",
-    "sys.fs.size",
-    "sys.hwmon",
-    "sys.load1",
-    "sys.load15",
-    "sys.load5",
-    "sys.mem.avail",
-    "sys.mem.free",
-    "sys.mem.total",
-    "sys.net.rx_bytes",
-    "sys.net.rx_packets",
-    "sys.net.tx_bytes",
-    "sys.net.tx_packets",
-    "sys.net.up",
-    "sys.thermal",
-    "sys.time",
-    "sys.uptime",
-}
-
-outputs_from_bme = {
-    "env.temperature",
-    "env.relative_humidity",
-    "env.pressure",
-}
-
-outputs_from_raingauge = {
-    # "env.raingauge.acc",
-    "env.raingauge.event_acc",
-    "env.raingauge.rint",
-    "env.raingauge.total_acc",
-}
-
-# add a stuct here which either has count or interval so we can check this
-# "nxcore": Check("nxcore", name, mean_publish_interval="3min")
-
-# device_output_table describes the output publishing policy for each of
-# the possible devices on a node. the frequency is the minimum expected
-# publishing frequency
-device_output_table = {
-    "nxcore": [("nxcore", name, "120s") for name in sys_from_nxcore],
-    "nxagent": [("nxagent", name, "120s") for name in sys_from_nxagent],
-    "rpi": [("rpi", name, "120s") for name in sys_from_rpi],
-    "dell": [("dell", name, "60s") for name in sys_from_dellblade],
-    "bme280": [("wes-iio-bme280", name, "30s") for name in outputs_from_bme],
-    "bme680": [("wes-iio-bme680", name, "30s") for name in outputs_from_bme],
-    "raingauge": [("wes-raingauge", name, "30s") for name in outputs_from_raingauge],
-    "top_camera": [("imagesampler-top", "upload", "1h")],
-    "bottom_camera": [("imagesampler-bottom", "upload", "1h")],
-    "left_camera": [("imagesampler-left", "upload", "1h")],
-    "right_camera": [("imagesampler-right", "upload", "1h")],
-    "microphone": [("audiosampler", "upload", "1h")],
-}
+
+def get_rule_stats(groups):
+    """
+    Returns the per series stats needed to evaluate value_rule_table over a window in one pass.
+    groups must be the window grouped by ["meta.vsn", "meta.task", "name"], optionally followed by
+    the series instance from get_series_instances. Only series with a rule are kept.
+    """
+    rules = get_value_rule_frame().set_index(["task", "name"])
+    df = groups.obj
+
+    # look up the rule once per series and broadcast it to samples by group number, rather than
+    # joining the rules to every sample.
+    keys = groups.size().index
+    bounds = rules.reindex(
+        pd.MultiIndex.from_arrays(
+            [keys.get_level_values("meta.task"), keys.get_level_values("name")]
+        )
+    )
+    has_rule = bounds.notna().any(axis=1).to_numpy()
+    # NOTE samples with a missing vsn or task are not in any group and are numbered nan
+    group = groups.ngroup().fillna(-1).to_numpy(dtype=int)
+    mask = group >= 0
+    mask[mask] = has_rule[group[mask]]
+    group = group[mask]
+
+    samples = pd.DataFrame(
+        {
+            "group": group,
+            "timestamp": df["timestamp"].array[mask],
+            "value": pd.to_numeric(df["value"].array[mask], errors="coerce"),
+        }
+    )
+    samples["out_of_range"] = (samples["value"] < bounds["min"].to_numpy()[group]) | (
+        samples["value"] > bounds["max"].to_numpy()[group]
+    )
+
+    stats = samples.groupby("group").agg(
+        count=("timestamp", "size"),
+        out_of_range=("out_of_range", "sum"),
+        value_min=("value", "min"),
+        value_max=("value", "max"),
+        first=("timestamp", "min"),
+        last=("timestamp", "max"),
+    )
+    stats.index = keys[stats.index].set_names({"meta.vsn": "vsn", "meta.task": "task"})
+    return stats.reset_index()
+
+
+def get_rule_violations(stats):
+    """
+    Returns the (vsn, task, name, rule, value) of each broken rule in stats, where rule is either
+    range or stale and value is the number of samples which broke it, summed over the instances
+    of the series.
+    """
+    df = stats.merge(get_value_rule_frame()[["task", "name", "stale"]], on=["task", "name"])
+    # NaT stale rules never match and NaN values are never equal, so series without usable
+    # values are not considered stuck.
+    is_stale = (df["value_min"] == df["value_max"]) & (df["last"] - df["first"] >= df["stale"])
+
+    violations = pd.concat(
+        [
+            df.loc[df["out_of_range"] > 0, ["vsn", "task", "name", "out_of_range"]]
+            .rename(columns={"out_of_range": "value"})
+            .assign(rule="range"),
+            df.loc[is_stale, ["vsn", "task", "name", "count"]]
+            .rename(columns={"count": "value"})
+            .assign(rule="stale"),
+        ]
+    )
+    return violations.groupby(["vsn", "task", "name", "rule"], as_index=False)["value"].sum()
+
+
+def get_cadence_stats(groups, start, end):
+    """
+    Returns the median and p95 interval between samples and the longest gap of each tracked
+    (vsn, task, name) series in [start, end), in seconds. The gaps before the first and after the
+    last sample are included in the longest gap, so a series which drops out at the end of the
+    window is caught. groups must be the window grouped by ["meta.vsn", "meta.task", "name"].
+    """
+    freq_for_series = get_freq_for_series()
+    df = groups.obj
+
+    keys = groups.size().index
+    tracked = (
+        pd.Series(True, index=pd.MultiIndex.from_tuples(freq_for_series))
+        .reindex(keys.droplevel(0), fill_value=False)
+        .to_numpy()
+    )
+    # NOTE samples with a missing vsn or task are not in any group and are numbered nan
+    group = groups.ngroup().fillna(-1).to_numpy(dtype=int)
+    mask = group >= 0
+    mask[mask] = tracked[group[mask]]
+
+    # sort all samples by series then time once, so the intervals of every series are the
+    # differences between neighbouring samples of the same series.
+    group = group[mask]
+    ts = df["timestamp"].to_numpy(dtype="datetime64[ns]")[mask].view("int64")
+
+    if len(group) == 0:
+        return pd.DataFrame(
+            columns=["vsn", "task", "name", "median_interval", "p95_interval", "longest_gap"]
+        )
+
+    order = np.lexsort((ts, group))
+    group = group[order]
+    ts = ts[order]
+
+    same = group[1:] == group[:-1]
+    intervals = pd.DataFrame(
+        {
+            "group": group[1:][same],
+            "interval": (ts[1:] - ts[:-1])[same] / 1e9,
+        }
+    ).groupby("group")["interval"]
+
+    is_first = np.r_[True, ~same]
+    is_last = np.r_[~same, True]
+    stats = pd.DataFrame(
+        {
+            "median_interval": intervals.median(),
+            "p95_interval": intervals.quantile(0.95),
+            "longest_interval": intervals.max(),
+        },
+        index=pd.Index(group[is_first], name="group"),
+    )
+    stats["longest_gap"] = np.fmax(
+        stats["longest_interval"].to_numpy(),
+        np.maximum(
+            (ts[is_first] - start.value) / 1e9,
+            (end.value - ts[is_last]) / 1e9,
+        ),
+    )
+    stats.index = keys[stats.index].set_names(["vsn", "task", "name"])
+    return stats.drop(columns="longest_interval").reset_index()
+
+
+def get_cadence_records(stats, nodes, timestamp):
+    vsns = {node.vsn for node in nodes}
+    records = []
+
+    for r in stats.itertuples(index=False):
+        if r.vsn not in vsns:
+            continue
+        fields = {"longest_gap_seconds": float(r.longest_gap)}
+        # series with a single sample have no intervals
+        if not pd.isna(r.median_interval):
+            fields["median_interval_seconds"] = float(r.median_interval)
+            fields["p95_interval_seconds"] = float(r.p95_interval)
+        records.append(
+            {
+                "measurement": "publish_cadence",
+                "tags": {
+                    "vsn": r.vsn,
+                    "task": r.task,
+                    "name": r.name,
+                },
+                "fields": fields,
+                "timestamp": timestamp,
+            }
+        )
+
+    return records
 
 
 def get_scheduled_tasks_by_node():
     """
     Queries the cloud scheduler and returns a map of VSN -> [Plugin names across all running jobs for VSN]
     """
-    r = requests.get("https://es.sagecontinuum.org/api/v1/jobs/list")
-    r.raise_for_status()
-    jobs = list(r.json().values())
+    tasks_by_node = {}
 
-    # filter only running jobs
-    jobs = [job for job in jobs if job["state"]["last_state"] == "Running"]
+    with profiler.stage("scheduled_tasks") as stage, http_get(
+        f"{SAGE_SCHEDULER_URL}/api/v1/jobs/list", stream=True
+    ) as r:
+        # NOTE the jobs list is large, so we stream it and only keep the plugins of running jobs
+        for _, job in iter_json_object_items(iter_response_text(r)):
+            # filter only running jobs
+            if job["state"]["last_state"] != "Running":
+                continue
+
+            plugins = job.get("plugins") or []
+            nodes = job.get("nodes") or {}
+
+            for plugin in plugins:
+                for vsn in nodes.keys():
+                    if vsn not in tasks_by_node:
+                        tasks_by_node[vsn] = []
+                    tasks_by_node[vsn].append(plugin["name"])
+                    stage["rows"] += 1
 
-    tasks_by_node = {}
+    return tasks_by_node
 
-    for job in jobs:
-        plugins = job.get("plugins") or []
-        nodes = job.get("nodes") or {}
 
-        for plugin in plugins:
-            for vsn in nodes.keys():
-                if vsn not in tasks_by_node:
-                    tasks_by_node[vsn] = []
-                tasks_by_node[vsn].append(plugin["name"])
+class ScheduledTasksCache:
+    """
+    ScheduledTasksCache keeps the result of get_scheduled_tasks_by_node and only fetches it again
+    once it's older than refresh. Live mode scores a window or rolling step every few minutes,
+    which doesn't need a fresh copy of the jobs list each time. If a refresh fails, the last tasks
+    are kept and the refresh is retried on the next use.
+    """
 
-    return tasks_by_node
+    def __init__(self, refresh=pd.Timedelta("10min"), clock=time.monotonic):
+        self.refresh = refresh.total_seconds()
+        self.clock = clock
+        self.tasks = None
+        self.fetched = None
 
+    def get(self):
+        now = self.clock()
+        if self.tasks is not None and now - self.fetched < self.refresh:
+            return self.tasks
+        try:
+            self.tasks = get_scheduled_tasks_by_node()
+        except (OSError, ValueError) as exc:
+            if self.tasks is None:
+                raise
+            logging.warning("failed to refresh scheduled tasks. keeping last tasks: %s", exc)
+            return self.tasks
+        self.fetched = now
+        return self.tasks
 
-def get_health_records_for_window(nodes, start, end, window):
-    records = []
+
+def get_health_records_for_window(
+    nodes, start, end, window, pushdown=False, scheduled_tasks_by_node=None, fleet=None
+):
+    filter = None
+
+    # restrict query to only the given nodes. this is useful when only rolling up a few nodes.
+    if pushdown:
+        filter = {"vsn": get_vsn_filter(nodes)}
 
     logging.info("querying data...")
-    df = sage_data_client.query(start=start, end=end)
+    df = get_data_source().query(start, end, filter=filter)
     logging.info("done")
 
     logging.info("checking data...")
 
+    # runs over many windows may fetch the scheduled tasks once and pass them in
+    if scheduled_tasks_by_node is None:
+        scheduled_tasks_by_node = get_scheduled_tasks_by_node()
+
+    with profiler.stage("health_check") as stage:
+        # NOTE derive task name from sys metrics using host
+        device = series_classifier.get_devices(df)
+        is_sys = device.isin(sys_tasks)
+        df.loc[is_sys, "meta.task"] = device[is_sys]
+
+        groups = df.groupby(["meta.vsn", "meta.task", "name"])
+        rule_violations = get_rule_violations(
+            get_rule_stats(
+                df.groupby(["meta.vsn", "meta.task", "name", get_series_instances(df)])
+            )
+        )
+
+        def get_publishing_frequency(vsn, task, name, freq):
+            try:
+                group = groups.get_group((vsn, task, name))
+            except KeyError:
+                return 0.0
+            return check_publishing_frequency(group, freq, window)
+
+        records = get_health_records_from_publishing_frequency(
+            nodes,
+            start,
+            end,
+            vsns_with_data=set(df["meta.vsn"]),
+            get_publishing_frequency=get_publishing_frequency,
+            scheduled_tasks_by_node=scheduled_tasks_by_node,
+            rule_violations=rule_violations,
+            fleet=fleet,
+        )
+        # NOTE cadence stats need every sample time, so unlike the health checks they're only
+        # computed by the windowed rollup and not in live mode.
+        records += get_cadence_records(get_cadence_stats(groups, start, end), nodes, start)
+        stage["rows"] = len(df)
+
+    logging.info("done")
+
+    return records
+
+
+def get_health_records_from_publishing_frequency(
+    nodes,
+    start,
+    end,
+    vsns_with_data,
+    get_publishing_frequency,
+    scheduled_tasks_by_node,
+    rule_violations,
+    fleet=None,
+):
+    """
+    Scores the health of each node and device in [start, end). get_publishing_frequency(vsn, task, name, freq)
+    must return the fraction of freq sized bins in the window which have at least one sample.
+    rule_violations is a frame of broken value rules from get_rule_violations, which also fail
+    their device and are counted in health_rule_failure_total. fleet is the Fleet of nodes, which
+    runs over many windows may build once and pass in.
+    """
+    records = []
+
     timestamp = start
 
+    failed_rules = {}
+    for r in rule_violations.itertuples(index=False):
+        failed_rules.setdefault((r.vsn, r.task, r.name), []).append(r.rule)
+
     def add_node_health_check_record(vsn, value):
         records.append(
             {
@@ -272,44 +454,30 @@ def get_health_records_for_window(nodes, start, end, window):
             }
         )
 
-    # NOTE derive task name from sys metrics using host
-    is_sys = df["name"].str.startswith("sys.")
-    df.loc[is_sys & df["meta.host"].str.endswith("nxcore"), "meta.task"] = "nxcore"
-    df.loc[is_sys & df["meta.host"].str.endswith("nxagent"), "meta.task"] = "nxagent"
-    # NOTE this will not really work for nodes with multiple rpis. we need to rethink this a bit
-    # in the future. for now, we want to fix the urgent problem of differentiating most sys metrics.
-    df.loc[is_sys & df["meta.host"].str.endswith("rpi"), "meta.task"] = "rpi"
-    df.loc[is_sys & df["meta.host"].str.endswith("sbcore"), "meta.task"] = "dell"
-
-    vsn_groups = df.groupby(["meta.vsn"])
+    if fleet is None:
+        fleet = Fleet(nodes)
+    has_data = np.isin(fleet.vsns, list(vsns_with_data))
 
-    scheduled_tasks_by_node = get_scheduled_tasks_by_node()
-
-    for node in nodes:
-        try:
-            df_vsn = vsn_groups.get_group(node.vsn)
-        except:
-            add_node_health_check_record(node.vsn, 0)
-            for device in node.devices:
-                add_device_health_check_record(node.vsn, device, 0)
-            continue
+    # nodes without any data are unhealthy along with all of their devices
+    for vsn in fleet.vsns[~has_data]:
+        add_node_health_check_record(vsn, 0)
+    missing = fleet.get_device_frame(~has_data)
+    for vsn, device in zip(missing["meta.vsn"], missing["device"]):
+        add_device_health_check_record(vsn, device, 0)
 
-        groups = df_vsn.groupby(["meta.task", "name"])
+    for i in np.flatnonzero(has_data):
+        node = nodes[i]
 
-        def check_publishing_frequency_for_device(device, window):
+        def check_publishing_frequency_for_device(device):
             for task, name, freq in device_output_table[device]:
-                try:
-                    group = groups.get_group((task, name))
-                    yield task, name, check_publishing_frequency(group, freq, window)
-                except KeyError:
-                    yield task, name, 0.0
+                yield task, name, get_publishing_frequency(node.vsn, task, name, freq)
 
         scheduled_tasks = scheduled_tasks_by_node.get(node.vsn, [])
 
-        def check_publishing_sla_for_device(device, window, sla):
+        def check_publishing_sla_for_device(device, sla):
             healthy = True
 
-            for task, name, f in check_publishing_frequency_for_device(device, window):
+            for task, name, f in check_publishing_frequency_for_device(device):
                 # skip image and audio sampler tasks which are not scheduled
                 if "sampler" in task and task not in scheduled_tasks:
                     continue
@@ -325,77 +493,480 @@ def get_health_records_for_window(nodes, start, end, window):
                         name,
                         f,
                     )
+                for rule in failed_rules.get((node.vsn, task, name), []):
+                    healthy = False
+                    logging.info(
+                        "failed %s rule %s %s %s %s %s %s",
+                        rule,
+                        start,
+                        end,
+                        node.vsn,
+                        device,
+                        task,
+                        name,
+                    )
 
             return healthy
 
         node_healthy = True
 
-        for device in node.devices:
+        for device in fleet.get_node_devices(i):
             # the idea here is to translate the publishing frequency into a kind of SLA. here
             # we're saying that after breaking the series up into window the size of the publishing
             # frequency, we should see 1 sample per window in 90% of the windows.
-            healthy = check_publishing_sla_for_device(device, window, 0.90)
+            healthy = check_publishing_sla_for_device(device, 0.90)
             # accumulate full node health
             node_healthy = node_healthy and healthy
             add_device_health_check_record(node.vsn, device, healthy)
 
         add_node_health_check_record(node.vsn, node_healthy)
 
-    logging.info("done")
+    vsns = set(fleet.vsns)
+
+    for r in rule_violations.itertuples(index=False):
+        if r.vsn not in vsns:
+            continue
+        records.append(
+            {
+                "measurement": "health_rule_failure_total",
+                "tags": {
+                    "vsn": r.vsn,
+                    "task": r.task,
+                    "name": r.name,
+                    "rule": r.rule,
+                },
+                "fields": {
+                    "value": int(r.value),
+                },
+                "timestamp": timestamp,
+            }
+        )
 
     return records
 
 
-exclude_sanity_tests = [
-    "sys.sanity_status.wes_telegraf_cadvisor",
-]
+def get_freq_for_series():
+    """
+    Returns a map of (task, name) -> minimum expected publishing frequency from device_output_table.
+    """
+    return {
+        (task, name): pd.Timedelta(freq)
+        for outputs in device_output_table.values()
+        for task, name, freq in outputs
+    }
 
 
-def get_sanity_records_for_window(nodes, start, end):
-    df = sage_data_client.query(start=start, end=end, filter={"name": "sys.sanity.*"})
+def parse_stream_item(item):
+    """
+    Returns the (timestamp, vsn, task, name, value) of a record from the data stream.
+    """
+    meta = item["meta"]
+    vsn = meta.get("vsn")
+    task = meta.get("task")
+    name = item["name"]
 
-    # drop excluded sanity tests we know are failing because of system changes
-    df = df[~df.name.isin(exclude_sanity_tests)]
+    # NOTE derive task name from sys metrics using host
+    if name.startswith("sys."):
+        task = series_classifier.get_device(meta.get("host"), None, name) or task
 
-    df["timestamp"] = df["timestamp"].dt.round("1h")
-    df["total"] = 1
-    df["pass"] = (df["value"] == 0) | (df["meta.severity"] == "warning")
-    df["fail"] = ~df["pass"]
+    return pd.Timestamp(item["timestamp"]), vsn, task, name, item.get("value")
 
-    table = df.groupby(["meta.node", "meta.vsn"])[["total", "pass", "fail"]].sum()
 
-    records = []
+class LiveHealthChecker:
+    """
+    LiveHealthChecker incrementally tracks which publishing frequency sized bins have samples for
+    each (vsn, task, name) series as records arrive from the data stream. The stats needed by
+    value_rule_table are kept the same way. This lets us score each window as soon as it closes
+    without querying its data again.
+    """
+
+    def __init__(self, nodes, window, grace):
+        self.nodes = nodes
+        self.fleet = Fleet(nodes)
+        self.window = window
+        self.grace = grace
+        self.freq_for_series = get_freq_for_series()
+        self.rule_for_series = get_rule_for_series()
+        # window start -> (series -> occupied bin bitset, vsns with any data, series -> rule stats)
+        self.windows = {}
+        self.latest = None
+        self.emitted_until = None
+
+    def add(self, timestamp, vsn, task, name, value=None, instance=""):
+        """
+        Adds a sample and returns the starts of any windows which closed. instance is the series
+        instance from get_series_instance, which value rules are checked per.
+        """
+        start = timestamp.floor(self.window)
+
+        if self.emitted_until is not None and start < self.emitted_until:
+            return []
+
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+
+        bins, vsns_with_data, rule_stats = self.windows.setdefault(start, ({}, set(), {}))
+        vsns_with_data.add(vsn)
+
+        key = (vsn, task, name)
+
+        freq = self.freq_for_series.get((task, name))
+        if freq is not None:
+            bins[key] = bins.get(key, 0) | (1 << int((timestamp - start) // freq))
+
+        rule = self.rule_for_series.get((task, name))
+        if rule is not None:
+            add_rule_stats(rule_stats, (*key, instance), rule, timestamp, value)
+
+        return [
+            start
+            for start in sorted(self.windows)
+            if start + self.window + self.grace <= self.latest
+        ]
+
+    def pending(self):
+        return sorted(self.windows)
+
+    def pop_health_records(self, start, scheduled_tasks_by_node):
+        bins, vsns_with_data, rule_stats = self.windows.pop(start)
+        self.emitted_until = start + self.window
+
+        def get_publishing_frequency(vsn, task, name, freq):
+            expected_samples = self.window / pd.Timedelta(freq)
+            return bins.get((vsn, task, name), 0).bit_count() / expected_samples
+
+        return get_health_records_from_publishing_frequency(
+            self.nodes,
+            start,
+            start + self.window,
+            vsns_with_data=vsns_with_data,
+            get_publishing_frequency=get_publishing_frequency,
+            scheduled_tasks_by_node=scheduled_tasks_by_node,
+            fleet=self.fleet,
+            rule_violations=get_rule_violations(
+                pd.DataFrame(
+                    [(*key, *stats) for key, stats in rule_stats.items()],
+                    columns=[
+                        "vsn",
+                        "task",
+                        "name",
+                        "instance",
+                        "count",
+                        "out_of_range",
+                        "value_min",
+                        "value_max",
+                        "first",
+                        "last",
+                    ],
+                )
+            ),
+        )
 
-    for node in nodes:
-        try:
-            r = table.loc[(node.id, node.vsn)]
-            totals = {
-                "sanity_test_total": r["total"],
-                "sanity_test_pass_total": r["pass"],
-                "sanity_test_fail_total": r["fail"],
-            }
-        except KeyError:
-            totals = {
-                "sanity_test_total": 0,
-                "sanity_test_pass_total": 0,
-                "sanity_test_fail_total": 0,
-            }
 
-        for name, value in totals.items():
+def add_rule_stats(rule_stats, key, rule, timestamp, value):
+    """
+    Incrementally updates the same stats for a series as get_rule_stats.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        value = float("nan")
+
+    stats = rule_stats.get(key)
+    if stats is None:
+        stats = rule_stats[key] = [0, 0, float("nan"), float("nan"), timestamp, timestamp]
+
+    low, high = rule
+    stats[0] += 1
+    stats[1] += value < low or value > high
+
+    # NOTE nan values are skipped like pandas min / max. as comparisons with nan are always
+    # false, the first value replaces the initial nan.
+    if value == value:
+        if not stats[2] <= value:
+            stats[2] = value
+        if not stats[3] >= value:
+            stats[3] = value
+
+    if timestamp < stats[4]:
+        stats[4] = timestamp
+    if timestamp > stats[5]:
+        stats[5] = timestamp
+
+
+class RollingSLATracker:
+    """
+    RollingSLATracker maintains the number of occupied publishing frequency bins for each
+    (vsn, task, name) series over a sliding lookback. Advancing the lookback only adds bins which
+    have entered it and drops bins which have expired, rather than recounting the series.
+    """
+
+    def __init__(self, nodes, lookback):
+        self.nodes = nodes
+        self.lookback = lookback
+        self.fleet = Fleet(nodes)
+        self.freq_for_series = get_freq_for_series()
+        # series -> set of bins seen which haven't expired
+        self.seen = {}
+        # series -> number of bins inside the lookback
+        self.counts = {}
+        # heaps of (bin start, seq, series, bin) which are waiting to enter / leave the lookback.
+        # seq breaks ties between bins with the same start, so series are never compared, as
+        # they may have a missing vsn or task.
+        self.entering = []
+        self.leaving = []
+        self.seq = itertools.count()
+        self.last_seen_by_vsn = {}
+        self.now = None
+
+    def add(self, timestamp, vsn, task, name):
+        if vsn not in self.last_seen_by_vsn or timestamp > self.last_seen_by_vsn[vsn]:
+            self.last_seen_by_vsn[vsn] = timestamp
+
+        freq = self.freq_for_series.get((task, name))
+        if freq is None:
+            return
+
+        key = (vsn, task, name)
+        index = timestamp.value // freq.value
+        bin_start = index * freq.value
+
+        # drop samples for bins which have already expired
+        if self.now is not None and bin_start < (self.now - self.lookback).value:
+            return
+
+        seen = self.seen.setdefault(key, set())
+        if index in seen:
+            return
+        seen.add(index)
+
+        if self.now is not None and bin_start < self.now.value:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            heapq.heappush(self.leaving, (bin_start, next(self.seq), key, index))
+        else:
+            heapq.heappush(self.entering, (bin_start, next(self.seq), key, index))
+
+    def advance(self, now):
+        """
+        Slides the lookback to end at now.
+        """
+        self.now = now
+
+        while len(self.entering) > 0 and self.entering[0][0] < now.value:
+            item = heapq.heappop(self.entering)
+            _, _, key, _ = item
+            self.counts[key] = self.counts.get(key, 0) + 1
+            heapq.heappush(self.leaving, item)
+
+        cutoff = (now - self.lookback).value
+
+        while len(self.leaving) > 0 and self.leaving[0][0] < cutoff:
+            _, _, key, index = heapq.heappop(self.leaving)
+            self.counts[key] -= 1
+            self.seen[key].discard(index)
+
+    def get_sla_records(self, scheduled_tasks_by_node):
+        """
+        Returns the fraction of expected bins seen in the lookback for the least available series
+        of each device and node.
+        """
+        timestamp = self.now
+        cutoff = self.now - self.lookback
+
+        records = []
+
+        for i, node in enumerate(self.nodes):
+            has_data = self.last_seen_by_vsn.get(node.vsn, cutoff) >= cutoff
+            scheduled_tasks = scheduled_tasks_by_node.get(node.vsn, [])
+            node_value = 1.0
+
+            for device in self.fleet.get_node_devices(i):
+                value = 1.0
+
+                for task, name, freq in device_output_table[device]:
+                    # skip image and audio sampler tasks which are not scheduled
+                    if "sampler" in task and task not in scheduled_tasks:
+                        continue
+                    expected_samples = max(self.lookback / pd.Timedelta(freq), 1)
+                    count = self.counts.get((node.vsn, task, name), 0) if has_data else 0
+                    value = min(value, count / expected_samples)
+
+                node_value = min(node_value, value)
+                records.append(
+                    {
+                        "measurement": "device_health_sla",
+                        "tags": {
+                            "vsn": node.vsn,
+                            "device": device,
+                        },
+                        "fields": {
+                            "value": float(value),
+                        },
+                        "timestamp": timestamp,
+                    }
+                )
+
             records.append(
                 {
-                    "measurement": name,
+                    "measurement": "node_health_sla",
                     "tags": {
                         "vsn": node.vsn,
-                        "node": node.id,
                     },
                     "fields": {
-                        "value": int(value),
+                        "value": float(node_value if has_data else 0.0),
                     },
-                    "timestamp": start,
+                    "timestamp": timestamp,
                 }
             )
 
+        return records
+
+
+def get_live_health_records(
+    nodes,
+    window,
+    grace,
+    items,
+    rolling_step=None,
+    rolling_lookback=pd.Timedelta("1h"),
+    flush=False,
+    scheduled_tasks=None,
+):
+    """
+    Yields the health records for each window as it closes in items. If rolling_step is set,
+    rolling SLA records over rolling_lookback are also yielded at each step. Windows still open
+    when items is exhausted are only emitted if flush is set, as when replaying a complete file.
+    Otherwise they're missing data and are dropped rather than scored as unhealthy. Scheduled
+    tasks are taken from the scheduled_tasks ScheduledTasksCache, which defaults to one refreshed
+    every 10 minutes.
+    """
+    checker = LiveHealthChecker(nodes, window, grace)
+    tracker = None
+    next_step = None
+
+    if scheduled_tasks is None:
+        scheduled_tasks = ScheduledTasksCache()
+
+    if rolling_step is not None:
+        tracker = RollingSLATracker(nodes, rolling_lookback)
+
+    def pop_health_records(start):
+        logging.info("window closed %s %s", start, start + window)
+        with profiler.stage("window", window=start):
+            return checker.pop_health_records(start, scheduled_tasks.get())
+
+    def pop_rolling_sla_records(until):
+        nonlocal next_step
+        while next_step <= until:
+            tracker.advance(next_step)
+            logging.info("rolling sla step %s", next_step)
+            yield tracker.get_sla_records(scheduled_tasks.get())
+            next_step += rolling_step
+
+    for item in items:
+        timestamp, vsn, task, name, value = parse_stream_item(item)
+        instance = get_series_instance(item["meta"])
+
+        for start in checker.add(timestamp, vsn, task, name, value, instance):
+            yield pop_health_records(start)
+
+        if tracker is not None:
+            tracker.add(timestamp, vsn, task, name)
+            # only emit steps whose lookback is fully covered by the stream
+            if next_step is None:
+                next_step = (timestamp + rolling_lookback).ceil(rolling_step)
+            yield from pop_rolling_sla_records(checker.latest - grace)
+
+    if not flush:
+        for start in checker.pending():
+            logging.info("dropping incomplete window %s %s", start, start + window)
+        return
+
+    for start in checker.pending():
+        yield pop_health_records(start)
+
+    if tracker is not None and next_step is not None:
+        yield from pop_rolling_sla_records(checker.latest)
+
+
+exclude_sanity_tests = [
+    "sys.sanity_status.wes_telegraf_cadvisor",
+]
+
+
+def get_sanity_records_for_window(nodes, start, end, pushdown=False):
+    filter = {"name": "sys.sanity.*"}
+
+    # restrict query to only the given nodes. this is useful when only rolling up a few nodes.
+    if pushdown:
+        filter["vsn"] = get_vsn_filter(nodes)
+
+    df = get_data_source().query(start, end, filter=filter)
+
+    with profiler.stage("sanity_check") as stage:
+        # drop excluded sanity tests we know are failing because of system changes
+        df = df[~df.name.isin(exclude_sanity_tests)].copy()
+
+        df["timestamp"] = df["timestamp"].dt.round("1h")
+        df["total"] = 1
+        df["pass"] = (df["value"] == 0) | (df["meta.severity"] == "warning")
+        df["fail"] = ~df["pass"]
+
+        # group raw results by test once. the node totals are then derived from the much smaller
+        # per test table.
+        tests = (
+            df.groupby(
+                ["meta.node", "meta.vsn", "name", "meta.severity"], dropna=False
+            )[["total", "pass", "fail"]]
+            .sum()
+            .reset_index()
+        )
+
+        # reindex against the node table so nodes without any results get zero totals
+        nodes_index = pd.MultiIndex.from_frame(get_node_frame(nodes))
+        table = (
+            tests.groupby(["meta.node", "meta.vsn"])[["total", "pass", "fail"]]
+            .sum()
+            .reindex(nodes_index, fill_value=0)
+            .reset_index()
+        )
+
+        # inner join drops tests from any id & vsn combination not found in the node table
+        tests = get_node_frame(nodes).merge(tests, on=["meta.node", "meta.vsn"])
+
+        records = []
+
+        for measurement, field in [
+            ("sanity_test_total", "total"),
+            ("sanity_test_pass_total", "pass"),
+            ("sanity_test_fail_total", "fail"),
+        ]:
+            records += get_records_from_frame(
+                table,
+                measurement=measurement,
+                tags={"vsn": "meta.vsn", "node": "meta.node"},
+                field=field,
+                timestamp=start,
+            )
+
+        for measurement, field in [
+            ("sanity_test_name_pass_total", "pass"),
+            ("sanity_test_name_fail_total", "fail"),
+        ]:
+            records += get_records_from_frame(
+                tests,
+                measurement=measurement,
+                tags={
+                    "vsn": "meta.vsn",
+                    "node": "meta.node",
+                    "name": "name",
+                    "severity": "meta.severity",
+                },
+                field=field,
+                timestamp=start,
+            )
+        stage["rows"] = len(df)
+
     return records
 
 
@@ -426,6 +997,62 @@ def main():
         action="store_true",
         help="reverse the rollup starting so it works from most recent to least recent",
     )
+    parser.add_argument(
+        "--write-index",
+        default=None,
+        type=Path,
+        help="path to local index of last written values. unchanged points are not rewritten.",
+    )
+    parser.add_argument(
+        "--spool",
+        default=None,
+        type=Path,
+        help="path to local spool of records waiting to be written. failed writes are replayed on later runs.",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=parse_shard,
+        help="only rollup nodes in shard i/N, where 0 <= i < N",
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="continuously check health from the live data stream, emitting each window as it closes",
+    )
+    parser.add_argument(
+        "--replay",
+        default=None,
+        type=Path,
+        help="check health from a newline delimited json file of records instead of the live data stream",
+    )
+    parser.add_argument(
+        "--live-grace",
+        default="5m",
+        type=pd.Timedelta,
+        help="time to wait for late samples after a window closes in live mode",
+    )
+    parser.add_argument(
+        "--rolling-step",
+        default=None,
+        type=pd.Timedelta,
+        help="also emit rolling sla fractions at this step in live mode",
+    )
+    parser.add_argument(
+        "--rolling-lookback",
+        default="1h",
+        type=pd.Timedelta,
+        help="lookback duration for rolling sla fractions",
+    )
+    parser.add_argument(
+        "--scheduled-tasks-refresh",
+        default="10min",
+        type=pd.Timedelta,
+        help="how often to refetch the scheduled tasks in live mode",
+    )
+    add_node_selection_arguments(parser)
+    add_data_source_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -434,51 +1061,161 @@ def main():
         datefmt="%Y/%m/%d %H:%M:%S",
     )
 
+    enable_profiling(args)
+    set_data_source_from_args(args)
+
     if not args.dry_run:
         INFLUXDB_URL = getenv("INFLUXDB_URL", "https://influxdb.sagecontinuum.org")
         INFLUXDB_ORG = getenv("INFLUXDB_ORG", "waggle")
         INFLUXDB_TOKEN = os.environ["INFLUXDB_TOKEN"]
         INFLUXDB_BUCKET_HEALTH = getenv("INFLUXDB_BUCKET_HEALTH", "health-check-test")
         INFLUXDB_BUCKET_SANITY = getenv("INFLUXDB_BUCKET_SANITY", "downsampled-test")
+        INFLUXDB_BUCKET_REPORTER = getenv("INFLUXDB_BUCKET_REPORTER", INFLUXDB_BUCKET_HEALTH)
+
+    nodes = select_nodes(
+        load_node_table(),
+        vsns=args.vsn,
+        node_types=args.node_type,
+        devices=args.device,
+    )
+
+    if args.shard is not None:
+        nodes = get_nodes_in_shard(nodes, args.shard)
+        logging.info("rolling up %d nodes in shard %d/%d", len(nodes), *args.shard)
+
+    if len(nodes) == 0:
+        logging.info("no nodes selected. nothing to do.")
+        return
+
+    index = open_write_index(args.write_index, dry_run=args.dry_run)
+
+    spool = None
+    if args.spool is not None and not args.dry_run:
+        spool = WriteSpool(args.spool)
+        replay_spool(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            spool=spool,
+            index=index,
+        )
 
-    nodes = load_node_table()
+    # only filter queries by node when rolling up a subset of the fleet
+    pushdown = args.shard is not None or has_node_selection(args)
     start, end = get_rollup_range(args.start, args.end)
     window = args.window
 
     logging.info("current time is %s", now)
 
-    time_windows = get_time_windows(start, end, window)
+    def write_reporter_run_record(timestamp):
+        if args.dry_run:
+            return
+        logging.info("writing reporter run record...")
+        write_results_to_influxdb(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            bucket=INFLUXDB_BUCKET_REPORTER,
+            records=[
+                get_reporter_run_record(
+                    "rollup_health_and_sanity_metrics", timestamp, shard=args.shard
+                )
+            ],
+        )
+
+    if args.live or args.replay is not None:
+        if args.replay is not None:
+            items = replay_records(args.replay)
+        else:
+            items = stream_records(
+                filter={"vsn": get_vsn_filter(nodes)} if pushdown else None
+            )
+
+        # live mode only emits health records, so we skip the windowed rollup below
+        time_windows = []
+
+        # a live run never ends, so its reporter_run record is written once per window instead of
+        # at the end of the run
+        reported = time.monotonic()
+
+        for health_records in get_live_health_records(
+            nodes,
+            window,
+            args.live_grace,
+            items,
+            rolling_step=args.rolling_step,
+            rolling_lookback=args.rolling_lookback,
+            flush=args.replay is not None,
+            scheduled_tasks=ScheduledTasksCache(args.scheduled_tasks_refresh),
+        ):
+            if not args.dry_run:
+                logging.info("writing %d health records...", len(health_records))
+                write_results_to_influxdb(
+                    url=INFLUXDB_URL,
+                    org=INFLUXDB_ORG,
+                    token=INFLUXDB_TOKEN,
+                    bucket=INFLUXDB_BUCKET_HEALTH,
+                    records=health_records,
+                    index=index,
+                    spool=spool,
+                )
+
+            if args.live and time.monotonic() - reported >= window.total_seconds():
+                write_reporter_run_record(pd.to_datetime("now", utc=True))
+                reported = time.monotonic()
+    else:
+        time_windows = get_time_windows(start, end, window)
 
     if args.reverse:
         time_windows = reversed(time_windows)
 
+    # the fleet is built once for all windows, rather than once per window
+    fleet = Fleet(nodes)
+
     for start, end in time_windows:
-        logging.info("getting health records in %s %s", start, end)
-        health_records = get_health_records_for_window(nodes, start, end, window)
-
-        if not args.dry_run:
-            logging.info("writing %d health records...", len(health_records))
-            write_results_to_influxdb(
-                url=INFLUXDB_URL,
-                org=INFLUXDB_ORG,
-                token=INFLUXDB_TOKEN,
-                bucket=INFLUXDB_BUCKET_HEALTH,
-                records=health_records,
+        with profiler.stage("window", window=start):
+            logging.info("getting health records in %s %s", start, end)
+            health_records = get_health_records_for_window(
+                nodes, start, end, window, pushdown=pushdown, fleet=fleet
             )
 
-        logging.info("getting sanity records in %s %s", start, end)
-        sanity_records = get_sanity_records_for_window(nodes, start, end)
-
-        if not args.dry_run:
-            logging.info("writing %d sanity records...", len(sanity_records))
-            write_results_to_influxdb(
-                url=INFLUXDB_URL,
-                org=INFLUXDB_ORG,
-                token=INFLUXDB_TOKEN,
-                bucket=INFLUXDB_BUCKET_SANITY,
-                records=sanity_records,
+            if not args.dry_run:
+                logging.info("writing %d health records...", len(health_records))
+                write_results_to_influxdb(
+                    url=INFLUXDB_URL,
+                    org=INFLUXDB_ORG,
+                    token=INFLUXDB_TOKEN,
+                    bucket=INFLUXDB_BUCKET_HEALTH,
+                    records=health_records,
+                    index=index,
+                    spool=spool,
+                )
+
+            logging.info("getting sanity records in %s %s", start, end)
+            sanity_records = get_sanity_records_for_window(
+                nodes, start, end, pushdown=pushdown
             )
 
+            if not args.dry_run:
+                logging.info("writing %d sanity records...", len(sanity_records))
+                write_results_to_influxdb(
+                    url=INFLUXDB_URL,
+                    org=INFLUXDB_ORG,
+                    token=INFLUXDB_TOKEN,
+                    bucket=INFLUXDB_BUCKET_SANITY,
+                    records=sanity_records,
+                    index=index,
+                    spool=spool,
+                )
+
+    if index is not None:
+        logging.info("suppressed %d unchanged points", index.suppressed)
+        index.close()
+
+    write_reporter_run_record(now)
+
+    write_profile_textfile(args, "rollup_health_and_sanity_metrics")
+
     logging.info("done!")
 
 
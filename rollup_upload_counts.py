@@ -1,73 +1,88 @@
 import argparse
 import os
+from pathlib import Path
 from os import getenv
 import pandas as pd
 import logging
-import sage_data_client
 
 from utils import (
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+    get_reporter_run_record,
+    get_data_source,
+    add_data_source_arguments,
+    set_data_source_from_args,
     load_node_table,
     parse_time,
     get_rollup_range,
     get_time_windows,
     write_results_to_influxdb,
+    open_write_index,
+    WriteSpool,
+    replay_spool,
+    add_node_selection_arguments,
+    has_node_selection,
+    select_nodes,
+    parse_shard,
+    get_nodes_in_shard,
+    get_vsn_filter,
+    reconcile_windows,
+    get_node_frame,
+    get_records_from_frame,
 )
 
 
-def get_media_counts_for_window(nodes, start, end, convert_timestamps=False):
-    df = sage_data_client.query(
-        start=start,
-        end=end,
-        filter={"name": "upload"},
+def get_media_counts_for_window(
+    nodes, start, end, convert_timestamps=False, pushdown=False
+):
+    filter = {"name": "upload"}
+
+    # restrict query to only the given nodes. this is useful when only rolling up a few nodes.
+    if pushdown:
+        filter["vsn"] = get_vsn_filter(nodes)
+
+    df = get_data_source().query(
+        start,
+        end,
+        filter=filter,
         experimental_func="count",
     )
 
-    df["timestamp"] = df["timestamp"].dt.round("1h")
-    # experimental_func count returns the total counts as the value field
-    df["total"] = df["value"]
+    with profiler.stage("upload_counts") as stage:
+        df["timestamp"] = df["timestamp"].dt.round("1h")
+        # experimental_func count returns the total counts as the value field
+        df["total"] = df["value"]
 
-    cols = ["meta.node", "meta.vsn", "meta.plugin", "meta.task"]
+        # 'meta.camera' doesn't exist for older uploads; only the newer image-sampler recoreds
+        if "meta.camera" not in df.columns:
+            df["meta.camera"] = None
 
-    # 'meta.camera' doesn't exist for older uploads; only the newer image-sampler recoreds
-    if "meta.camera" in df.columns:
-        cols = cols + ["meta.camera"]
+        cols = ["meta.node", "meta.vsn", "meta.plugin", "meta.task", "meta.camera"]
 
-    table = df.groupby(cols)[["total"]].sum()
+        # only camera is optional. keep null cameras as their own group so older uploads are
+        # still counted.
+        df = df.dropna(subset=cols[:-1])
+        table = df.groupby(cols, dropna=False)["total"].sum().reset_index()
 
-    records = []
-    for node in nodes:
-        try:
-            r = table.loc[(node.id, node.vsn)]
-            plugin_totals = r["total"]
-        except KeyError:
-            continue  # ignore if id & vsn combination not found
-
-        for plugin_key, total in plugin_totals.items():
-            if len(plugin_key) == 3:
-                plugin_name, task, camera = plugin_key
-            else:
-                plugin_name, task = plugin_key
-                camera = None
-
-            record = {
-                "measurement": "total",
-                "tags": {
-                    "vsn": node.vsn,
-                    "node": node.id,
-                    "plugin": plugin_name,
-                    "task": task,
-                    **({"camera": camera} if camera is not None else {})
-                },
-                "fields": {
-                    "value": int(total),  # Ensure value is integer
-                },
-                "timestamp": (
-                    start.isoformat() + "Z" if convert_timestamps else start
-                ),
-            }
-
-            records.append(record)
+        # inner join drops any id & vsn combination not found in the node table
+        table = get_node_frame(nodes).merge(table, on=["meta.node", "meta.vsn"])
 
+        records = get_records_from_frame(
+            table,
+            measurement="total",
+            tags={
+                "vsn": "meta.vsn",
+                "node": "meta.node",
+                "plugin": "meta.plugin",
+                "task": "meta.task",
+                "camera": "meta.camera",
+            },
+            field="total",
+            timestamp=start.isoformat() + "Z" if convert_timestamps else start,
+        )
+        stage["rows"] = len(df)
 
     return records
 
@@ -99,21 +114,84 @@ def main():
         action="store_true",
         help="reverse the rollup starting so it works from most recent to least recent",
     )
+    parser.add_argument(
+        "--write-index",
+        default=None,
+        type=Path,
+        help="path to local index of last written values. unchanged points are not rewritten.",
+    )
+    parser.add_argument(
+        "--spool",
+        default=None,
+        type=Path,
+        help="path to local spool of records waiting to be written. failed writes are replayed on later runs.",
+    )
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="only re-roll nodes whose totals changed since last written. requires --write-index.",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=parse_shard,
+        help="only rollup nodes in shard i/N, where 0 <= i < N",
+    )
+    add_node_selection_arguments(parser)
+    add_data_source_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
 
+    if args.reconcile and args.write_index is None:
+        parser.error("--reconcile requires --write-index")
+
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s %(message)s",
         datefmt="%Y/%m/%d %H:%M:%S",
     )
 
+    enable_profiling(args)
+    set_data_source_from_args(args)
+
+    INFLUXDB_BUCKET = getenv("INFLUXDB_BUCKET", "upload-stats")
+
     if not args.dry_run:
         INFLUXDB_URL = getenv("INFLUXDB_URL", "https://influxdb.sagecontinuum.org")
         INFLUXDB_ORG = getenv("INFLUXDB_ORG", "waggle")
         INFLUXDB_TOKEN = os.environ["INFLUXDB_TOKEN"]
-        INFLUXDB_BUCKET = getenv("INFLUXDB_BUCKET", "upload-stats")
+        INFLUXDB_BUCKET_REPORTER = getenv("INFLUXDB_BUCKET_REPORTER", INFLUXDB_BUCKET)
 
-    nodes = load_node_table()
+    nodes = select_nodes(
+        load_node_table(),
+        vsns=args.vsn,
+        node_types=args.node_type,
+        devices=args.device,
+    )
+
+    if args.shard is not None:
+        nodes = get_nodes_in_shard(nodes, args.shard)
+        logging.info("rolling up %d nodes in shard %d/%d", len(nodes), *args.shard)
+
+    if len(nodes) == 0:
+        logging.info("no nodes selected. nothing to do.")
+        return
+
+    index = open_write_index(args.write_index, dry_run=args.dry_run)
+
+    spool = None
+    if args.spool is not None and not args.dry_run:
+        spool = WriteSpool(args.spool)
+        replay_spool(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            spool=spool,
+            index=index,
+        )
+
+    # only filter queries by node when rolling up a subset of the fleet
+    pushdown = args.shard is not None or has_node_selection(args)
     start, end = get_rollup_range(args.start, args.end)
     window = args.window
 
@@ -121,22 +199,61 @@ def main():
 
     time_windows = get_time_windows(start, end, window)
 
+    if args.reconcile:
+        # only the windows and nodes whose totals changed since they were last written received
+        # late data. their probes already hold their records, so they aren't queried again.
+        with profiler.stage("reconcile"):
+            logging.info("probing upload counts for %s %s", start, end)
+            reconciled = reconcile_windows(
+                index,
+                INFLUXDB_BUCKET,
+                nodes,
+                time_windows,
+                get_media_counts_for_window,
+                pushdown=pushdown,
+            )
+        time_windows = [w for w in time_windows if w in reconciled]
+
     if args.reverse:
         time_windows = reversed(time_windows)
 
     for start, end in time_windows:
-        logging.info("getting upload counts for %s %s", start, end)
-        records = get_media_counts_for_window(nodes, start, end)
-
-        if not args.dry_run:
-            logging.info("writing %d upload count records...", len(records))
-            write_results_to_influxdb(
-                url=INFLUXDB_URL,
-                org=INFLUXDB_ORG,
-                token=INFLUXDB_TOKEN,
-                bucket=INFLUXDB_BUCKET,
-                records=records,
-            )
+        with profiler.stage("window", window=start):
+            if args.reconcile:
+                records = reconciled[(start, end)]
+            else:
+                logging.info("getting upload counts for %s %s", start, end)
+                records = get_media_counts_for_window(
+                    nodes, start, end, pushdown=pushdown
+                )
+
+            if not args.dry_run:
+                logging.info("writing %d upload count records...", len(records))
+                write_results_to_influxdb(
+                    url=INFLUXDB_URL,
+                    org=INFLUXDB_ORG,
+                    token=INFLUXDB_TOKEN,
+                    bucket=INFLUXDB_BUCKET,
+                    records=records,
+                    index=index,
+                    spool=spool,
+                )
+
+    if index is not None:
+        logging.info("suppressed %d unchanged points", index.suppressed)
+        index.close()
+
+    if not args.dry_run:
+        logging.info("writing reporter run record...")
+        write_results_to_influxdb(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            bucket=INFLUXDB_BUCKET_REPORTER,
+            records=[get_reporter_run_record("rollup_upload_counts", now, shard=args.shard)],
+        )
+
+    write_profile_textfile(args, "rollup_upload_counts")
 
     logging.info("done!")
 
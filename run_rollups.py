@@ -0,0 +1,276 @@
+import argparse
+import os
+from pathlib import Path
+from os import getenv
+import pandas as pd
+import logging
+
+from utils import (
+    profiler,
+    add_profile_arguments,
+    enable_profiling,
+    write_profile_textfile,
+    get_reporter_run_record,
+    get_data_source,
+    set_data_source,
+    add_data_source_arguments,
+    set_data_source_from_args,
+    WindowDataSource,
+    Fleet,
+    load_node_table,
+    parse_time,
+    get_rollup_range,
+    get_time_windows,
+    write_results_to_influxdb,
+    ResultWriter,
+    open_write_index,
+    WriteSpool,
+    replay_spool,
+    add_node_selection_arguments,
+    has_node_selection,
+    select_nodes,
+    parse_shard,
+    get_nodes_in_shard,
+    get_vsn_filter,
+)
+from rollup_health_and_sanity_metrics import (
+    get_health_records_for_window,
+    get_sanity_records_for_window,
+    get_scheduled_tasks_by_node,
+)
+from rollup_plugin_counts import get_plugin_counts_for_window
+from rollup_upload_counts import get_media_counts_for_window
+
+
+# rollup_buckets maps each rollup to the env var and default of the bucket it writes to. these are
+# the buckets rollup_daily_and_weekly.py reads from.
+rollup_buckets = {
+    "health": ("INFLUXDB_BUCKET_HEALTH", "health-check-test"),
+    "sanity": ("INFLUXDB_BUCKET_SANITY", "downsampled-test"),
+    "plugin": ("INFLUXDB_BUCKET_PLUGIN", "plugin-stats"),
+    "upload": ("INFLUXDB_BUCKET_UPLOAD", "upload-stats"),
+}
+
+
+def get_rollup_records_for_window(
+    rollups, nodes, start, end, window, pushdown=False, scheduled_tasks_by_node=None, fleet=None
+):
+    """
+    Returns a map of rollup -> records in [start, end) for each of rollups. When the health rollup
+    is included, its query of every record in the window is made once and the other rollups are
+    answered from it, as their queries select a subset of the same records. Otherwise, each
+    rollup makes its own query, since the count queries are much smaller than the raw data.
+    """
+    source = get_data_source()
+
+    if "health" in rollups:
+        filter = {"vsn": get_vsn_filter(nodes)} if pushdown else None
+        set_data_source(WindowDataSource(source, start, end, filter=filter))
+
+    records = {}
+
+    try:
+        for rollup in rollups:
+            logging.info("getting %s records in %s %s", rollup, start, end)
+            if rollup == "health":
+                records[rollup] = get_health_records_for_window(
+                    nodes,
+                    start,
+                    end,
+                    window,
+                    pushdown=pushdown,
+                    scheduled_tasks_by_node=scheduled_tasks_by_node,
+                    fleet=fleet,
+                )
+            elif rollup == "sanity":
+                records[rollup] = get_sanity_records_for_window(
+                    nodes, start, end, pushdown=pushdown
+                )
+            elif rollup == "plugin":
+                records[rollup] = get_plugin_counts_for_window(
+                    nodes, start, end, pushdown=pushdown
+                )
+            elif rollup == "upload":
+                records[rollup] = get_media_counts_for_window(
+                    nodes, start, end, pushdown=pushdown
+                )
+    finally:
+        set_data_source(source)
+
+    return records
+
+
+def main():
+    now = pd.to_datetime("now", utc=True)
+
+    def time_arg(s):
+        return parse_time(s, now=now)
+
+    parser = argparse.ArgumentParser(
+        description="run several hourly rollups in one process, sharing the node table, queries and writer"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="perform dry run to view logs. will skip writing results to influxdb.",
+    )
+    parser.add_argument(
+        "--start", default="-2h", type=time_arg, help="relative start time"
+    )
+    parser.add_argument("--end", default="-1h", type=time_arg, help="relative end time")
+    parser.add_argument(
+        "--window",
+        default="1h",
+        type=pd.Timedelta,
+        help="window duration to aggreagate over",
+    )
+    parser.add_argument(
+        "--rollup",
+        action="append",
+        choices=list(rollup_buckets),
+        help="rollup to run. may be repeated. defaults to all rollups.",
+    )
+    parser.add_argument(
+        "--reverse",
+        action="store_true",
+        help="reverse the rollup starting so it works from most recent to least recent",
+    )
+    parser.add_argument(
+        "--write-index",
+        default=None,
+        type=Path,
+        help="path to local index of last written values. unchanged points are not rewritten.",
+    )
+    parser.add_argument(
+        "--spool",
+        default=None,
+        type=Path,
+        help="path to local spool of records waiting to be written. failed writes are replayed on later runs.",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=parse_shard,
+        help="only rollup nodes in shard i/N, where 0 <= i < N",
+    )
+    add_node_selection_arguments(parser)
+    add_data_source_arguments(parser)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(message)s",
+        datefmt="%Y/%m/%d %H:%M:%S",
+    )
+
+    enable_profiling(args)
+    set_data_source_from_args(args)
+
+    rollups = [rollup for rollup in rollup_buckets if args.rollup is None or rollup in args.rollup]
+    buckets = {rollup: getenv(*rollup_buckets[rollup]) for rollup in rollups}
+
+    if not args.dry_run:
+        INFLUXDB_URL = getenv("INFLUXDB_URL", "https://influxdb.sagecontinuum.org")
+        INFLUXDB_ORG = getenv("INFLUXDB_ORG", "waggle")
+        INFLUXDB_TOKEN = os.environ["INFLUXDB_TOKEN"]
+        INFLUXDB_BUCKET_REPORTER = getenv("INFLUXDB_BUCKET_REPORTER", buckets[rollups[0]])
+
+    nodes = select_nodes(
+        load_node_table(),
+        vsns=args.vsn,
+        node_types=args.node_type,
+        devices=args.device,
+    )
+
+    if args.shard is not None:
+        nodes = get_nodes_in_shard(nodes, args.shard)
+        logging.info("rolling up %d nodes in shard %d/%d", len(nodes), *args.shard)
+
+    if len(nodes) == 0:
+        logging.info("no nodes selected. nothing to do.")
+        return
+
+    index = open_write_index(args.write_index, dry_run=args.dry_run)
+
+    writer = None
+    if not args.dry_run:
+        spool = None
+        if args.spool is not None:
+            spool = WriteSpool(args.spool)
+            replay_spool(
+                url=INFLUXDB_URL,
+                org=INFLUXDB_ORG,
+                token=INFLUXDB_TOKEN,
+                spool=spool,
+                index=index,
+            )
+        writer = ResultWriter(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            index=index,
+            spool=spool,
+        )
+
+    # only filter queries by node when rolling up a subset of the fleet
+    pushdown = args.shard is not None or has_node_selection(args)
+    start, end = get_rollup_range(args.start, args.end)
+    window = args.window
+
+    logging.info("current time is %s", now)
+    logging.info("running rollups %s", ", ".join(rollups))
+
+    # the scheduled jobs and fleet are set up once for all windows, rather than once per window
+    scheduled_tasks_by_node = None
+    fleet = None
+    if "health" in rollups:
+        scheduled_tasks_by_node = get_scheduled_tasks_by_node()
+        fleet = Fleet(nodes)
+
+    time_windows = get_time_windows(start, end, window)
+
+    if args.reverse:
+        time_windows = reversed(time_windows)
+
+    for start, end in time_windows:
+        with profiler.stage("window", window=start):
+            records_by_rollup = get_rollup_records_for_window(
+                rollups,
+                nodes,
+                start,
+                end,
+                window,
+                pushdown=pushdown,
+                scheduled_tasks_by_node=scheduled_tasks_by_node,
+                fleet=fleet,
+            )
+
+            if writer is not None:
+                for rollup, records in records_by_rollup.items():
+                    logging.info("writing %d %s records...", len(records), rollup)
+                    writer.write(buckets[rollup], records)
+
+    if index is not None:
+        logging.info("suppressed %d unchanged points", index.suppressed)
+        index.close()
+
+    if writer is not None:
+        logging.info("writing reporter run record...")
+        write_results_to_influxdb(
+            url=INFLUXDB_URL,
+            org=INFLUXDB_ORG,
+            token=INFLUXDB_TOKEN,
+            bucket=INFLUXDB_BUCKET_REPORTER,
+            records=[get_reporter_run_record("run_rollups", now, shard=args.shard)],
+            client=writer.client,
+        )
+        writer.close()
+
+    write_profile_textfile(args, "run_rollups")
+
+    logging.info("done!")
+
+
+if __name__ == "__main__":
+    main()
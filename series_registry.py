@@ -0,0 +1,307 @@
+import re
+import numpy as np
+import pandas as pd
+
+
+# these metrics are coming in inconsistently. we should debug later
+# but to make the health report less red, we'll comment them out.
+# sys.cooling*
+# sys.freq*
+# sys.gps*
+
+sys_from_nxcore = {
+    "sys.boot_time",
+    # "sys.cooling",
+    # "sys.cooling_max",
+    "sys.cpu_seconds",
+    # "sys.freq.ape",
+    # "sys.freq.cpu",
+    # "sys.freq.cpu_max",
+    # "sys.freq.cpu_min",
+    # "sys.freq.cpu_perc",
+    # "sys.freq.emc",
+    # "sys.freq.emc_max",
+    # "sys.freq.emc_min",
+    # "sys.freq.emc_perc",
+    # "sys.freq.gpu",
+    # "sys.freq.gpu_max",
+    # "sys.freq.gpu_min",
+    # "sys.freq.gpu_perc",
+    "sys.fs.avail",
+    "sys.fs.size",
+    "sys.hwmon",
+    "sys.load1",
+    "sys.load15",
+    "sys.load5",
+    "sys.mem.avail",
+    "sys.mem.free",
+    "sys.mem.total",
+    "sys.net.rx_bytes",
+    "sys.net.rx_packets",
+    "sys.net.tx_bytes",
+    "sys.net.tx_packets",
+    "sys.net.up",
+    "sys.power",
+    "sys.rssh_up",
+    "sys.thermal",
+    "sys.time",
+    "sys.uptime",
+    # "sys.gps.lat", # not sent with no GPS fix
+    # "sys.gps.lon", # not sent with no GPS fix
+    # "sys.gps.alt", # not sent with no GPS fix
+    # "sys.gps.epx", # not sent with no GPS fix
+    # "sys.gps.epy", # not sent with no GPS fix
+    # "sys.gps.epv", # not sent with no GPS fix
+    # "sys.gps.satellites", # not sent with no GPS fix
+    # "sys.gps.mode",
+}
+
+sys_from_dellblade = {
+    "sys.boot_time",
+    # "sys.cooling",
+    # "sys.cooling_max",
+    "sys.cpu_seconds",
+    # "sys.freq.ape",
+    # "sys.freq.cpu",
+    # "sys.freq.cpu_max",
+    # "sys.freq.cpu_min",
+    # "sys.freq.cpu_perc",
+    # "sys.freq.emc",
+    # "sys.freq.emc_max",
+    # "sys.freq.emc_min",
+    # "sys.freq.emc_perc",
+    # "sys.freq.gpu",
+    # "sys.freq.gpu_max",
+    # "sys.freq.gpu_min",
+    # "sys.freq.gpu_perc",
+    "sys.fs.avail",
+    "sys.fs.size",
+    # "sys.hwmon",
+    "sys.load1",
+    "sys.load15",
+    "sys.load5",
+    "sys.mem.avail",
+    "sys.mem.free",
+    "sys.mem.total",
+    "sys.net.rx_bytes",
+    "sys.net.rx_packets",
+    "sys.net.tx_bytes",
+    "sys.net.tx_packets",
+    "sys.net.up",
+    # "sys.power",
+    # "sys.rssh_up", # no network watchdog
+    # "sys.thermal",
+    "sys.time",
+    "sys.uptime",
+}
+
+sys_from_nxagent = {
+    "sys.boot_time",
+    # "sys.cooling",
+    # "sys.cooling_max",
+    "sys.cpu_seconds",
+    # "sys.freq.ape",
+    # "sys.freq.cpu",
+    # "sys.freq.cpu_max",
+    # "sys.freq.cpu_min",
+    # "sys.freq.cpu_perc",
+    # "sys.freq.emc",
+    # "sys.freq.emc_max",
+    # "sys.freq.emc_min",
+    # "sys.freq.emc_perc",
+    # "sys.freq.gpu",
+    # "sys.freq.gpu_max",
+    # "sys.freq.gpu_min",
+    # "sys.freq.gpu_perc",
+    "sys.fs.avail",
+    "sys.fs.size",
+    "sys.hwmon",
+    "sys.load1",
+    "sys.load15",
+    "sys.load5",
+    "sys.mem.avail",
+    "sys.mem.free",
+    "sys.mem.total",
+    "sys.net.rx_bytes",
+    "sys.net.rx_packets",
+    "sys.net.tx_bytes",
+    "sys.net.tx_packets",
+    "sys.net.up",
+    "sys.power",
+    "sys.thermal",
+    "sys.time",
+    "sys.uptime",
+}
+
+sys_from_rpi = {
+    "sys.boot_time",
+    "sys.cpu_seconds",
+    "sys.freq.cpu",
+    "sys.freq.cpu_max",
+    "sys.freq.cpu_min",
+    "sys.freq.cpu_perc",
+    "sys.fs.avail",
+    "sys.fs.size",
+    "sys.hwmon",
+    "sys.load1",
+    "sys.load15",
+    "sys.load5",
+    "sys.mem.avail",
+    "sys.mem.free",
+    "sys.mem.total",
+    "sys.net.rx_bytes",
+    "sys.net.rx_packets",
+    "sys.net.tx_bytes",
+    "sys.net.tx_packets",
+    "sys.net.up",
+    "sys.thermal",
+    "sys.time",
+    "sys.uptime",
+}
+
+# inconsistent_sys_from_nx are the sys metrics commented out of the nxcore and nxagent sets above.
+# they come in too inconsistently to score the rollups' publishing frequency SLA by, but
+# check_nodes.py only checks that each series has a recent sample, so it still checks them. the
+# checker's sets are the rollup's sets plus these, so the rollup never expects a series the
+# checker doesn't.
+inconsistent_sys_from_nx = {
+    "sys.cooling",
+    "sys.cooling_max",
+    "sys.freq.ape",
+    "sys.freq.cpu",
+    "sys.freq.cpu_max",
+    "sys.freq.cpu_min",
+    "sys.freq.cpu_perc",
+    "sys.freq.emc",
+    "sys.freq.emc_max",
+    "sys.freq.emc_min",
+    "sys.freq.emc_perc",
+    "sys.freq.gpu",
+    "sys.freq.gpu_max",
+    "sys.freq.gpu_min",
+    "sys.freq.gpu_perc",
+}
+
+checked_sys_from_nxcore = sys_from_nxcore | inconsistent_sys_from_nx | {"sys.gps.mode"}
+
+checked_sys_from_nxagent = sys_from_nxagent | inconsistent_sys_from_nx
+
+outputs_from_bme = {
+    "env.temperature",
+    "env.relative_humidity",
+    "env.pressure",
+}
+
+outputs_from_raingauge = {
+    # "env.raingauge.acc", # we decided this measurement didn't make sense and that user's should use total_acc
+    "env.raingauge.event_acc",
+    "env.raingauge.rint",
+    "env.raingauge.total_acc",
+}
+
+# add a stuct here which either has count or interval so we can check this
+# "nxcore": Check("nxcore", name, mean_publish_interval="3min")
+
+# device_output_table describes the output publishing policy for each of
+# the possible devices on a node. the frequency is the minimum expected
+# publishing frequency
+device_output_table = {
+    "nxcore": [("nxcore", name, "120s") for name in sys_from_nxcore],
+    "nxagent": [("nxagent", name, "120s") for name in sys_from_nxagent],
+    "rpi": [("rpi", name, "120s") for name in sys_from_rpi],
+    "dell": [("dell", name, "60s") for name in sys_from_dellblade],
+    "bme280": [("wes-iio-bme280", name, "30s") for name in outputs_from_bme],
+    "bme680": [("wes-iio-bme680", name, "30s") for name in outputs_from_bme],
+    "raingauge": [("wes-raingauge", name, "30s") for name in outputs_from_raingauge],
+    "top_camera": [("imagesampler-top", "upload", "1h")],
+    "bottom_camera": [("imagesampler-bottom", "upload", "1h")],
+    "left_camera": [("imagesampler-left", "upload", "1h")],
+    "right_camera": [("imagesampler-right", "upload", "1h")],
+    "microphone": [("audiosampler", "upload", "1h")],
+}
+
+bme_tasks = ["wes-iio-bme280", "wes-iio-bme680"]
+
+sys_tasks = ["nxcore", "nxagent", "rpi", "dell"]
+
+# host_suffixes maps the suffix of a host to the device whose sys metrics it publishes. dell
+# blades have published from both sbcore and sb-core hosts.
+host_suffixes = {
+    "nxcore": "nxcore",
+    "nxagent": "nxagent",
+    # NOTE this will not really work for nodes with multiple rpis. we need to rethink this a bit
+    # in the future. for now, we want to fix the urgent problem of differentiating most sys metrics.
+    "rpi": "rpi",
+    "sbcore": "dell",
+    "sb-core": "dell",
+}
+
+# sensor_devices maps meta.sensor to the device which publishes env metrics. both bme sensors
+# publish the same names, so they can only be told apart by sensor.
+sensor_devices = {
+    "bme280": "bme280",
+    "bme680": "bme680",
+}
+
+
+class SeriesClassifier:
+    """
+    SeriesClassifier attributes series to devices by their host, sensor and name. sys metrics are
+    attributed by host suffix, env metrics by sensor and other outputs by name when only one
+    device in the table publishes them. Results are memoized per unique (host, sensor, name), so
+    each combination is only classified once.
+    """
+
+    def __init__(self, table, host_suffixes, sensor_devices):
+        self.host_pattern = re.compile("(%s)$" % "|".join(map(re.escape, host_suffixes)))
+        self.host_suffixes = host_suffixes
+        self.sensor_devices = sensor_devices
+
+        devices_for_name = {}
+        for device, outputs in table.items():
+            for _, name, _ in outputs:
+                devices_for_name.setdefault(name, set()).add(device)
+        self.device_for_name = {
+            name: devices.pop()
+            for name, devices in devices_for_name.items()
+            if len(devices) == 1 and not name.startswith("sys.")
+        }
+
+        self.devices = {}
+
+    def classify(self, host, sensor, name):
+        if name.startswith("sys."):
+            if not isinstance(host, str):
+                return None
+            match = self.host_pattern.search(host)
+            return self.host_suffixes[match.group(1)] if match is not None else None
+        if sensor in self.sensor_devices:
+            return self.sensor_devices[sensor]
+        return self.device_for_name.get(name)
+
+    def get_device(self, host, sensor, name):
+        """
+        Returns the device which published the series or None if it isn't one we track.
+        """
+        key = (host, sensor, name)
+        try:
+            return self.devices[key]
+        except KeyError:
+            device = self.devices[key] = self.classify(host, sensor, name)
+            return device
+
+    def get_devices(self, df):
+        """
+        Returns the device of each row of a query result frame. Rows are classified once per
+        unique (meta.host, meta.sensor, name) and the results are broadcast back to the rows.
+        """
+        keys = pd.DataFrame(
+            {c: df[c] if c in df.columns else None for c in ["meta.host", "meta.sensor", "name"]},
+            index=df.index,
+        )
+        codes, uniques = pd.MultiIndex.from_frame(keys).factorize()
+        devices = np.array([self.get_device(*key) for key in uniques], dtype=object)
+        return pd.Series(devices[codes], index=df.index, dtype=object)
+
+
+series_classifier = SeriesClassifier(device_output_table, host_suffixes, sensor_devices)
@@ -0,0 +1,99 @@
+from check_nodes import (
+    query_latest,
+    query_latest_uploads,
+    get_expected_uploads,
+    get_missing_uploads,
+)
+from utils import get_data_source, set_data_source, DataSource
+import pandas as pd
+import unittest
+
+
+class FakeDataSource(DataSource):
+    """
+    FakeDataSource answers queries from a fixed frame and records the queries made to it.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.queries = []
+
+    def query(self, start, end, **kwargs):
+        self.queries.append((start, end, kwargs))
+        return self.df[(self.df["timestamp"] >= start) & (self.df["timestamp"] < end)]
+
+
+class TestCheckNodes(unittest.TestCase):
+
+    def setUp(self):
+        source = get_data_source()
+        self.addCleanup(set_data_source, source)
+
+    def test_query_latest(self):
+        now = pd.to_datetime("2022-01-01 12:00:00", utc=True)
+        df = pd.DataFrame(
+            [
+                (now - pd.Timedelta("1min"), "sys.uptime", "000048b02d15bc7c", "nxcore"),
+                (now - pd.Timedelta("30min"), "sys.uptime", "000048b02d15bc7d", "nxcore"),
+                (now - pd.Timedelta("30min"), "upload", "000048b02d15bc7c", "imagesampler-top"),
+                (now - pd.Timedelta("3h"), "upload", "000048b02d15bc7d", "imagesampler-top"),
+            ],
+            columns=["timestamp", "name", "meta.node", "meta.task"],
+        )
+        source = FakeDataSource(df)
+        set_data_source(source)
+
+        got = query_latest(now, pd.Timedelta("5min"))
+        self.assertEqual(len(source.queries), 1)
+        start, end, kwargs = source.queries[0]
+        self.assertEqual((start, end), (now - pd.Timedelta("5min"), now))
+        self.assertEqual(kwargs["tail"], 1)
+        self.assertEqual(got.index.tolist(), [0])
+
+        # only uploads are looked for over the longer lookback
+        query_latest_uploads(now, filter={"vsn": "W01A"})
+        self.assertEqual(len(source.queries), 2)
+        start, end, kwargs = source.queries[1]
+        self.assertEqual((start, end), (now - pd.Timedelta("2h"), now))
+        self.assertEqual(kwargs["filter"], {"vsn": "W01A", "name": "upload"})
+        self.assertEqual(kwargs["tail"], 1)
+
+    def test_missing_uploads(self):
+        expected = get_expected_uploads(
+            {
+                "000048b02d15bc7c": {"imagesampler-top", "imagesampler-bottom", "mobotix-scan", ""},
+                "000048b02d15bc7d": {"imagesampler-top"},
+                "000048b02d15bc7e": set(),
+            }
+        )
+        self.assertEqual(
+            expected.values.tolist(),
+            [
+                ["000048b02d15bc7c", "imagesampler-bottom"],
+                ["000048b02d15bc7c", "imagesampler-top"],
+                ["000048b02d15bc7d", "imagesampler-top"],
+            ],
+        )
+
+        uploads = pd.DataFrame(
+            [
+                ("000048b02d15bc7c", "imagesampler-top"),
+                ("000048b02d15bc7d", "imagesampler-bottom"),
+            ],
+            columns=["meta.node", "meta.task"],
+        )
+        self.assertEqual(
+            get_missing_uploads(expected, uploads).values.tolist(),
+            [
+                ["000048b02d15bc7c", "imagesampler-bottom"],
+                ["000048b02d15bc7d", "imagesampler-top"],
+            ],
+        )
+
+        # every upload is missing when there are none
+        empty = pd.DataFrame({"timestamp": pd.to_datetime([], utc=True), "name": [], "value": []})
+        self.assertEqual(len(get_missing_uploads(expected, empty)), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+from local_services import LocalServices, start_local_services
+from utils import load_node_table, write_results_to_influxdb
+from rollup_health_and_sanity_metrics import get_health_records_for_window
+import pandas as pd
+import requests
+import unittest
+from unittest.mock import patch
+
+
+class TestLocalServices(unittest.TestCase):
+
+    def setUp(self):
+        self.services = LocalServices(nodes=12)
+        self.server = start_local_services(self.services)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        patches = [
+            patch("utils.SAGE_API_URL", self.url),
+            patch("utils.SAGE_QUERY_URL", f"{self.url}/api/v1/query"),
+            patch("rollup_health_and_sanity_metrics.SAGE_SCHEDULER_URL", self.url),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_healthy_fleet(self):
+        nodes = load_node_table()
+        self.assertEqual(len(nodes), 12)
+
+        start = pd.to_datetime("2022-01-01 10:00:00", utc=True)
+        end = start + pd.Timedelta("1h")
+        records = get_health_records_for_window(nodes, start, end, "1h")
+
+        # every node in the synthetic fleet publishes all of its expected series
+        health = [r for r in records if r["measurement"] == "node_health_check"]
+        self.assertEqual(len(health), 12)
+        for r in health:
+            self.assertEqual(r["fields"]["value"], 1, r["tags"])
+        self.assertFalse(any(r["measurement"] == "health_rule_failure_total" for r in records))
+
+    def test_write_sink(self):
+        timestamp = pd.to_datetime("2022-01-01 10:00:00", utc=True)
+        records = [
+            {
+                "measurement": "total",
+                "tags": {"vsn": f"W{i:03d}"},
+                "fields": {"value": i},
+                "timestamp": timestamp,
+            }
+            for i in range(25)
+        ]
+        write_results_to_influxdb(
+            url=self.url, token="token", org="waggle", bucket="plugin-stats", records=records
+        )
+        stats = requests.get(f"{self.url}/sink").json()
+        self.assertEqual(stats["points"], {"plugin-stats": 25})
+
+
+if __name__ == "__main__":
+    unittest.main()
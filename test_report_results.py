@@ -0,0 +1,112 @@
+from report_results import publish_results_to_slack
+import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+
+class FakeWebClient:
+    """
+    FakeWebClient records the calls made to it in place of slack.WebClient.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.files = []
+
+    def chat_postMessage(self, **kwargs):
+        self.messages.append(kwargs)
+        return {"ok": True, "ts": f"1665482400.{len(self.messages):06d}"}
+
+    def files_upload(self, **kwargs):
+        self.files.append(kwargs)
+        return {"ok": True}
+
+
+def write_results(path, issues):
+    pd.DataFrame(issues, columns=["node", "vsn", "msg"]).to_csv(path, index=False)
+
+
+def get_node_sections(client):
+    return [
+        block["text"]["text"].split("\n")[0]
+        for message in client.messages
+        for block in message["blocks"]
+        if "accessory" in block
+    ]
+
+
+class TestReportResults(unittest.TestCase):
+
+    def test_only_changed_nodes_are_reported(self):
+        with TemporaryDirectory() as dir:
+            result_file = Path(dir, "result.csv")
+            save_file = Path(dir, "report.csv")
+            write_results(
+                save_file,
+                [
+                    ("000048b02d15bc7c", "W01A", "missing nxcore sys.uptime"),
+                    ("000048b02d15bc7d", "W01B", "missing rpi sys.uptime"),
+                ],
+            )
+            write_results(
+                result_file,
+                [
+                    ("000048b02d15bc7c", "W01A", "missing nxcore sys.uptime"),
+                    ("000048b02d15bc7e", "W01C", "missing nxcore sys.uptime"),
+                ],
+            )
+
+            client = FakeWebClient()
+            publish_results_to_slack(result_file, save_file, client, file_threshold=10)
+
+            # W01A's issue is recurring, W01B was fixed and W01C is new
+            self.assertEqual(
+                get_node_sections(client),
+                ["*W01B* (000048b02d15bc7d)", "*W01C* (000048b02d15bc7e)"],
+            )
+            summary = client.messages[-1]["blocks"][-1]["text"]["text"]
+            self.assertIn("2 active issues (1 recurring | 1 new)", summary)
+            self.assertIn("2 of 3 nodes changed", summary)
+            # the diff is small, so the file isn't uploaded
+            self.assertEqual(client.files, [])
+            # the new results are stored for the next comparison
+            self.assertEqual(save_file.read_bytes(), result_file.read_bytes())
+
+            # nothing is posted when no node's issues changed
+            client = FakeWebClient()
+            publish_results_to_slack(result_file, save_file, client)
+            self.assertEqual(client.messages, [])
+
+    def test_large_reports_are_split(self):
+        with TemporaryDirectory() as dir:
+            result_file = Path(dir, "result.csv")
+            save_file = Path(dir, "report.csv")
+            write_results(
+                result_file,
+                [
+                    (f"000048b02d15{i:04x}", f"W{i:03d}", msg)
+                    for i in range(120)
+                    for msg in ["missing nxcore sys.uptime", "missing rpi sys.uptime"]
+                ],
+            )
+
+            client = FakeWebClient()
+            publish_results_to_slack(result_file, save_file, client, file_threshold=100)
+
+            self.assertEqual(len(get_node_sections(client)), 120)
+            self.assertEqual(len(client.messages), 3)
+            for message in client.messages:
+                self.assertLessEqual(len(message["blocks"]), 50)
+            # the rest of the report is posted in the thread of the first message
+            self.assertNotIn("thread_ts", client.messages[0])
+            for message in client.messages[1:]:
+                self.assertEqual(message["thread_ts"], "1665482400.000001")
+            # the diff is large, so the file is uploaded to the thread
+            self.assertEqual(len(client.files), 1)
+            self.assertEqual(client.files[0]["file"], str(result_file))
+            self.assertEqual(client.files[0]["thread_ts"], "1665482400.000001")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,198 @@
+from local_services import LocalServices, start_local_services
+import rollup_plugin_counts
+import rollup_upload_counts
+from utils import (
+    Node,
+    WriteIndex,
+    parse_write_index_tags,
+    load_node_table,
+    get_nodes_in_shard,
+    query_adaptive,
+)
+import os
+import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+
+class TestRollupCounts(unittest.TestCase):
+    """
+    Runs the count rollups end-to-end against the stand-in services in local_services.py.
+    """
+
+    scripts = [
+        (rollup_plugin_counts, "plugin-stats"),
+        (rollup_upload_counts, "upload-stats"),
+    ]
+
+    def setUp(self):
+        self.services = LocalServices(nodes=12)
+        self.server = start_local_services(self.services)
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        patches = [
+            patch("utils.SAGE_API_URL", url),
+            patch("utils.SAGE_QUERY_URL", f"{url}/api/v1/query"),
+            patch.dict(os.environ, {"INFLUXDB_URL": url, "INFLUXDB_TOKEN": "token"}),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_main(self, script, *args):
+        argv = [
+            script.__name__,
+            "--start",
+            "2022-01-01T00:00:00Z",
+            "--end",
+            "2022-01-01T02:00:00Z",
+            *args,
+        ]
+        with patch("sys.argv", argv):
+            script.main()
+
+    def get_points(self, bucket):
+        return self.services.sink.stats()["points"].get(bucket, 0)
+
+    def test_reconcile(self):
+        for script, bucket in self.scripts:
+            with self.subTest(script=script.__name__), TemporaryDirectory() as dir:
+                index = str(Path(dir, "index.db"))
+
+                self.run_main(script, "--write-index", index)
+                written = self.get_points(bucket)
+                # rollup records and the reporter_run record
+                self.assertGreater(written, 1)
+
+                # nothing arrived late, so the single probe finds nothing to re-roll and only the
+                # reporter_run record is written
+                with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+                    self.run_main(script, "--write-index", index, "--reconcile")
+                self.assertEqual(query.call_count, 1)
+                self.assertEqual(self.get_points(bucket), written + 1)
+
+    def get_index_rows(self, index, bucket, timestamp, vsn):
+        rows = index.conn.execute(
+            "SELECT rowid, tags FROM written WHERE bucket=? AND timestamp=?",
+            (bucket, int(timestamp.timestamp())),
+        ).fetchall()
+        return [rowid for rowid, tags in rows if parse_write_index_tags(tags)["vsn"] == vsn]
+
+    def test_reconcile_rerolls_changed_windows(self):
+        first_window = pd.Timestamp("2022-01-01T00:00:00Z")
+
+        for script, bucket in self.scripts:
+            with self.subTest(script=script.__name__), TemporaryDirectory() as dir:
+                path = str(Path(dir, "index.db"))
+                self.run_main(script, "--write-index", path)
+
+                # data arrives late for one node in the first window only
+                with WriteIndex(path) as index:
+                    rows = self.get_index_rows(index, bucket, first_window, "W001")
+                    self.assertGreater(len(rows), 0)
+                    with index.conn:
+                        index.conn.executemany(
+                            "DELETE FROM written WHERE rowid=?", [(rowid,) for rowid in rows]
+                        )
+
+                # only that node's records in that window are re-rolled
+                written = self.get_points(bucket)
+                with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+                    self.run_main(script, "--write-index", path, "--reconcile")
+                self.assertEqual(self.get_points(bucket), written + len(rows) + 1)
+
+                # the range is probed once, then each half only for the changed node
+                self.assertEqual(query.call_count, 3)
+                self.assertNotIn("vsn", query.call_args_list[0].kwargs["filter"])
+                for call in query.call_args_list[1:]:
+                    self.assertEqual(call.kwargs["filter"]["vsn"], "W001")
+
+                with WriteIndex(path) as index:
+                    self.assertEqual(
+                        len(self.get_index_rows(index, bucket, first_window, "W001")), len(rows)
+                    )
+
+    def test_shard(self):
+        nodes = load_node_table()
+        empty = next(i for i in range(64) if len(get_nodes_in_shard(nodes, (i, 64))) == 0)
+
+        for script, bucket in self.scripts:
+            with self.subTest(script=script.__name__):
+                self.run_main(script)
+                points = self.get_points(bucket)
+
+                # the shards cover the fleet once, each writing its own reporter_run record
+                for i in range(3):
+                    self.run_main(script, "--shard", f"{i}/3")
+                self.assertEqual(self.get_points(bucket), 2 * points + 2)
+
+                # an empty shard returns without querying or writing anything
+                with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+                    self.run_main(script, "--shard", f"{empty}/64")
+                self.assertEqual(query.call_count, 0)
+                self.assertEqual(self.get_points(bucket), 2 * points + 2)
+
+    def test_node_selection(self):
+        for script, bucket in self.scripts:
+            with self.subTest(script=script.__name__), TemporaryDirectory() as dir:
+                path = str(Path(dir, "index.db"))
+
+                # the selection is pushed down into the query and only those nodes are written
+                with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+                    self.run_main(script, "--vsn", "w001", "--vsn", "W002", "--write-index", path)
+                self.assertGreater(query.call_count, 0)
+                for call in query.call_args_list:
+                    self.assertEqual(call.kwargs["filter"]["vsn"], "W001|W002")
+
+                with WriteIndex(path) as index:
+                    rows = index.conn.execute(
+                        "SELECT tags FROM written WHERE bucket=?", (bucket,)
+                    ).fetchall()
+                self.assertGreater(len(rows), 0)
+                self.assertEqual(
+                    {parse_write_index_tags(tags)["vsn"] for (tags,) in rows}, {"W001", "W002"}
+                )
+
+    def test_upload_counts_null_tags(self):
+        start = pd.Timestamp("2022-01-01T00:00:00Z")
+        node = Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices=set())
+        df = pd.DataFrame(
+            {
+                "timestamp": [start] * 4,
+                "name": ["upload"] * 4,
+                "value": [1, 2, 3, 4],
+                "meta.node": [node.id] * 4,
+                "meta.vsn": [node.vsn] * 4,
+                "meta.plugin": ["imagesampler", "imagesampler", None, "audiosampler"],
+                "meta.task": ["imagesampler-top", "imagesampler-top", "imagesampler-top", None],
+                "meta.camera": ["top", None, "top", None],
+            }
+        )
+
+        with patch("sage_data_client.query", return_value=df):
+            records = rollup_upload_counts.get_media_counts_for_window(
+                [node], start, start + pd.Timedelta("1h")
+            )
+
+        # uploads without a camera are counted, but those without a plugin or task are not
+        self.assertEqual(
+            [(r["tags"].get("camera"), r["fields"]["value"]) for r in records],
+            [("top", 1), (None, 2)],
+        )
+
+    def test_dry_run_does_not_create_index(self):
+        for script, bucket in self.scripts:
+            with self.subTest(script=script.__name__), TemporaryDirectory() as dir:
+                index = Path(dir, "index.db")
+                self.run_main(script, "--dry-run", "--write-index", str(index), "--reconcile")
+                self.assertFalse(index.exists())
+                self.assertEqual(self.get_points(bucket), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
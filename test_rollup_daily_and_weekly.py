@@ -0,0 +1,185 @@
+from rollup_daily_and_weekly import get_period_records_for_bucket, get_period_range
+from utils import WriteIndex
+import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+
+
+def datetime(s):
+    return pd.to_datetime(s, utc=True)
+
+
+def record(measurement, tags, timestamp, value):
+    return {
+        "measurement": measurement,
+        "tags": tags,
+        "fields": {"value": value},
+        "timestamp": timestamp,
+    }
+
+
+class TestRollupDailyAndWeekly(unittest.TestCase):
+
+    def test_get_period_range(self):
+        # 2021-10-11 is a Monday
+        self.assertEqual(
+            get_period_range(datetime("2021-10-09 10:00"), datetime("2021-10-13 10:00"), "1d"),
+            (datetime("2021-10-09"), datetime("2021-10-13")),
+        )
+        self.assertEqual(
+            get_period_range(datetime("2021-10-09 10:00"), datetime("2021-10-20 10:00"), "1w"),
+            (datetime("2021-10-04"), datetime("2021-10-18")),
+        )
+
+    def test_get_period_records_for_bucket(self):
+        hours = pd.date_range("2021-10-11 00:00", "2021-10-13 00:00", freq="1h", tz="UTC", inclusive="left")
+        week = pd.date_range("2021-10-11 00:00", "2021-10-18 00:00", freq="1h", tz="UTC", inclusive="left")
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "index.db")) as index:
+            # W01A is unhealthy for the last 6 hours of the first day
+            index.update(
+                "health",
+                [
+                    record("node_health_check", {"vsn": "W01A"}, ts, int(not (ts.day == 11 and ts.hour >= 18)))
+                    for ts in hours
+                ],
+            )
+            index.update(
+                "plugin-stats",
+                [
+                    record("total", {"vsn": "W01A", "node": "000048b02d15bc7c", "plugin": "p,q=1"}, ts, 10)
+                    for ts in week
+                ],
+            )
+
+            records, incomplete = get_period_records_for_bucket(
+                [index], "health", datetime("2021-10-11"), datetime("2021-10-13"), "1d"
+            )
+            self.assertEqual(
+                records,
+                [
+                    record("node_health_check_1d", {"vsn": "W01A"}, datetime("2021-10-11"), 0.75),
+                    record("node_health_check_1d", {"vsn": "W01A"}, datetime("2021-10-12"), 1.0),
+                ],
+            )
+            self.assertEqual(incomplete, [])
+
+            # tags are kept intact even if they contain separators
+            records, incomplete = get_period_records_for_bucket(
+                [index], "plugin-stats", datetime("2021-10-11"), datetime("2021-10-18"), "1w"
+            )
+            self.assertEqual(
+                records,
+                [
+                    record(
+                        "total_1w",
+                        {"node": "000048b02d15bc7c", "plugin": "p,q=1", "vsn": "W01A"},
+                        datetime("2021-10-11"),
+                        1680,
+                    ),
+                ],
+            )
+            self.assertEqual(incomplete, [])
+
+            # only two days of the week were written to health, so it's skipped
+            records, incomplete = get_period_records_for_bucket(
+                [index], "health", datetime("2021-10-11"), datetime("2021-10-18"), "1w"
+            )
+            self.assertEqual(records, [])
+            self.assertEqual(incomplete, [datetime("2021-10-11")])
+
+            # days whose last hour hasn't been written yet are skipped
+            index.update("health", [record("node_health_check", {"vsn": "W01A"}, datetime("2021-10-13 00:00"), 1)])
+            records, incomplete = get_period_records_for_bucket(
+                [index], "health", datetime("2021-10-12"), datetime("2021-10-14"), "1d"
+            )
+            self.assertEqual([r["timestamp"] for r in records], [datetime("2021-10-12")])
+            self.assertEqual(incomplete, [datetime("2021-10-13")])
+
+            # days missing any hour are skipped, not just those missing their first or last hour
+            with index.conn:
+                index.conn.execute(
+                    "DELETE FROM written WHERE bucket='health' AND timestamp=?",
+                    (int(datetime("2021-10-11 12:00").timestamp()),),
+                )
+            records, incomplete = get_period_records_for_bucket(
+                [index], "health", datetime("2021-10-11"), datetime("2021-10-13"), "1d"
+            )
+            self.assertEqual([r["timestamp"] for r in records], [datetime("2021-10-12")])
+            self.assertEqual(incomplete, [datetime("2021-10-11")])
+
+            # nothing was written to this bucket
+            self.assertEqual(
+                get_period_records_for_bucket(
+                    [index], "upload-stats", datetime("2021-10-11"), datetime("2021-10-18"), "1w"
+                ),
+                ([], [datetime("2021-10-11")]),
+            )
+
+    def test_get_period_records_for_bucket_partial_series(self):
+        hours = pd.date_range("2021-10-11 00:00", "2021-10-12 00:00", freq="1h", tz="UTC", inclusive="left")
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "index.db")) as index:
+            # W01B was added halfway through the day, so its mean would only cover half the day
+            index.update(
+                "health",
+                [record("node_health_check", {"vsn": "W01A"}, ts, 1) for ts in hours]
+                + [record("node_health_check", {"vsn": "W01B"}, ts, 1) for ts in hours[12:]],
+            )
+            # counts are only written for hours with data
+            index.update(
+                "plugin-stats",
+                [record("total", {"vsn": "W01A"}, ts, 10) for ts in hours]
+                + [record("total", {"vsn": "W01B"}, ts, 10) for ts in hours[12:]],
+            )
+
+            with self.assertLogs(level="WARNING"):
+                records, incomplete = get_period_records_for_bucket(
+                    [index], "health", datetime("2021-10-11"), datetime("2021-10-12"), "1d"
+                )
+            self.assertEqual(
+                records,
+                [record("node_health_check_1d", {"vsn": "W01A"}, datetime("2021-10-11"), 1.0)],
+            )
+            self.assertEqual(incomplete, [])
+
+            records, incomplete = get_period_records_for_bucket(
+                [index], "plugin-stats", datetime("2021-10-11"), datetime("2021-10-12"), "1d"
+            )
+            self.assertEqual([r["fields"]["value"] for r in records], [240, 120])
+
+    def test_get_period_records_for_bucket_shards(self):
+        hours = pd.date_range("2021-10-11 00:00", "2021-10-12 00:00", freq="1h", tz="UTC", inclusive="left")
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "0.db")) as shard0, WriteIndex(Path(dir, "1.db")) as shard1:
+            shard0.update("health", [record("node_health_check", {"vsn": "W01A"}, ts, 1) for ts in hours])
+            shard1.update("health", [record("node_health_check", {"vsn": "W01B"}, ts, 0) for ts in hours])
+
+            records, incomplete = get_period_records_for_bucket(
+                [shard0, shard1], "health", datetime("2021-10-11"), datetime("2021-10-12"), "1d"
+            )
+            self.assertEqual(
+                records,
+                [
+                    record("node_health_check_1d", {"vsn": "W01A"}, datetime("2021-10-11"), 1.0),
+                    record("node_health_check_1d", {"vsn": "W01B"}, datetime("2021-10-11"), 0.0),
+                ],
+            )
+            self.assertEqual(incomplete, [])
+
+            # each shard must cover the whole day, even if the others do
+            with shard1.conn:
+                shard1.conn.execute(
+                    "DELETE FROM written WHERE timestamp=?", (int(hours[-1].timestamp()),)
+                )
+            self.assertEqual(
+                get_period_records_for_bucket(
+                    [shard0, shard1], "health", datetime("2021-10-11"), datetime("2021-10-12"), "1d"
+                ),
+                ([], [datetime("2021-10-11")]),
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,453 @@
+from rollup_health_and_sanity_metrics import (
+    get_health_records_for_window,
+    get_rule_stats,
+    get_rule_violations,
+    get_cadence_stats,
+    get_live_health_records,
+    get_sanity_records_for_window,
+    RollingSLATracker,
+    LiveHealthChecker,
+    ScheduledTasksCache,
+    get_series_instances,
+    get_series_instance,
+)
+from utils import Node, replay_records
+import json
+import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import unittest
+from unittest.mock import patch
+
+
+def datetime(s):
+    return pd.to_datetime(s, utc=True)
+
+
+bme_values = {
+    "env.temperature": 20.0,
+    "env.relative_humidity": 50.0,
+    "env.pressure": 98000.0,
+}
+
+
+def generate_items(start, end):
+    """
+    Generates stream records for a healthy W01A, a W01B which stops publishing bme280 outputs at
+    half past each hour and no data for W01C.
+    """
+    items = []
+    for ts in pd.date_range(start, end, freq="30s", inclusive="left"):
+        for name, value in bme_values.items():
+            for vsn in ["W01A", "W01B"]:
+                if vsn == "W01B" and ts.minute >= 30:
+                    continue
+                items.append(
+                    {
+                        "timestamp": ts.isoformat(),
+                        "name": name,
+                        "value": value,
+                        "meta": {"vsn": vsn, "task": "wes-iio-bme280", "host": "000048b02d15bc7c.ws-nxcore"},
+                    }
+                )
+        if ts.second == 0 and ts.minute % 2 == 0:
+            for vsn in ["W01A", "W01B"]:
+                items.append(
+                    {
+                        "timestamp": ts.isoformat(),
+                        "name": "sys.uptime",
+                        "value": (ts - start).total_seconds(),
+                        "meta": {"vsn": vsn, "task": "wes-metrics-agent", "host": "000048b02d15bc7c.ws-nxcore"},
+                    }
+                )
+    return items
+
+
+def items_to_frame(items):
+    df = pd.json_normalize(items, sep=".")
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+    return df
+
+
+class TestRollupHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = [
+            Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices={"bme280"}),
+            Node(id="000048b02d15bc7d", vsn="W01B", type="wsn", devices={"bme280"}),
+            Node(id="000048b02d15bc7e", vsn="W01C", type="wsn", devices={"bme280"}),
+        ]
+        patcher = patch(
+            "rollup_health_and_sanity_metrics.get_scheduled_tasks_by_node",
+            return_value={},
+        )
+        self.get_scheduled_tasks_by_node = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_live_health_matches_windowed_rollup(self):
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 12:00:00")
+        window = pd.Timedelta("1h")
+        items = generate_items(start, end)
+
+        # W01A reports a bogus temperature in the second window
+        items.append(
+            {
+                "timestamp": "2021-10-11T11:20:00+00:00",
+                "name": "env.temperature",
+                "value": -999.0,
+                "meta": {"vsn": "W01A", "task": "wes-iio-bme280", "host": "000048b02d15bc7c.ws-nxcore"},
+            }
+        )
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "replay.ndjson")
+            path.write_text("\n".join(json.dumps(item) for item in items))
+            live = list(
+                get_live_health_records(
+                    self.nodes, window, pd.Timedelta("5m"), replay_records(path), flush=True
+                )
+            )
+
+            # a live stream which ends mid window drops the incomplete window instead
+            partial = list(
+                get_live_health_records(
+                    self.nodes, window, pd.Timedelta("5m"), replay_records(path)
+                )
+            )
+
+        self.assertEqual(len(live), 2)
+        self.assertEqual(partial, live[:1])
+
+        # the scheduled tasks are fetched once per run rather than for every window
+        self.assertEqual(self.get_scheduled_tasks_by_node.call_count, 2)
+
+        for records, (wstart, wend) in zip(live, [(start, start + window), (start + window, end)]):
+            df = items_to_frame(
+                [item for item in items if wstart <= datetime(item["timestamp"]) < wend]
+            )
+            with patch("sage_data_client.query", return_value=df):
+                expect = get_health_records_for_window(self.nodes, wstart, wend, window)
+            # cadence stats are only computed by the windowed rollup
+            expect = [r for r in expect if r["measurement"] != "publish_cadence"]
+            self.assertEqual(records, expect)
+
+        values = {
+            (r["measurement"], r["tags"]["vsn"]): r["fields"]["value"] for r in live[0]
+        }
+        self.assertEqual(values[("node_health_check", "W01A")], 1)
+        self.assertEqual(values[("node_health_check", "W01B")], 0)
+        self.assertEqual(values[("node_health_check", "W01C")], 0)
+
+        # value rules fail the device even though it published on time
+        values = {
+            (r["measurement"], r["tags"]["vsn"]): r for r in live[1]
+        }
+        self.assertEqual(values[("node_health_check", "W01A")]["fields"]["value"], 0)
+        self.assertEqual(
+            values[("health_rule_failure_total", "W01A")]["tags"],
+            {"vsn": "W01A", "task": "wes-iio-bme280", "name": "env.temperature", "rule": "range"},
+        )
+        self.assertEqual(values[("health_rule_failure_total", "W01A")]["fields"]["value"], 1)
+
+    def test_rolling_sla_matches_recomputed_lookback(self):
+        start = datetime("2021-10-11 09:00:00")
+        end = datetime("2021-10-11 12:00:00")
+        lookback = pd.Timedelta("1h")
+        step = pd.Timedelta("15m")
+
+        # W01B drops out entirely at 10:05
+        items = [
+            item
+            for item in generate_items(start, end)
+            if not (
+                item["meta"]["vsn"] == "W01B"
+                and datetime(item["timestamp"]) >= datetime("2021-10-11 10:05:00")
+            )
+        ]
+
+        results = list(
+            get_live_health_records(
+                self.nodes,
+                pd.Timedelta("1h"),
+                pd.Timedelta("5m"),
+                items,
+                rolling_step=step,
+                rolling_lookback=lookback,
+                flush=True,
+            )
+        )
+        rolling = [
+            records
+            for records in results
+            if records[0]["measurement"] in ["device_health_sla", "node_health_sla"]
+        ]
+        steps = [records[0]["timestamp"] for records in rolling]
+        self.assertEqual(
+            steps, list(pd.date_range(start + lookback, end, freq=step, inclusive="left"))
+        )
+
+        # the scheduled tasks are fetched once rather than for every window and step
+        self.assertEqual(self.get_scheduled_tasks_by_node.call_count, 1)
+
+        df = items_to_frame(items)
+        df["bin"] = df["timestamp"].dt.floor("30s")
+
+        # recompute each step from scratch to check the incremental result
+        for records in rolling:
+            now = records[0]["timestamp"]
+            df_lookback = df[(df["bin"] >= now - lookback) & (df["bin"] < now)]
+            for r in records:
+                if r["measurement"] != "device_health_sla":
+                    continue
+                vsn = r["tags"]["vsn"]
+                counts = [
+                    df_lookback[(df_lookback["meta.vsn"] == vsn) & (df_lookback["name"] == name)]["bin"].nunique()
+                    for name in ["env.temperature", "env.relative_humidity", "env.pressure"]
+                ]
+                self.assertAlmostEqual(r["fields"]["value"], min(counts) / 120, msg=f"{vsn} {now}")
+
+        values = {
+            (r["tags"]["vsn"], r["timestamp"]): r["fields"]["value"]
+            for records in rolling
+            for r in records
+            if r["measurement"] == "node_health_sla"
+        }
+        # W01B only publishes bme280 in the first half of each hour before dropping out
+        self.assertAlmostEqual(values[("W01B", datetime("2021-10-11 10:00:00"))], 30 / 60)
+        self.assertAlmostEqual(values[("W01B", datetime("2021-10-11 10:15:00"))], 20 / 60)
+        self.assertAlmostEqual(values[("W01B", datetime("2021-10-11 10:30:00"))], 5 / 60)
+        self.assertEqual(values[("W01B", datetime("2021-10-11 11:15:00"))], 0.0)
+        self.assertEqual(values[("W01A", datetime("2021-10-11 10:15:00"))], 1.0)
+        self.assertEqual(values[("W01C", datetime("2021-10-11 10:15:00"))], 0.0)
+
+    def test_scheduled_tasks_cache(self):
+        clock = [0.0]
+        cache = ScheduledTasksCache(pd.Timedelta("10min"), clock=lambda: clock[0])
+        self.get_scheduled_tasks_by_node.side_effect = [
+            {"W01A": ["a"]},
+            {"W01A": ["b"]},
+            ConnectionError("down"),
+        ]
+
+        self.assertEqual(cache.get(), {"W01A": ["a"]})
+        clock[0] = 599.0
+        self.assertEqual(cache.get(), {"W01A": ["a"]})
+        self.assertEqual(self.get_scheduled_tasks_by_node.call_count, 1)
+
+        clock[0] = 600.0
+        self.assertEqual(cache.get(), {"W01A": ["b"]})
+        self.assertEqual(self.get_scheduled_tasks_by_node.call_count, 2)
+
+        # a failed refresh keeps the last tasks
+        clock[0] = 1200.0
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(cache.get(), {"W01A": ["b"]})
+
+    def test_rolling_sla_tracker_with_missing_vsn(self):
+        tracker = RollingSLATracker(self.nodes, pd.Timedelta("1h"))
+        start = datetime("2021-10-11 10:00:00")
+
+        # records without a vsn land in the same bins as the others and must not break the heaps
+        for vsn in [None, "W01A", None, "W01B"]:
+            for name in bme_values:
+                tracker.add(start, vsn, "wes-iio-bme280", name)
+        tracker.advance(start + pd.Timedelta("1min"))
+        tracker.advance(start + pd.Timedelta("2h"))
+
+        self.assertEqual(tracker.counts[("W01A", "wes-iio-bme280", "env.temperature")], 0)
+        self.assertEqual(len(tracker.leaving), 0)
+
+    def test_rule_violations(self):
+        start = datetime("2021-10-11 10:00:00")
+        timestamps = list(pd.date_range(start, periods=30, freq="2min"))
+        df = pd.DataFrame(
+            {
+                "timestamp": timestamps * 4,
+                "meta.vsn": ["W01A"] * 60 + ["W01B"] * 60,
+                "meta.task": ["nxcore"] * 120,
+                "name": (["sys.uptime"] * 30 + ["sys.fs.avail"] * 30) * 2,
+                # W01A's uptime is stuck, but fs.avail may be constant, and W01B has a negative and a
+                # missing fs.avail value
+                "value": [100.0] * 30
+                + [1e9] * 30
+                + [100.0 + 120 * i for i in range(30)]
+                + [1e9 - i for i in range(28)]
+                + [-1.0, "nan"],
+            }
+        )
+
+        violations = get_rule_violations(
+            get_rule_stats(df.groupby(["meta.vsn", "meta.task", "name"]))
+        )
+
+        self.assertEqual(
+            violations.to_dict("records"),
+            [
+                {"vsn": "W01A", "task": "nxcore", "name": "sys.uptime", "rule": "stale", "value": 30},
+                {"vsn": "W01B", "task": "nxcore", "name": "sys.fs.avail", "rule": "range", "value": 1},
+            ],
+        )
+
+    def get_fs_avail_items(self, start, values):
+        timestamps = list(pd.date_range(start, periods=30, freq="2min"))
+        return [
+            {
+                "timestamp": ts.isoformat(),
+                "name": "sys.fs.avail",
+                "value": value(i),
+                "meta": {"vsn": "W01A", "task": "nxcore", "fs": fs, "mountpoint": mountpoint},
+            }
+            for fs, mountpoint, value in values
+            for i, ts in enumerate(timestamps)
+        ]
+
+    def test_rule_violations_per_instance(self):
+        start = datetime("2021-10-11 10:00:00")
+        # W01A has two filesystems whose free space is stuck at different values
+        items = self.get_fs_avail_items(
+            start,
+            [
+                ("/dev/nvme0n1p1", "/", lambda i: 1e9),
+                ("/dev/nvme0n1p2", "/media/plugin-data", lambda i: 2e9),
+            ],
+        )
+        df = items_to_frame(items)
+
+        want = [{"vsn": "W01A", "task": "nxcore", "name": "sys.fs.avail", "rule": "stale", "value": 60}]
+
+        # sys.fs.avail has no stale rule, so check grouping with one
+        rules = [("nxcore", "sys.fs.avail", 0, None, "30min")]
+        with patch("rollup_health_and_sanity_metrics.value_rule_table", rules):
+            violations = get_rule_violations(
+                get_rule_stats(
+                    df.groupby(["meta.vsn", "meta.task", "name", get_series_instances(df)])
+                )
+            )
+            self.assertEqual(violations.to_dict("records"), want)
+
+            # grouping the filesystems together hides that they're stuck
+            violations = get_rule_violations(
+                get_rule_stats(df.groupby(["meta.vsn", "meta.task", "name"]))
+            )
+            self.assertEqual(violations.to_dict("records"), [])
+
+            # live mode keeps its stats per instance the same way
+            checker = LiveHealthChecker(self.nodes, pd.Timedelta("1h"), pd.Timedelta("5m"))
+            for item in items:
+                checker.add(
+                    pd.Timestamp(item["timestamp"]),
+                    "W01A",
+                    "nxcore",
+                    "sys.fs.avail",
+                    item["value"],
+                    get_series_instance(item["meta"]),
+                )
+            records = checker.pop_health_records(start, {})
+        self.assertIn(
+            {
+                "measurement": "health_rule_failure_total",
+                "tags": {"vsn": "W01A", "task": "nxcore", "name": "sys.fs.avail", "rule": "stale"},
+                "fields": {"value": 60},
+                "timestamp": start,
+            },
+            records,
+        )
+
+    def test_constant_read_only_mount(self):
+        start = datetime("2021-10-11 10:00:00")
+        # the root filesystem is read-only, so its free space never changes
+        items = self.get_fs_avail_items(
+            start,
+            [
+                ("/dev/nvme0n1p1", "/", lambda i: 1e9),
+                ("/dev/nvme0n1p2", "/media/plugin-data", lambda i: 2e9 - i * 1e6),
+            ],
+        )
+        df = items_to_frame(items)
+
+        violations = get_rule_violations(
+            get_rule_stats(df.groupby(["meta.vsn", "meta.task", "name", get_series_instances(df)]))
+        )
+        self.assertEqual(violations.to_dict("records"), [])
+
+    def test_cadence_stats(self):
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 11:00:00")
+        items = generate_items(start, end)
+        # W01A's bme280 drops out for 20 minutes
+        items = [
+            item
+            for item in items
+            if not (
+                item["meta"]["vsn"] == "W01A"
+                and item["meta"]["task"] == "wes-iio-bme280"
+                and datetime("2021-10-11 10:20:00") <= datetime(item["timestamp"]) < datetime("2021-10-11 10:40:00")
+            )
+        ]
+        df = items_to_frame(items).sample(frac=1, random_state=0)
+
+        stats = get_cadence_stats(df.groupby(["meta.vsn", "meta.task", "name"]), start, end)
+        stats = stats.set_index(["vsn", "task", "name"])
+
+        w01a = stats.loc[("W01A", "wes-iio-bme280", "env.temperature")]
+        self.assertEqual(w01a["median_interval"], 30)
+        self.assertEqual(w01a["longest_gap"], 20 * 60 + 30)
+        # W01B stops publishing at half past, which shows up as a gap until the window end
+        w01b = stats.loc[("W01B", "wes-iio-bme280", "env.pressure")]
+        self.assertEqual(w01b["median_interval"], 30)
+        self.assertEqual(w01b["p95_interval"], 30)
+        self.assertEqual(w01b["longest_gap"], 30 * 60 + 30)
+        # sys metrics are only tracked once they are attributed to the task of their host
+        self.assertEqual(len(stats), 6)
+
+    def test_sanity_records(self):
+        start = datetime("2021-10-11 10:00:00")
+        df = pd.DataFrame(
+            {
+                "timestamp": [start] * 5,
+                "name": [
+                    "sys.sanity_status.a",
+                    "sys.sanity_status.a",
+                    "sys.sanity_status.b",
+                    "sys.sanity_status.wes_telegraf_cadvisor",
+                    "sys.sanity_status.a",
+                ],
+                "value": [0, 1, 1, 1, 1],
+                "meta.severity": ["fatal", "fatal", "warning", "fatal", "fatal"],
+                "meta.node": ["000048b02d15bc7c"] * 4 + ["unknown"],
+                "meta.vsn": ["W01A"] * 4 + ["W999"],
+            }
+        )
+
+        with patch("sage_data_client.query", return_value=df):
+            records = get_sanity_records_for_window(
+                self.nodes, start, start + pd.Timedelta("1h")
+            )
+
+        values = {
+            (r["measurement"], tuple(sorted(r["tags"].items()))): r["fields"]["value"]
+            for r in records
+        }
+
+        def tags(vsn, node, **kwargs):
+            return tuple(sorted({"vsn": vsn, "node": node, **kwargs}.items()))
+
+        # excluded tests are dropped and warnings count as passing
+        self.assertEqual(values[("sanity_test_total", tags("W01A", "000048b02d15bc7c"))], 3)
+        self.assertEqual(values[("sanity_test_pass_total", tags("W01A", "000048b02d15bc7c"))], 2)
+        self.assertEqual(values[("sanity_test_fail_total", tags("W01A", "000048b02d15bc7c"))], 1)
+        # nodes without results are zero filled
+        self.assertEqual(values[("sanity_test_total", tags("W01C", "000048b02d15bc7e"))], 0)
+        # per test breakdown
+        test_a = tags("W01A", "000048b02d15bc7c", name="sys.sanity_status.a", severity="fatal")
+        self.assertEqual(values[("sanity_test_name_pass_total", test_a)], 1)
+        self.assertEqual(values[("sanity_test_name_fail_total", test_a)], 1)
+        test_b = tags("W01A", "000048b02d15bc7c", name="sys.sanity_status.b", severity="warning")
+        self.assertEqual(values[("sanity_test_name_pass_total", test_b)], 1)
+        # unknown nodes are ignored
+        self.assertEqual(len(records), 3 * len(self.nodes) + 2 * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+from local_services import LocalServices, start_local_services
+from run_rollups import get_rollup_records_for_window
+from rollup_health_and_sanity_metrics import (
+    get_health_records_for_window,
+    get_sanity_records_for_window,
+    get_scheduled_tasks_by_node,
+)
+from rollup_plugin_counts import get_plugin_counts_for_window
+from rollup_upload_counts import get_media_counts_for_window
+from utils import load_node_table, query_adaptive, get_data_source, Profiler, Fleet
+import json
+import pandas as pd
+import unittest
+from unittest.mock import patch
+
+
+def normalize(records):
+    return sorted(json.dumps(r, sort_keys=True, default=str) for r in records)
+
+
+class TestRunRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_local_services(LocalServices(nodes=12))
+        url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        patches = [
+            patch("utils.SAGE_API_URL", url),
+            patch("utils.SAGE_QUERY_URL", f"{url}/api/v1/query"),
+            patch("rollup_health_and_sanity_metrics.SAGE_SCHEDULER_URL", url),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_scheduled_tasks_with_profiling_off(self):
+        profiler = Profiler()
+        with patch("rollup_health_and_sanity_metrics.profiler", profiler):
+            scheduled_tasks_by_node = get_scheduled_tasks_by_node()
+
+        self.assertFalse(profiler.enabled)
+        self.assertGreater(len(scheduled_tasks_by_node), 0)
+        self.assertGreater(profiler.get_totals("scheduled_tasks")[2], 0)
+
+    def test_fleet_is_built_once(self):
+        nodes = load_node_table()
+        start = pd.to_datetime("2022-01-01 10:00:00", utc=True)
+        window = pd.Timedelta("1h")
+        scheduled_tasks_by_node = get_scheduled_tasks_by_node()
+        fleet = Fleet(nodes)
+
+        with patch("rollup_health_and_sanity_metrics.Fleet", wraps=Fleet) as build:
+            for i in range(2):
+                got = get_rollup_records_for_window(
+                    ["health"],
+                    nodes,
+                    start + i * window,
+                    start + (i + 1) * window,
+                    window,
+                    scheduled_tasks_by_node=scheduled_tasks_by_node,
+                    fleet=fleet,
+                )
+        self.assertEqual(build.call_count, 0)
+
+        want = get_health_records_for_window(
+            nodes, start + window, start + 2 * window, window, scheduled_tasks_by_node=scheduled_tasks_by_node
+        )
+        self.assertEqual(normalize(got["health"]), normalize(want))
+
+    def test_shared_window_matches_separate_rollups(self):
+        nodes = load_node_table()
+        start = pd.to_datetime("2022-01-01 10:00:00", utc=True)
+        end = start + pd.Timedelta("1h")
+        window = pd.Timedelta("1h")
+        scheduled_tasks_by_node = get_scheduled_tasks_by_node()
+
+        want = {
+            "health": get_health_records_for_window(nodes, start, end, window),
+            "sanity": get_sanity_records_for_window(nodes, start, end),
+            "plugin": get_plugin_counts_for_window(nodes, start, end),
+            "upload": get_media_counts_for_window(nodes, start, end),
+        }
+
+        for pushdown in [False, True]:
+            source = get_data_source()
+            with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+                got = get_rollup_records_for_window(
+                    list(want),
+                    nodes,
+                    start,
+                    end,
+                    window,
+                    pushdown=pushdown,
+                    scheduled_tasks_by_node=scheduled_tasks_by_node,
+                )
+
+            # all rollups are answered from a single query of the window
+            self.assertEqual(query.call_count, 1)
+            self.assertIs(get_data_source(), source)
+            self.assertEqual(list(got), list(want))
+            for rollup in want:
+                self.assertGreater(len(got[rollup]), 0, rollup)
+                self.assertEqual(normalize(got[rollup]), normalize(want[rollup]), rollup)
+
+        # without the health rollup, the count rollups make their own count queries
+        with patch("utils.query_adaptive", wraps=query_adaptive) as query:
+            got = get_rollup_records_for_window(["plugin", "upload"], nodes, start, end, window)
+        self.assertEqual(query.call_count, 2)
+        for call in query.call_args_list:
+            self.assertEqual(call.kwargs["experimental_func"], "count")
+        self.assertEqual(normalize(got["upload"]), normalize(want["upload"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
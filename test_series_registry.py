@@ -0,0 +1,80 @@
+from series_registry import (
+    SeriesClassifier,
+    device_output_table,
+    host_suffixes,
+    sensor_devices,
+    series_classifier,
+    sys_from_nxcore,
+    sys_from_nxagent,
+    checked_sys_from_nxcore,
+    checked_sys_from_nxagent,
+)
+import pandas as pd
+import unittest
+from unittest.mock import patch
+
+
+class TestSeriesRegistry(unittest.TestCase):
+
+    def test_get_device(self):
+        tests = [
+            (("000048b02d15bc7c.ws-nxcore", None, "sys.uptime"), "nxcore"),
+            (("000048b02d15bc7c.ws-nxagent", None, "sys.uptime"), "nxagent"),
+            (("000048b02d15bc7c.ws-rpi", None, "sys.uptime"), "rpi"),
+            (("000048b02d15bc7c.sbcore", None, "sys.uptime"), "dell"),
+            (("000048b02d15bc7c.sb-core", None, "sys.uptime"), "dell"),
+            (("000048b02d15bc7c.ws-unknown", None, "sys.uptime"), None),
+            ((None, None, "sys.uptime"), None),
+            (("000048b02d15bc7c.ws-nxcore", "bme280", "env.temperature"), "bme280"),
+            (("000048b02d15bc7c.ws-rpi", "bme680", "env.temperature"), "bme680"),
+            (("000048b02d15bc7c.ws-rpi", None, "env.raingauge.rint"), "raingauge"),
+            # uploads are published by several devices, so they can't be attributed by name alone
+            (("000048b02d15bc7c.ws-nxcore", None, "upload"), None),
+            (("000048b02d15bc7c.ws-nxcore", None, "env.temperature"), None),
+        ]
+        for key, want in tests:
+            self.assertEqual(series_classifier.get_device(*key), want, key)
+
+    def test_get_devices(self):
+        df = pd.DataFrame(
+            {
+                "name": ["sys.uptime", "env.pressure", "sys.uptime", "env.pressure", "upload"],
+                "meta.host": ["a.ws-nxcore", "a.ws-nxcore", "a.ws-nxcore", "a.ws-rpi", None],
+                "meta.sensor": [None, "bme280", None, "bme680", None],
+            },
+            index=[10, 11, 12, 13, 14],
+        )
+        classifier = SeriesClassifier(device_output_table, host_suffixes, sensor_devices)
+
+        with patch.object(classifier, "classify", wraps=classifier.classify) as classify:
+            devices = classifier.get_devices(df)
+            # each unique combination is only classified once
+            self.assertEqual(classify.call_count, 4)
+
+        self.assertEqual(devices.index.tolist(), df.index.tolist())
+        self.assertEqual(devices.tolist(), ["nxcore", "bme280", "nxcore", "bme680", None])
+
+        # frames without meta.sensor are classified by host and name
+        devices = classifier.get_devices(df.drop(columns=["meta.sensor"]))
+        self.assertEqual(devices.tolist(), ["nxcore", None, "nxcore", None, None])
+
+    def test_checked_series(self):
+        # check_nodes.py checks every series it did before the registry was shared, including
+        # the ones the rollups leave out
+        inconsistent = {
+            "sys.cooling",
+            "sys.cooling_max",
+            "sys.freq.ape",
+            *[f"sys.freq.{unit}{suffix}" for unit in ["cpu", "emc", "gpu"] for suffix in ["", "_max", "_min", "_perc"]],
+        }
+        self.assertLessEqual(inconsistent | {"sys.gps.mode"}, checked_sys_from_nxcore)
+        self.assertLessEqual(inconsistent, checked_sys_from_nxagent)
+
+        # the rollups never expect a series the checker doesn't
+        self.assertLessEqual(sys_from_nxcore, checked_sys_from_nxcore)
+        self.assertLessEqual(sys_from_nxagent, checked_sys_from_nxagent)
+        self.assertEqual(checked_sys_from_nxcore - sys_from_nxcore, inconsistent | {"sys.gps.mode"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,53 @@
-from utils import load_node_table, parse_time, get_rollup_range, get_time_windows
+from utils import (
+    load_node_table,
+    parse_time,
+    get_rollup_range,
+    get_time_windows,
+    get_node_frame,
+    get_records_from_frame,
+    Node,
+    WriteIndex,
+    get_nodes_with_changed_totals,
+    reconcile_windows,
+    open_write_index,
+    parse_shard,
+    get_nodes_in_shard,
+    get_shard,
+    select_nodes,
+    query_adaptive,
+    http_get,
+    iter_json_object_items,
+    stream_records,
+    SAGE_QUERY_URL,
+    Profiler,
+    get_reporter_run_record,
+    WriteSpool,
+    write_results_to_influxdb,
+    replay_spool,
+    Fleet,
+    ReplayDataSource,
+    ArrowCacheDataSource,
+    get_arrow_table,
+    get_frame_from_arrow,
+    DataSource,
+)
+import importlib.util
+import json
+import os
 import pandas as pd
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+from itertools import islice
+from urllib.parse import parse_qs, urlparse
+import requests
+import sqlite3
+import urllib.error
+import subprocess
+import sys
 import unittest
+from unittest.mock import patch
 
 
 def datetime(s):
@@ -42,6 +89,756 @@ class TestUtils(unittest.TestCase):
         ]
         self.assertEqual(windows, expect)
 
+    def test_get_records_from_frame(self):
+        timestamp = datetime("2021-10-11 10:00:00")
+        nodes = [
+            Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices=set()),
+            Node(id="000048b02d15bc7d", vsn="W01B", type="wsn", devices=set()),
+        ]
+        counts = pd.DataFrame(
+            {
+                "meta.node": ["000048b02d15bc7c", "000048b02d15bc7c", "unknown"],
+                "meta.vsn": ["W01A", "W01A", "W999"],
+                "meta.camera": ["top", None, "top"],
+                "total": [3, 4, 5],
+            }
+        )
+        table = get_node_frame(nodes).merge(counts, on=["meta.node", "meta.vsn"])
+        records = get_records_from_frame(
+            table,
+            measurement="total",
+            tags={"vsn": "meta.vsn", "camera": "meta.camera"},
+            field="total",
+            timestamp=timestamp,
+        )
+        self.assertEqual(
+            records,
+            [
+                {
+                    "measurement": "total",
+                    "tags": {"vsn": "W01A", "camera": "top"},
+                    "fields": {"value": 3},
+                    "timestamp": timestamp,
+                },
+                {
+                    "measurement": "total",
+                    "tags": {"vsn": "W01A"},
+                    "fields": {"value": 4},
+                    "timestamp": timestamp,
+                },
+            ],
+        )
+
+    def test_write_index(self):
+        def record(vsn, value):
+            return {
+                "measurement": "node_health_check",
+                "tags": {"vsn": vsn},
+                "fields": {"value": value},
+                "timestamp": datetime("2021-10-11 10:00:00"),
+            }
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "index.db")
+
+            with WriteIndex(path) as index:
+                records = [record("W01A", 1), record("W01B", 0)]
+                self.assertEqual(index.get_changed_records("health", records), records)
+                index.update("health", records)
+
+            # reopen index to check that written values persist
+            with WriteIndex(path) as index:
+                records = [record("W01A", 1), record("W01B", 1)]
+                self.assertEqual(
+                    index.get_changed_records("health", records), [record("W01B", 1)]
+                )
+                self.assertEqual(index.suppressed, 1)
+                # same point in a different bucket has not been written yet
+                self.assertEqual(index.get_changed_records("other", records), records)
+
+    def test_open_write_index(self):
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "index.db")
+            self.assertIsNone(open_write_index(None))
+
+            # dry runs don't create the index
+            self.assertIsNone(open_write_index(path, dry_run=True))
+            self.assertFalse(path.exists())
+
+            with open_write_index(path) as index:
+                index.update("health", [{"measurement": "m", "tags": {}, "fields": {"value": 1}, "timestamp": datetime("2021-10-11 10:00:00")}])
+
+            # or change it
+            with open_write_index(path, dry_run=True) as index:
+                self.assertEqual(index.get_totals_by_tags("health", "m", datetime("2021-10-11 10:00:00"), datetime("2021-10-11 11:00:00")), {"{}": 1})
+                with self.assertRaises(sqlite3.OperationalError):
+                    index.update("health", [{"measurement": "m", "tags": {}, "fields": {"value": 2}, "timestamp": datetime("2021-10-11 10:00:00")}])
+
+    def test_get_nodes_with_changed_totals(self):
+        def record(vsn, plugin, timestamp, value):
+            return {
+                "measurement": "total",
+                "tags": {"vsn": vsn, "plugin": plugin},
+                "fields": {"value": value},
+                "timestamp": datetime(timestamp),
+            }
+
+        nodes = [
+            Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices=set()),
+            Node(id="000048b02d15bc7d", vsn="W01B", type="wsn", devices=set()),
+            Node(id="000048b02d15bc7e", vsn="W01C", type="wsn", devices=set()),
+        ]
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 12:00:00")
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "index.db")) as index:
+            index.update(
+                "plugin-stats",
+                [
+                    record("W01A", "p1", "2021-10-11 10:00:00", 10),
+                    record("W01A", "p2", "2021-10-11 11:00:00", 5),
+                    record("W01B", "p1", "2021-10-11 10:00:00", 10),
+                    # outside of range
+                    record("W01B", "p1", "2021-10-11 12:00:00", 10),
+                ],
+            )
+            # probe counts cover all of [start, end), so they have its start as timestamp
+            probe = [
+                record("W01A", "p1", "2021-10-11 10:00:00", 10),
+                record("W01A", "p2", "2021-10-11 10:00:00", 5),
+                record("W01B", "p1", "2021-10-11 10:00:00", 12),
+                record("W01C", "p1", "2021-10-11 10:00:00", 1),
+            ]
+            changed = get_nodes_with_changed_totals(
+                index, "plugin-stats", nodes, probe, start, end
+            )
+            self.assertEqual([node.vsn for node in changed], ["W01B", "W01C"])
+
+            # W01A's total is unchanged, but counts moved between its plugins
+            probe[0] = record("W01A", "p1", "2021-10-11 10:00:00", 9)
+            probe[1] = record("W01A", "p2", "2021-10-11 10:00:00", 6)
+            changed = get_nodes_with_changed_totals(
+                index, "plugin-stats", nodes, probe, start, end
+            )
+            self.assertEqual([node.vsn for node in changed], ["W01A", "W01B", "W01C"])
+
+    def test_reconcile_windows(self):
+        nodes = [
+            Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices=set()),
+            Node(id="000048b02d15bc7d", vsn="W01B", type="wsn", devices=set()),
+        ]
+        windows = get_time_windows(datetime("2021-10-11 10:00:00"), datetime("2021-10-11 14:00:00"), "1h")
+
+        counts = {(node.vsn, start): 10 for node in nodes for start, _ in windows}
+        calls = []
+
+        def get_counts(nodes, start, end, pushdown=False):
+            calls.append((start, end, [node.vsn for node in nodes], pushdown))
+            return [
+                {
+                    "measurement": "total",
+                    "tags": {"vsn": node.vsn, "plugin": "p"},
+                    "fields": {"value": sum(v for (vsn, t), v in counts.items() if vsn == node.vsn and start <= t < end)},
+                    "timestamp": start,
+                }
+                for node in nodes
+            ]
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "index.db")) as index:
+            for start, end in windows:
+                index.update("plugin-stats", get_counts(nodes, start, end))
+            calls.clear()
+
+            # W01B received late data for the third window since it was written
+            counts[("W01B", windows[2][0])] = 12
+
+            changed = reconcile_windows(index, "plugin-stats", nodes, windows, get_counts)
+
+        self.assertEqual(list(changed), [windows[2]])
+        self.assertEqual([r["tags"]["vsn"] for r in changed[windows[2]]], ["W01B"])
+        self.assertEqual(changed[windows[2]][0]["fields"]["value"], 12)
+
+        # the whole range is probed once, then only the halves with W01B's late data
+        hours = [start for start, _ in windows] + [windows[-1][1]]
+        self.assertEqual(
+            calls,
+            [
+                (hours[0], hours[4], ["W01A", "W01B"], False),
+                (hours[0], hours[2], ["W01B"], True),
+                (hours[2], hours[4], ["W01B"], True),
+                (hours[2], hours[3], ["W01B"], True),
+                (hours[3], hours[4], ["W01B"], True),
+            ],
+        )
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("0/4"), (0, 4))
+        self.assertEqual(parse_shard("3/4"), (3, 4))
+        for s in ["4/4", "-1/4", "1", "a/b", "1/0"]:
+            with self.assertRaises(ValueError):
+                parse_shard(s)
+
+    def test_get_nodes_in_shard(self):
+        nodes = [
+            Node(id=f"{i:016x}", vsn=f"W{i:03X}", type="wsn", devices=set())
+            for i in range(200)
+        ]
+
+        for n in [1, 2, 3, 8]:
+            shards = [get_nodes_in_shard(nodes, (i, n)) for i in range(n)]
+            # check that shards cover all nodes without overlap
+            merged = sorted(node.vsn for shard in shards for node in shard)
+            self.assertEqual(merged, sorted(node.vsn for node in nodes))
+
+        # check that shard assignment doesn't depend on python's randomized hash
+        self.assertEqual(
+            [get_shard(vsn, 4) for vsn in ["W01A", "W01B", "W023", "V008"]],
+            [3, 1, 0, 3],
+        )
+
+    def test_select_nodes(self):
+        nodes = [
+            Node(id="a", vsn="W01A", type="wsn", devices={"nxcore", "rpi"}),
+            Node(id="b", vsn="W01B", type="wsn", devices={"nxcore"}),
+            Node(id="c", vsn="V001", type="dell", devices={"dell"}),
+        ]
+
+        def vsns(nodes):
+            return [node.vsn for node in nodes]
+
+        self.assertEqual(vsns(select_nodes(nodes)), ["W01A", "W01B", "V001"])
+        self.assertEqual(vsns(select_nodes(nodes, vsns=["W01B"])), ["W01B"])
+        self.assertEqual(vsns(select_nodes(nodes, node_types=["dell"])), ["V001"])
+        self.assertEqual(vsns(select_nodes(nodes, devices=["rpi", "dell"])), ["W01A", "V001"])
+        self.assertEqual(
+            vsns(select_nodes(nodes, node_types=["wsn"], devices=["nxcore"])),
+            ["W01A", "W01B"],
+        )
+        self.assertEqual(select_nodes(nodes, vsns=["W01A"], devices=["dell"]), [])
+
+    def test_query_adaptive(self):
+        timestamps = pd.date_range("2021-10-11 10:00:00", "2021-10-11 11:00:00", freq="10s", tz="UTC", inclusive="left")
+        data = pd.DataFrame({"timestamp": timestamps, "value": range(len(timestamps))})
+        calls = []
+
+        # simulate a query api which fails for windows larger than 15min
+        def query(start, end, **kwargs):
+            calls.append((start, end))
+            if end - start > pd.Timedelta("15min"):
+                raise requests.exceptions.ReadTimeout("timeout")
+            return data[(start <= data.timestamp) & (data.timestamp < end)]
+
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 11:00:00")
+
+        with patch("sage_data_client.query", side_effect=query), patch("time.sleep") as sleep:
+            df = query_adaptive(start, end, retries=1)
+
+        pd.testing.assert_frame_equal(df, data)
+        # each window larger than 15min is tried twice before being split
+        self.assertEqual(calls[:2], [(start, end), (start, end)])
+        self.assertEqual(len(calls), 2 + 2 * 2 + 4)
+        self.assertEqual(sleep.call_count, 3)
+
+        with patch("sage_data_client.query", side_effect=query), patch("time.sleep"):
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                query_adaptive(start, end, retries=0, min_window=pd.Timedelta("30min"))
+
+    def test_query_adaptive_tail(self):
+        timestamps = pd.date_range("2021-10-11 10:00:00", "2021-10-11 11:00:00", freq="10min", tz="UTC", inclusive="left")
+        data = pd.DataFrame(
+            {
+                "timestamp": timestamps.repeat(2),
+                "name": ["sys.uptime", "env.temperature"] * len(timestamps),
+                "value": range(2 * len(timestamps)),
+                "meta.vsn": "W01A",
+            }
+        )
+        calls = []
+
+        # simulate a query api which fails for windows larger than 15min and applies tail per series
+        def query(start, end, tail=None, **kwargs):
+            calls.append((start, end))
+            if end - start > pd.Timedelta("15min"):
+                raise requests.exceptions.ReadTimeout("timeout")
+            df = data[(start <= data.timestamp) & (data.timestamp < end)]
+            return df.groupby(["name", "meta.vsn"], sort=False).tail(tail)
+
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 11:00:00")
+
+        with patch("sage_data_client.query", side_effect=query), patch("time.sleep"):
+            df = query_adaptive(start, end, retries=0, tail=1)
+
+        # the split query still returns only the last record of each series
+        self.assertGreater(len(calls), 1)
+        pd.testing.assert_frame_equal(df, data.tail(2).reset_index(drop=True))
+
+    def test_query_adaptive_errors(self):
+        start = datetime("2021-10-11 10:00:00")
+        end = datetime("2021-10-11 11:00:00")
+        data = pd.DataFrame({"timestamp": [start], "value": [1]})
+
+        def http_error(status):
+            return urllib.error.HTTPError(SAGE_QUERY_URL, status, "error", {}, None)
+
+        def query_failing_with(exc):
+            calls = []
+
+            def query(start, end, **kwargs):
+                calls.append((start, end))
+                # only the first call fails
+                if len(calls) == 1:
+                    raise exc
+                return data
+
+            return calls, query
+
+        # bad queries and unparsable responses fail immediately
+        for exc in [http_error(400), http_error(404), ValueError("bad json")]:
+            calls, query = query_failing_with(exc)
+            with patch("sage_data_client.query", side_effect=query), patch("time.sleep"):
+                with self.assertRaises(type(exc)):
+                    query_adaptive(start, end)
+            self.assertEqual(len(calls), 1, exc)
+
+        # transient errors are retried on the same window
+        for exc in [http_error(503), http_error(429), TimeoutError(), requests.exceptions.ConnectionError()]:
+            calls, query = query_failing_with(exc)
+            with patch("sage_data_client.query", side_effect=query), patch("time.sleep"):
+                query_adaptive(start, end)
+            self.assertEqual(calls, [(start, end), (start, end)], exc)
+
+        # oversized responses are split without retrying
+        for exc in [http_error(413), MemoryError()]:
+            calls, query = query_failing_with(exc)
+            with patch("sage_data_client.query", side_effect=query), patch("time.sleep"):
+                query_adaptive(start, end)
+            self.assertEqual(len(calls), 3, exc)
+            self.assertEqual(calls[1], (start, datetime("2021-10-11 10:30:00")))
+
+    def test_http_get_retries(self):
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.headers.get("Accept-Encoding"))
+                # fail first request to check that it's retried
+                if len(requests_seen) == 1:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                body = b'{"ok": true}'
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        with HTTPServer(("127.0.0.1", 0), Handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                r = http_get(f"http://127.0.0.1:{server.server_port}/")
+            finally:
+                server.shutdown()
+
+        self.assertEqual(r.json(), {"ok": True})
+        self.assertEqual(len(requests_seen), 2)
+        self.assertEqual(requests_seen[0], "gzip")
+
+    def test_stream_records_reconnects(self):
+        starts_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                starts_seen.append(parse_qs(urlparse(self.path).query).get("start"))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                # each connection sends two records and then drops
+                for i in range(2):
+                    timestamp = f"2022-01-01T00:0{len(starts_seen)}:0{i}+00:00"
+                    self.wfile.write(f"data: {json.dumps({'timestamp': timestamp})}\n\n".encode())
+
+            def log_message(self, *args):
+                pass
+
+        with HTTPServer(("127.0.0.1", 0), Handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with patch("time.sleep") as sleep:
+                    items = stream_records(endpoint=f"http://127.0.0.1:{server.server_port}/")
+                    got = [item["timestamp"] for item in islice(items, 4)]
+                    items.close()
+            finally:
+                server.shutdown()
+
+        self.assertEqual(
+            got,
+            [
+                "2022-01-01T00:01:00+00:00",
+                "2022-01-01T00:01:01+00:00",
+                "2022-01-01T00:02:00+00:00",
+                "2022-01-01T00:02:01+00:00",
+            ],
+        )
+        # the stream is resumed from the latest record seen after a backoff
+        self.assertEqual(starts_seen, [None, ["2022-01-01T00:01:01+00:00"]])
+        sleep.assert_called_once_with(1.0)
+
+    def test_http_get_closes_failed_stream(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = b'{"error": "not found"}'
+                self.send_response(404)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        with HTTPServer(("127.0.0.1", 0), Handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                with self.assertRaises(requests.exceptions.HTTPError) as cm:
+                    http_get(f"http://127.0.0.1:{server.server_port}/", stream=True)
+            finally:
+                server.shutdown()
+
+        self.assertTrue(cm.exception.response.raw.closed)
+
+    def test_iter_json_object_items(self):
+        doc = {
+            "W01A": [{"meta": {"deployment": "imagesampler-top"}}, {"meta": {"deployment": None}}],
+            "W01B": [],
+            "count": 12500.0,
+            "exp": -1.5e-7,
+            "str": "has } and , in it",
+            "nested": {"a": {"b": [True, False, None]}},
+        }
+        for text in [json.dumps(doc), json.dumps(doc, indent=2)]:
+            # check that values split across any chunk boundary are parsed
+            for n in [1, 2, 3, 7, len(text)]:
+                chunks = [text[i : i + n] for i in range(0, len(text), n)]
+                self.assertEqual(dict(iter_json_object_items(chunks)), doc)
+
+        self.assertEqual(list(iter_json_object_items([" {", " } "])), [])
+
+        # large values split across many chunks are only decoded a few times
+        text = json.dumps({"W01A": [{"meta": {"vsn": "W01A", "i": i}} for i in range(2000)]})
+        raw_decode = json.JSONDecoder.raw_decode
+        with patch.object(
+            json.JSONDecoder, "raw_decode", autospec=True, side_effect=raw_decode
+        ) as decode:
+            items = dict(iter_json_object_items(text[i : i + 16] for i in range(0, len(text), 16)))
+        self.assertEqual(items, json.loads(text))
+        self.assertLess(decode.call_count, 40)
+
+        with self.assertRaises(ValueError):
+            list(iter_json_object_items(['{"a": 1 "b": 2}']))
+
+    def test_profiler(self):
+        profiler = Profiler()
+
+        # disabled profiler should keep totals without logging
+        with self.assertNoLogs(level="INFO"):
+            with profiler.stage("query") as stage:
+                stage["rows"] = 10
+        self.assertEqual(profiler.totals["query"][0], 1)
+        self.assertEqual(profiler.totals["query"][2], 10)
+
+        # stages start with zero rows, so counting rows works with profiling off
+        with profiler.stage("load") as stage:
+            for _ in range(3):
+                stage["rows"] += 1
+        with profiler.stage("publish"):
+            pass
+        self.assertEqual(profiler.totals["load"][2], 3)
+        self.assertEqual(profiler.totals["publish"], [1, profiler.totals["publish"][1], 0])
+
+        profiler = Profiler()
+        profiler.enable()
+
+        with self.assertLogs(level="INFO") as logs:
+            with profiler.stage("window", window="2021-10-11"):
+                with profiler.stage("query") as stage:
+                    stage["rows"] = 10
+                with profiler.stage("query") as stage:
+                    stage["rows"] = 5
+
+        # nested stages inherit labels from their parent stages
+        self.assertIn("profile stage=query window=2021-10-11 duration=", logs.output[0])
+        self.assertIn(" rows=10 ", logs.output[0])
+        self.assertEqual(profiler.totals["query"][0], 2)
+        self.assertEqual(profiler.totals["query"][2], 15)
+        self.assertEqual(profiler.totals["window"][0], 1)
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "profile.prom")
+            profiler.write_textfile(path, "test")
+            text = path.read_text()
+
+        self.assertIn('node_health_reporter_stage_rows_total{script="test",stage="query"} 15\n', text)
+        self.assertIn('node_health_reporter_stage_runs_total{script="test",stage="window"} 1\n', text)
+        self.assertIn('node_health_reporter_peak_rss_bytes{script="test"} ', text)
+
+    def test_get_reporter_run_record(self):
+        timestamp = pd.to_datetime("2021-10-11 10:00:00", utc=True)
+
+        with patch("utils.profiler", Profiler()) as profiler:
+            for rows in [100, 200]:
+                with profiler.stage("window"):
+                    with profiler.stage("query") as stage:
+                        stage["rows"] = rows
+                    with profiler.stage("write") as stage:
+                        stage["rows"] = rows // 10
+
+            record = get_reporter_run_record("rollup_plugin_counts", timestamp, shard=(1, 4))
+
+        self.assertEqual(record["measurement"], "reporter_run")
+        self.assertEqual(record["tags"], {"script": "rollup_plugin_counts", "shard": "1/4"})
+        self.assertEqual(record["timestamp"], timestamp)
+        fields = record["fields"]
+        self.assertEqual(fields["query_count"], 2)
+        self.assertEqual(fields["rows_fetched"], 300)
+        self.assertEqual(fields["records_written"], 30)
+        self.assertEqual(fields["windows"], 2)
+        self.assertGreaterEqual(fields["duration_seconds"], fields["query_duration_seconds"])
+        self.assertGreater(fields["peak_rss_bytes"], 0)
+
+    def test_write_spool(self):
+        timestamp = pd.to_datetime("2021-10-11 10:00:00", utc=True)
+        records = [
+            {
+                "measurement": "total",
+                "tags": {"vsn": vsn},
+                "fields": {"value": 1},
+                "timestamp": timestamp,
+            }
+            for vsn in ["W01A", "W01B"]
+        ]
+        influxdb = {"url": "http://localhost:8086", "token": "token", "org": "waggle"}
+
+        with TemporaryDirectory() as dir, WriteIndex(Path(dir, "index.db")) as index:
+            spool = WriteSpool(Path(dir, "spool"))
+
+            # failed writes are kept in the spool and not marked as written
+            with patch("utils.write_lines_to_influxdb", side_effect=ConnectionError("down")):
+                write_results_to_influxdb(**influxdb, bucket="plugin-stats", records=records, index=index, spool=spool)
+            segments = spool.get_segments()
+            self.assertEqual(len(segments), 1)
+            bucket, segment = segments[0]
+            self.assertEqual(bucket, "plugin-stats")
+            self.assertEqual(spool.get_attempts(segment), 1)
+            self.assertEqual(
+                spool.read(segment),
+                ["total,vsn=W01A value=1i 1633946400", "total,vsn=W01B value=1i 1633946400"],
+            )
+            self.assertEqual(len(index.get_changed_records("plugin-stats", records)), 2)
+
+            # segments are not replayed until their backoff has elapsed
+            self.assertFalse(spool.is_due(segment))
+            self.assertTrue(spool.is_due(segment, now=segment.stat().st_mtime + 300))
+            with patch("utils.write_lines_to_influxdb", return_value=[]) as write:
+                replay_spool(**influxdb, spool=spool)
+            write.assert_not_called()
+
+            os.utime(segment, (0, 0))
+            with patch("utils.write_lines_to_influxdb", return_value=[]) as write:
+                replay_spool(**influxdb, spool=spool, index=index)
+            write.assert_called_once_with(
+                influxdb["url"],
+                influxdb["token"],
+                influxdb["org"],
+                "plugin-stats",
+                ["total,vsn=W01A value=1i 1633946400", "total,vsn=W01B value=1i 1633946400"],
+            )
+            self.assertEqual(spool.get_segments(), [])
+            self.assertEqual(list(Path(dir, "spool", "plugin-stats").iterdir()), [])
+
+            # replayed records are marked as written
+            self.assertEqual(index.get_changed_records("plugin-stats", records), [])
+
+            # successful writes are removed from the spool
+            for r in records:
+                r["fields"]["value"] = 2
+            with patch("utils.write_lines_to_influxdb", return_value=[]) as write:
+                write_results_to_influxdb(**influxdb, bucket="plugin-stats", records=records, index=index, spool=spool)
+            write.assert_called_once()
+            self.assertEqual(spool.get_segments(), [])
+            self.assertEqual(list(Path(dir, "spool", "plugin-stats").iterdir()), [])
+            self.assertEqual(index.get_changed_records("plugin-stats", records), [])
+
+    def test_write_spool_limit(self):
+        with TemporaryDirectory() as dir:
+            spool = WriteSpool(Path(dir, "spool"), max_bytes=1024)
+            for i in range(10):
+                spool.append("health", [f"m,vsn=W{i:03d} value={j}i {j}" for j in range(100)])
+            segments = spool.get_segments()
+            self.assertLess(len(segments), 10)
+            self.assertLessEqual(sum(p.stat().st_size for _, p in segments), 1024)
+            # oldest segments are dropped first
+            self.assertEqual(spool.read(segments[-1][1])[0], "m,vsn=W009 value=0i 0")
+
+    def write_replay_file(self, path):
+        records = []
+        for i in range(6):
+            timestamp = f"2022-01-01T10:{i * 10:02d}:00Z"
+            for node, vsn in [("000048b02d15bc7c", "W01A"), ("000048b02d15bc7d", "W01B")]:
+                records.append(
+                    {
+                        "timestamp": timestamp,
+                        "name": "env.temperature",
+                        "value": 20.0 + i,
+                        "meta": {"node": node, "vsn": vsn, "sensor": "bme280"},
+                    }
+                )
+            records.append(
+                {
+                    "timestamp": timestamp,
+                    "name": "upload",
+                    "value": f"https://storage.sagecontinuum.org/{i}.jpg",
+                    "meta": {"node": "000048b02d15bc7c", "vsn": "W01A", "task": "imagesampler-top"},
+                }
+            )
+        path.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+    def test_replay_data_source(self):
+        start = datetime("2022-01-01 10:00:00")
+        end = datetime("2022-01-01 11:00:00")
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "data.ndjson")
+            self.write_replay_file(path)
+            source = ReplayDataSource(path)
+
+            df = source.query(start, datetime("2022-01-01 10:30:00"))
+            self.assertEqual(len(df), 9)
+            self.assertEqual(str(df["timestamp"].dtype), "datetime64[ns, UTC]")
+
+            # filters are regular expressions which must match the whole value
+            df = source.query(start, end, filter={"name": "env.*", "vsn": "W01B"})
+            self.assertEqual(len(df), 6)
+            self.assertEqual(set(df["meta.vsn"]), {"W01B"})
+            self.assertNotIn("meta.task", df.columns)
+            self.assertEqual(len(source.query(start, end, filter={"vsn": "W01"})), 0)
+            self.assertEqual(len(source.query(start, end, filter={"camera": ".*"})), 0)
+
+            # tail applies to each series
+            df = source.query(start, end, tail=1)
+            self.assertEqual(len(df), 3)
+            self.assertEqual(set(df["timestamp"]), {datetime("2022-01-01 10:50:00")})
+
+            df = source.query(start, end, filter={"name": "upload"}, experimental_func="count")
+            self.assertEqual(df[["timestamp", "name", "value"]].values.tolist(), [[start, "upload", 6]])
+            self.assertEqual(df["meta.task"].tolist(), ["imagesampler-top"])
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_arrow_cache_data_source(self):
+        start = datetime("2022-01-01 10:00:00")
+        end = datetime("2022-01-01 11:00:00")
+
+        with TemporaryDirectory() as dir:
+            path = Path(dir, "data.ndjson")
+            self.write_replay_file(path)
+            source = ReplayDataSource(path)
+            cache = ArrowCacheDataSource(Path(dir, "cache"), source)
+
+            want = source.query(start, end)
+            with patch.object(source, "query", wraps=source.query) as query:
+                # the first query fills the cache and later ones are read from it
+                for _ in range(2):
+                    df = cache.query(start, end)
+                    # missing meta fields come back as None rather than NaN
+                    pd.testing.assert_frame_equal(df.fillna(""), want.fillna(""))
+                    self.assertEqual(df["value"].map(type).tolist(), want["value"].map(type).tolist())
+                self.assertEqual(query.call_count, 1)
+
+                # different queries are cached separately
+                df = cache.query(start, end, filter={"name": "upload"})
+                self.assertEqual(len(df), 6)
+                self.assertEqual(query.call_count, 2)
+
+            # recent windows aren't cached since more data may arrive
+            now = pd.Timestamp.now(tz="UTC").floor("1s")
+            cache.query(now - pd.Timedelta("1h"), now)
+            self.assertEqual(len(list(Path(dir, "cache").glob("*.arrow"))), 2)
+
+            # the same query of a different source isn't answered from the cache
+            other = Path(dir, "other.ndjson")
+            other.write_text("")
+            cache = ArrowCacheDataSource(Path(dir, "cache"), ReplayDataSource(other))
+            with patch("sage_data_client.load", return_value=want.iloc[:0]) as load:
+                self.assertEqual(len(cache.query(start, end)), 0)
+            self.assertEqual(load.call_count, 1)
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "requires pyarrow")
+    def test_arrow_table_keeps_value_types(self):
+        timestamps = pd.to_datetime(["2022-01-01 10:00:00"] * 5, utc=True)
+
+        # mixed values keep their types, including ints next to nulls
+        df = pd.DataFrame(
+            {
+                "timestamp": timestamps,
+                "name": ["sys.uptime", "env.temperature", "sys.gps.fix", "upload", "sys.uptime"],
+                "value": pd.Series([12, 20.5, True, "https://storage.sagecontinuum.org/0.jpg", None], dtype=object),
+                "meta.vsn": ["W01A", "W01A", None, "W01A", "W01A"],
+            }
+        )
+        got = get_frame_from_arrow(get_arrow_table(df))
+        pd.testing.assert_frame_equal(got, df)
+        self.assertEqual([type(v) for v in got["value"]], [int, float, bool, str, type(None)])
+
+        # values of a single type, such as counts, keep their column type
+        df = pd.DataFrame({"timestamp": timestamps[:2], "name": ["upload", "upload"], "value": [6, 7]})
+        pd.testing.assert_frame_equal(get_frame_from_arrow(get_arrow_table(df)), df)
+
+    def test_data_source_is_abstract(self):
+        with self.assertRaises(TypeError):
+            DataSource()
+
+    def test_fleet(self):
+        nodes = [
+            Node(id="000048b02d15bc7c", vsn="W01A", type="wsn", devices={"nxcore", "bme280", "top_camera"}),
+            Node(id="000048b02d15bc7d", vsn="W01B", type="wsn", devices={"nxcore", "rpi"}),
+            Node(id="000048b02d15bc7e", vsn="V008", type="dell", devices={"dell", "new_device"}),
+        ]
+        fleet = Fleet(nodes)
+
+        self.assertEqual(list(fleet.vsns), ["W01A", "W01B", "V008"])
+        self.assertEqual(fleet.matrix.shape, (3, len(fleet.devices)))
+        # devices follow the column order and unknown devices are kept
+        self.assertEqual(fleet.get_node_devices(0), ["nxcore", "bme280", "top_camera"])
+        self.assertEqual(fleet.get_node_devices(2), ["dell", "new_device"])
+        self.assertEqual(list(fleet.get_device_mask({"rpi", "dell"})), [False, True, True])
+        self.assertEqual(list(fleet.get_device_mask({"unknown"})), [False, False, False])
+
+        df = fleet.get_device_frame(fleet.types == "wsn")
+        self.assertEqual(
+            list(zip(df["meta.vsn"], df["device"])),
+            [("W01A", "nxcore"), ("W01A", "bme280"), ("W01A", "top_camera"), ("W01B", "nxcore"), ("W01B", "rpi")],
+        )
+
+        with self.assertRaises(AttributeError):
+            nodes[0].extra = True
+
+    def test_lazy_imports(self):
+        # heavy clients should only be imported by the code paths which use them
+        for module in ["utils", "rollup_daily_and_weekly", "report_results"]:
+            output = subprocess.check_output(
+                [
+                    sys.executable,
+                    "-c",
+                    f"import sys, {module}; print(sorted(set(sys.modules) & {{'influxdb_client', 'sage_data_client', 'slack'}}))",
+                ],
+                text=True,
+            )
+            self.assertEqual(output.strip(), "[]", module)
+
 
 if __name__ == "__main__":
     unittest.main()
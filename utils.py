@@ -1,17 +1,610 @@
-import influxdb_client
-from influxdb_client.client.write_api import (
-    WriteOptions,
-    WritePrecision,
-    Point,
-    WriteType,
-)
+import numpy as np
 import pandas as pd
-import requests
 from dataclasses import dataclass
+from pathlib import Path
+import codecs
+import gzip
+import hashlib
+import json
+import logging
+import numbers
+import os
+import re
+import resource
+import sqlite3
+import sys
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+import zlib
 
+# NOTE influxdb_client, pyarrow, requests and sage_data_client are imported by the functions which
+# use them. they're slow to import and many runs, such as dry runs, check_nodes.py and
+# rollup_daily_and_weekly.py, only need some of them.
 
-def write_results_to_influxdb(url, token, org, bucket, records):
-    data = []
+# base urls of the services we depend on. they can be overridden to point at the stand-in
+# services in local_services.py for offline benchmarks.
+SAGE_DATA_URL = os.getenv("SAGE_DATA_URL", "https://data.sagecontinuum.org")
+SAGE_API_URL = os.getenv("SAGE_API_URL", "https://api.sagecontinuum.org")
+SAGE_SCHEDULER_URL = os.getenv("SAGE_SCHEDULER_URL", "https://es.sagecontinuum.org")
+SAGE_PORTAL_URL = os.getenv("SAGE_PORTAL_URL", "https://portal.sagecontinuum.org")
+SAGE_QUERY_URL = f"{SAGE_DATA_URL}/api/v1/query"
+
+
+class Profiler:
+    """
+    Profiler records the wall time, rows processed and peak RSS of each stage of a run. Stages
+    can be nested and inherit the labels, such as the window, of the stages they're in. Stage
+    totals are always kept for the reporter_run record, but stages are only logged when enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = time.perf_counter()
+        self.labels = [{}]
+        # stage -> [count, duration, rows]
+        self.totals = {}
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def stage(self, name, **labels):
+        stats = {"rows": 0}
+        start = time.perf_counter()
+
+        if not self.enabled:
+            try:
+                yield stats
+            finally:
+                self.add_totals(name, time.perf_counter() - start, stats["rows"])
+            return
+
+        labels = {**self.labels[-1], **labels}
+        self.labels.append(labels)
+        try:
+            yield stats
+        finally:
+            duration = time.perf_counter() - start
+            self.labels.pop()
+            logging.info(
+                "profile %s",
+                " ".join(
+                    f"{k}={v}"
+                    for k, v in {
+                        "stage": name,
+                        **labels,
+                        "duration": f"{duration:0.3f}",
+                        "rows": stats["rows"],
+                        "peak_rss_bytes": get_peak_rss_bytes(),
+                    }.items()
+                ),
+            )
+            self.add_totals(name, duration, stats["rows"])
+
+    def add_totals(self, name, duration, rows):
+        totals = self.totals.setdefault(name, [0, 0.0, 0])
+        totals[0] += 1
+        totals[1] += duration
+        totals[2] += rows
+
+    def get_totals(self, name):
+        return self.totals.get(name, [0, 0.0, 0])
+
+    def write_textfile(self, path, script):
+        """
+        Writes the stage totals in Prometheus textfile format. The file is written atomically so
+        it can be read by the node exporter's textfile collector.
+        """
+        lines = []
+        for i, metric in enumerate(["runs", "duration_seconds", "rows"]):
+            lines.append(f"# TYPE node_health_reporter_stage_{metric}_total counter")
+            for name, totals in sorted(self.totals.items()):
+                lines.append(
+                    f'node_health_reporter_stage_{metric}_total{{script="{script}",stage="{name}"}} {totals[i]}'
+                )
+        lines.append("# TYPE node_health_reporter_peak_rss_bytes gauge")
+        lines.append(
+            f'node_health_reporter_peak_rss_bytes{{script="{script}"}} {get_peak_rss_bytes()}'
+        )
+
+        tmp = Path(f"{path}.tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+
+def get_reporter_run_record(script, timestamp, shard=None):
+    """
+    Returns a reporter_run record describing this run of script from the profiler's stage totals,
+    so the reporter's own performance can be charted alongside the fleet health it reports.
+    """
+    query_count, query_duration, rows_fetched = profiler.get_totals("query")
+    _, _, records_written = profiler.get_totals("write")
+    windows, _, _ = profiler.get_totals("window")
+
+    tags = {"script": script}
+    # sharded runs start at the same time, so they must be tagged to be kept apart
+    if shard is not None:
+        tags["shard"] = "%d/%d" % shard
+
+    return {
+        "measurement": "reporter_run",
+        "tags": tags,
+        "fields": {
+            "duration_seconds": time.perf_counter() - profiler.started,
+            "query_count": query_count,
+            "query_duration_seconds": query_duration,
+            "rows_fetched": rows_fetched,
+            "records_written": records_written,
+            "windows": windows,
+            "peak_rss_bytes": get_peak_rss_bytes(),
+        },
+        "timestamp": timestamp,
+    }
+
+
+def get_peak_rss_bytes():
+    # NOTE ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+profiler = Profiler()
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="log wall time, rows processed and peak memory of each stage",
+    )
+    parser.add_argument(
+        "--profile-textfile",
+        default=None,
+        type=Path,
+        help="also write stage totals to this prometheus textfile. implies --profile.",
+    )
+
+
+def enable_profiling(args):
+    if args.profile or args.profile_textfile is not None:
+        profiler.enable()
+
+
+def write_profile_textfile(args, script):
+    if args.profile_textfile is not None:
+        profiler.write_textfile(args.profile_textfile, script)
+
+
+session = None
+
+
+def get_session():
+    """
+    Returns the shared HTTP session used for all reference data fetches. It pools connections,
+    requests gzip responses and retries failed requests with backoff.
+    """
+    global session
+    if session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=8, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Accept-Encoding"] = "gzip"
+    return session
+
+
+def http_get(url, timeout=60, **kwargs):
+    """
+    Makes a GET request to url using the shared session and logs its latency. For streamed
+    requests, the latency is only until the response headers are received.
+    """
+    start = time.monotonic()
+    r = get_session().get(url, timeout=timeout, **kwargs)
+    if kwargs.get("stream"):
+        logging.info(
+            "GET %s %d streaming after %0.3fs",
+            url,
+            r.status_code,
+            time.monotonic() - start,
+        )
+    else:
+        logging.info(
+            "GET %s %d %d bytes in %0.3fs",
+            url,
+            r.status_code,
+            len(r.content),
+            time.monotonic() - start,
+        )
+    # streamed responses hold their connection until closed, so failed ones are closed here as
+    # callers never get them
+    if not r.ok:
+        r.close()
+    r.raise_for_status()
+    return r
+
+
+def iter_response_text(r, chunk_size=65536):
+    """
+    Yields the decoded text of a streamed response in chunks.
+    """
+    decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")()
+    for chunk in r.iter_content(chunk_size=chunk_size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def iter_json_object_items(chunks):
+    """
+    Incrementally parses a top level JSON object from an iterable of text chunks and yields its
+    (key, value) items. Only the item being parsed is held in memory rather than the whole object.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+
+    def fill(size=1):
+        """
+        Buffers chunks until at least size more characters have arrived or the chunks run out.
+        Returns whether any arrived.
+        """
+        nonlocal buf, pos
+        parts = [buf[pos:]]
+        n = 0
+        for chunk in chunks:
+            parts.append(chunk)
+            n += len(chunk)
+            if n >= size:
+                break
+        buf = "".join(parts)
+        pos = 0
+        return n > 0
+
+    def skip_whitespace():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or not fill():
+                return
+
+    def expect(chars):
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError(f"invalid json object. expected one of {chars!r}")
+        pos += 1
+        return buf[pos - 1]
+
+    def decode():
+        nonlocal pos
+        skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # the value continues in later chunks. rather than decoding it from the start again
+                # after every chunk, we wait until as much again has arrived, so values spanning
+                # many chunks are decoded in linear time overall.
+                if not fill(len(buf) - pos):
+                    raise
+                continue
+            # values like numbers may continue in the next chunk, so we only accept a value once
+            # we've seen the delimiter following it
+            if (end == len(buf) or buf[end] not in " \t\r\n,:}]") and fill():
+                continue
+            pos = end
+            return value
+
+    expect("{")
+    skip_whitespace()
+    if buf[pos : pos + 1] == "}":
+        return
+
+    while True:
+        key = decode()
+        expect(":")
+        yield key, decode()
+        if expect(",}") == "}":
+            return
+
+
+class WriteIndex:
+    """
+    WriteIndex is a local index of the last value written for each (bucket, measurement,
+    tag set, timestamp) point. It's used to skip rewriting unchanged points when rollups
+    are re-run over windows they've already written.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.suppressed = 0
+
+        # read-only indexes are used by dry runs, which must not create or change the index
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{Path(path).absolute()}?mode=ro", uri=True)
+            return
+
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS written (
+                bucket TEXT NOT NULL,
+                measurement TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                timestamp INTEGER NOT NULL,
+                fields TEXT NOT NULL,
+                PRIMARY KEY (bucket, measurement, tags, timestamp)
+            )
+            """
+        )
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_changed_records(self, bucket, records):
+        """
+        Returns the records whose fields differ from the last value written to bucket.
+        """
+        changed = []
+        for r in records:
+            key, fields = get_write_index_key(bucket, r)
+            row = self.conn.execute(
+                "SELECT fields FROM written WHERE bucket=? AND measurement=? AND tags=? AND timestamp=?",
+                key,
+            ).fetchone()
+            if row is not None and row[0] == fields:
+                self.suppressed += 1
+                continue
+            changed.append(r)
+        return changed
+
+    def get_totals_by_tags(self, bucket, measurement, start, end):
+        """
+        Returns a map of serialized tag set -> sum of the value field written to bucket for
+        measurement with a timestamp in [start, end).
+        """
+        totals = {}
+        rows = self.conn.execute(
+            "SELECT tags, fields FROM written WHERE bucket=? AND measurement=? AND timestamp>=? AND timestamp<?",
+            (bucket, measurement, int(start.timestamp()), int(end.timestamp())),
+        )
+        for tags, fields in rows:
+            totals[tags] = totals.get(tags, 0) + int(json.loads(fields)["value"])
+        return totals
+
+    def get_frame(self, bucket, measurements, start, end):
+        """
+        Returns a DataFrame of the points last written to bucket for measurements with a
+        timestamp in [start, end). Tags are kept in their serialized form.
+        """
+        placeholders = ",".join("?" for _ in measurements)
+        df = pd.read_sql_query(
+            f"SELECT measurement, tags, timestamp, fields FROM written WHERE bucket=? AND measurement IN ({placeholders}) AND timestamp>=? AND timestamp<?",
+            self.conn,
+            params=(bucket, *measurements, int(start.timestamp()), int(end.timestamp())),
+        )
+        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", utc=True)
+        df["value"] = pd.to_numeric(
+            df["fields"].map(lambda s: json.loads(s)["value"]), errors="coerce"
+        )
+        return df.drop(columns="fields")
+
+    def update(self, bucket, records):
+        self.update_rows(get_write_index_rows(bucket, records))
+
+    def update_rows(self, rows):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO written VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+
+def open_write_index(path, dry_run=False):
+    """
+    Opens the write index at path, or returns None if path is None. Dry runs open the index
+    read-only, or not at all if it doesn't exist yet, so they have no side effects.
+    """
+    if path is None:
+        return None
+    if dry_run:
+        if not Path(path).exists():
+            return None
+        return WriteIndex(path, readonly=True)
+    return WriteIndex(path)
+
+
+def parse_write_index_tags(s):
+    return json.loads(s)
+
+
+def get_write_index_key(bucket, r):
+    tags = json.dumps(r["tags"], sort_keys=True)
+    fields = json.dumps({k: str(v) for k, v in r["fields"].items()}, sort_keys=True)
+    return (bucket, r["measurement"], tags, int(r["timestamp"].timestamp())), fields
+
+
+def get_write_index_rows(bucket, records):
+    rows = []
+    for r in records:
+        key, fields = get_write_index_key(bucket, r)
+        rows.append((*key, fields))
+    return rows
+
+
+class WriteSpool:
+    """
+    WriteSpool is a local write-ahead spool of records waiting to be written to InfluxDB. Each
+    write is kept as a gzipped line protocol segment until it succeeds, so records from a failed
+    write can be replayed on a later run instead of being recomputed.
+
+    Segments are stored as <bucket>/<seq>-<attempts>.lp.gz. Failed segments are retried with
+    exponential backoff from the time of their last attempt. If the spool grows past max_bytes,
+    the oldest segments are dropped as they can still be recomputed. The write index rows of a
+    segment's records are kept alongside it as <bucket>/<seq>.index.json.gz, so replayed records
+    can be marked as written.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=4 * 1024 * 1024,
+        backoff=pd.Timedelta("5min"),
+        max_backoff=pd.Timedelta("6h"),
+    ):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def append(self, bucket, lines, index_rows=None):
+        dir = self.path / bucket
+        dir.mkdir(exist_ok=True)
+        seq = f"{time.time_ns():020d}"
+        # index rows are written first, so a segment never exists without them
+        if index_rows is not None:
+            self.write_file(dir / f"{seq}.index.json.gz", json.dumps(index_rows))
+        segment = dir / f"{seq}-0.lp.gz"
+        self.write_file(segment, "\n".join(lines))
+        self.drop_oldest_segments()
+        return segment
+
+    def write_file(self, path, text):
+        tmp = path.with_suffix(".tmp")
+        with gzip.open(tmp, "wt") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def read(self, segment):
+        with gzip.open(segment, "rt") as f:
+            return f.read().splitlines()
+
+    def get_index_path(self, segment):
+        seq = segment.name.split("-")[0]
+        return segment.with_name(f"{seq}.index.json.gz")
+
+    def read_index_rows(self, segment):
+        """
+        Returns the write index rows of segment's records, or an empty list if none were kept.
+        """
+        try:
+            with gzip.open(self.get_index_path(segment), "rt") as f:
+                return [tuple(row) for row in json.load(f)]
+        except FileNotFoundError:
+            return []
+
+    def remove(self, segment):
+        segment.unlink(missing_ok=True)
+        self.get_index_path(segment).unlink(missing_ok=True)
+
+    def get_segments(self):
+        """
+        Returns (bucket, segment) for each spooled segment, oldest first.
+        """
+        segments = [(p.name, p.parent.name, p) for p in self.path.glob("*/*.lp.gz")]
+        return [(bucket, p) for _, bucket, p in sorted(segments)]
+
+    def get_attempts(self, segment):
+        return int(segment.name.split(".")[0].split("-")[1])
+
+    def mark_failed(self, segment):
+        """
+        Records a failed attempt to write segment. The file's mtime is used as the time of the
+        last attempt.
+        """
+        seq = segment.name.split("-")[0]
+        failed = segment.with_name(f"{seq}-{self.get_attempts(segment) + 1}.lp.gz")
+        os.replace(segment, failed)
+        failed.touch()
+        return failed
+
+    def is_due(self, segment, now=None):
+        attempts = self.get_attempts(segment)
+        if attempts == 0:
+            return True
+        if now is None:
+            now = time.time()
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return now >= segment.stat().st_mtime + delay.total_seconds()
+
+    def drop_oldest_segments(self):
+        segments = self.get_segments()
+        total = sum(p.stat().st_size for _, p in segments)
+        for bucket, p in segments:
+            if total <= self.max_bytes:
+                break
+            logging.warning("spool is full. dropping oldest segment %s for %s", p.name, bucket)
+            total -= p.stat().st_size
+            self.remove(p)
+
+
+def write_lines_to_influxdb(url, token, org, bucket, lines, client=None):
+    """
+    Writes line protocol lines to bucket and returns the errors reported by the batched writer.
+    A client is created for the write unless an open one is given.
+    """
+    import influxdb_client
+    from influxdb_client.client.write_api import WriteOptions, WritePrecision
+
+    # batched writes report errors through a callback rather than raising, so we track them
+    # to avoid marking failed points as written.
+    errors = []
+
+    def error_callback(conf, data, exc):
+        errors.append(exc)
+
+    if client is None:
+        client_context = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+    else:
+        client_context = nullcontext(client)
+
+    with profiler.stage("write", bucket=bucket) as stage, client_context as client, client.write_api(
+        write_options=WriteOptions(batch_size=10000), error_callback=error_callback
+    ) as write_api:
+        write_api.write(
+            bucket=bucket, org=org, record=lines, write_precision=WritePrecision.S
+        )
+        stage["rows"] = len(lines)
+
+    return errors
+
+
+def write_results_to_influxdb(
+    url, token, org, bucket, records, index=None, spool=None, client=None
+):
+    if index is not None:
+        total = len(records)
+        records = index.get_changed_records(bucket, records)
+        logging.info("skipping %d unchanged records", total - len(records))
+
+    if len(records) == 0:
+        return
+
+    from influxdb_client.client.write_api import WritePrecision, Point
+
+    index_rows = None
+    if index is not None:
+        index_rows = get_write_index_rows(bucket, records)
+
+    lines = []
 
     for r in records:
         p = Point(r["measurement"])
@@ -20,17 +613,547 @@ def write_results_to_influxdb(url, token, org, bucket, records):
         for k, v in r["fields"].items():
             p = p.field(k, v)
         p = p.time(int(r["timestamp"].timestamp()), write_precision=WritePrecision.S)
-        data.append(p)
+        lines.append(p.to_line_protocol())
 
-    with influxdb_client.InfluxDBClient(
-        url=url, token=token, org=org
-    ) as client, client.write_api(
-        write_options=WriteOptions(batch_size=10000)
-    ) as write_api:
-        write_api.write(
-            bucket=bucket, org=org, record=data, write_precision=WritePrecision.S
+    if spool is None:
+        errors = write_lines_to_influxdb(url, token, org, bucket, lines, client=client)
+    else:
+        # spool records before sending, so a failed write doesn't lose them or kill the run
+        segment = spool.append(bucket, lines, index_rows=index_rows)
+        try:
+            errors = write_lines_to_influxdb(url, token, org, bucket, lines, client=client)
+        except Exception as exc:
+            errors = [exc]
+        if len(errors) == 0:
+            spool.remove(segment)
+        else:
+            spool.mark_failed(segment)
+
+    if len(errors) > 0:
+        logging.warning("failed to write %d records to %s: %s", len(records), bucket, errors[0])
+        return
+
+    if index is not None:
+        index.update_rows(index_rows)
+
+
+class ResultWriter:
+    """
+    ResultWriter writes the records of several rollups through one InfluxDB client, sharing a
+    write index and spool between them.
+    """
+
+    def __init__(self, url, token, org, index=None, spool=None):
+        import influxdb_client
+
+        self.url = url
+        self.token = token
+        self.org = org
+        self.index = index
+        self.spool = spool
+        self.client = influxdb_client.InfluxDBClient(url=url, token=token, org=org)
+
+    def write(self, bucket, records):
+        write_results_to_influxdb(
+            url=self.url,
+            token=self.token,
+            org=self.org,
+            bucket=bucket,
+            records=records,
+            index=self.index,
+            spool=self.spool,
+            client=self.client,
         )
 
+    def close(self):
+        self.client.close()
+
+
+def replay_spool(url, token, org, spool, index=None):
+    """
+    Replays spooled segments whose backoff has elapsed, oldest first. Replay stops at the first
+    failure, as later segments are likely to fail for the same reason. Replayed records are added
+    to index, so they're known to be written, for example by the daily and weekly rollups.
+    """
+    with profiler.stage("spool_replay") as stage:
+        for bucket, segment in spool.get_segments():
+            if not spool.is_due(segment):
+                continue
+            lines = spool.read(segment)
+            logging.info("replaying %d spooled records to %s", len(lines), bucket)
+            try:
+                errors = write_lines_to_influxdb(url, token, org, bucket, lines)
+            except Exception as exc:
+                errors = [exc]
+            if len(errors) > 0:
+                failed = spool.mark_failed(segment)
+                logging.warning(
+                    "failed to replay %s after %d attempts: %s",
+                    segment.name,
+                    spool.get_attempts(failed),
+                    errors[0],
+                )
+                break
+            if index is not None:
+                index.update_rows(spool.read_index_rows(segment))
+            spool.remove(segment)
+            stage["rows"] += len(lines)
+
+
+def get_query_error_action(exc):
+    """
+    Returns how query_adaptive handles a failed query. Transient errors, such as timeouts, dropped
+    connections and 429 or 5xx responses, are "retry"ed. Responses too large for the API or for
+    memory are "split" into smaller windows. Anything else, such as a 4xx response to a bad query
+    or a response which can't be parsed, would fail the same way again and returns None.
+    """
+    import http.client
+    import requests
+    import urllib.error
+
+    if isinstance(exc, MemoryError):
+        return "split"
+
+    # sage_data_client uses urllib, but other clients may raise the requests equivalents
+    status = None
+    if isinstance(exc, urllib.error.HTTPError):
+        status = exc.code
+    elif isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        status = exc.response.status_code
+
+    if status == 413:
+        return "split"
+    if status is not None:
+        return "retry" if status == 429 or status >= 500 else None
+
+    # a response cut off mid transfer shows up as an incomplete read or truncated gzip stream
+    if isinstance(exc, (OSError, EOFError, http.client.HTTPException)):
+        return "retry"
+
+    return None
+
+
+def query_adaptive(
+    start,
+    end,
+    retries=2,
+    backoff=1.0,
+    min_window=pd.Timedelta("1min"),
+    **kwargs,
+):
+    """
+    Queries [start, end) like sage_data_client.query, but retries failed queries with exponential
+    backoff. If a window still fails or is too large, it's recursively split in half and the
+    partial results are concatenated. This is only valid for queries whose results can be merged
+    by concatenation, such as raw data or per series counts which are summed afterwards. head and
+    tail are re-applied to each series of the merged results, as each half has its own. Errors
+    which would fail again, such as bad queries, are raised immediately.
+    """
+    import sage_data_client
+
+    for attempt in range(retries + 1):
+        try:
+            with profiler.stage("query") as stage:
+                df = sage_data_client.query(
+                    start=start, end=end, endpoint=SAGE_QUERY_URL, **kwargs
+                )
+                stage["rows"] = len(df)
+            return df
+        except Exception as exc:
+            action = get_query_error_action(exc)
+            if action is None:
+                raise
+            logging.warning(
+                "query failed %s %s attempt %d: %s", start, end, attempt + 1, exc
+            )
+            error = exc
+            # retrying an oversized query gets the same response, so it's split right away
+            if action == "split":
+                break
+            if attempt < retries:
+                time.sleep(backoff * 2**attempt)
+
+    if end - start <= min_window:
+        raise error
+
+    mid = start + ((end - start) / 2).floor("1s")
+    logging.info("splitting query %s %s at %s", start, end, mid)
+
+    df = pd.concat(
+        [
+            query_adaptive(start, mid, retries, backoff, min_window, **kwargs),
+            query_adaptive(mid, end, retries, backoff, min_window, **kwargs),
+        ],
+        ignore_index=True,
+    )
+
+    if kwargs.get("head") is not None or kwargs.get("tail") is not None:
+        df = get_head_and_tail_per_series(df, kwargs.get("head"), kwargs.get("tail"))
+
+    return df
+
+
+def get_head_and_tail_per_series(df, head=None, tail=None):
+    """
+    Keeps the first head and last tail rows of each series in df, which is in time order, like
+    the query API does for a single query.
+    """
+    if len(df) == 0:
+        return df
+    cols = [c for c in df.columns if c == "name" or c.startswith("meta.")]
+    if head is not None:
+        df = df.groupby(cols, dropna=False, sort=False).head(head)
+    if tail is not None:
+        df = df.groupby(cols, dropna=False, sort=False).tail(tail)
+    return df.reset_index(drop=True)
+
+
+class DataSource(ABC):
+    """
+    DataSource is the interface the rollups and check_nodes.py query data through. query takes the
+    same arguments as sage_data_client.query, with start and end as timestamps, and returns a frame
+    in the same format. get_name identifies the data a source answers from, such as the API url or
+    replay file, so cached results of different sources are kept apart.
+    """
+
+    @abstractmethod
+    def query(self, start, end, **kwargs):
+        pass
+
+    def get_name(self):
+        return type(self).__name__
+
+
+class SageDataSource(DataSource):
+    """
+    SageDataSource queries the data API. This is the default data source.
+    """
+
+    def query(self, start, end, **kwargs):
+        return query_adaptive(start=start, end=end, **kwargs)
+
+    def get_name(self):
+        return SAGE_QUERY_URL
+
+
+class ReplayDataSource(DataSource):
+    """
+    ReplayDataSource answers queries from a newline delimited JSON file of records, such as one
+    saved from a query or recorded by local_services.py. The file is loaded on the first query.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.df = None
+
+    def get_name(self):
+        return str(Path(self.path).resolve())
+
+    def query(self, start, end, **kwargs):
+        import sage_data_client
+
+        if self.df is None:
+            with profiler.stage("load_replay") as stage:
+                self.df = sage_data_client.load(Path(self.path))
+                stage["rows"] = len(self.df)
+
+        with profiler.stage("query") as stage:
+            df = select_records(self.df, start, end, **kwargs)
+            stage["rows"] = len(df)
+        return df
+
+
+def select_records(
+    df, start, end, filter=None, head=None, tail=None, experimental_func=None, bucket=None
+):
+    """
+    Selects the records of df which match a query in the same way as the data API. Filters are
+    regular expressions matched against the name or meta fields. head, tail and experimental_func
+    apply to each series, which is identified by its name and meta fields.
+    """
+    mask = (df["timestamp"] >= start) & (df["timestamp"] < end)
+
+    for key, pattern in (filter or {}).items():
+        col = "name" if key == "name" else f"meta.{key}"
+        if col not in df.columns:
+            mask &= False
+            continue
+        # match each unique value once instead of every row
+        codes, uniques = pd.factorize(df[col])
+        matches = np.array([re.fullmatch(pattern, str(v)) is not None for v in uniques] + [False])
+        mask &= matches[codes]
+
+    df = df[mask]
+
+    # meta fields only present in records which were filtered out are not part of the result
+    df = df.drop(columns=[c for c in df.columns if c.startswith("meta.") and df[c].isna().all()])
+    series = ["name"] + [c for c in df.columns if c.startswith("meta.")]
+
+    if experimental_func == "count":
+        df = df.groupby(series, dropna=False).size().reset_index(name="value")
+        df.insert(0, "timestamp", start)
+        return df[["timestamp", "name", "value"] + series[1:]]
+    if experimental_func is not None:
+        raise ValueError(f"unsupported experimental_func {experimental_func!r}")
+
+    if head is not None or tail is not None:
+        groups = df.sort_values("timestamp", kind="stable").groupby(series, dropna=False)
+        df = groups.head(head) if head is not None else groups.tail(tail)
+        df = df.sort_index()
+
+    return df.reset_index(drop=True)
+
+
+class ArrowCacheDataSource(DataSource):
+    """
+    ArrowCacheDataSource keeps the results of queries to source as Arrow IPC files under path, so
+    repeated runs over the same windows, such as backfills and benchmarks, are read back from local
+    disk. Only windows which ended at least lag ago are cached, since later data may still arrive.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path, source, lag=pd.Timedelta("1h")):
+        self.path = Path(path)
+        self.source = source
+        self.lag = lag
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get_name(self):
+        return self.source.get_name()
+
+    def get_path(self, start, end, kwargs):
+        key = json.dumps(
+            {
+                "source": self.source.get_name(),
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                **kwargs,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return self.path / f"{hashlib.sha1(key.encode()).hexdigest()}.arrow"
+
+    def read_table(self, start, end, kwargs):
+        import pyarrow as pa
+
+        path = self.get_path(start, end, kwargs)
+
+        if path.exists():
+            with profiler.stage("cache_read") as stage, pa.memory_map(str(path)) as f:
+                table = pa.ipc.open_file(f).read_all()
+                stage["rows"] = table.num_rows
+            return table
+
+        table = get_arrow_table(self.source.query(start, end, **kwargs))
+
+        if end <= pd.Timestamp.now(tz="UTC") - self.lag:
+            with profiler.stage("cache_write") as stage:
+                # write to a temporary file first so readers never see a partial file
+                tmp = path.with_suffix(".tmp")
+                with pa.OSFile(str(tmp), "wb") as f, pa.ipc.new_file(f, table.schema) as writer:
+                    writer.write_table(table)
+                tmp.rename(path)
+                stage["rows"] = table.num_rows
+
+        return table
+
+    def query(self, start, end, **kwargs):
+        return get_frame_from_arrow(self.read_table(start, end, kwargs))
+
+
+# value_columns maps each typed column an object value column is split into, since Arrow columns
+# have a single type, to its Arrow type and the values it holds. they're checked in order, so bools
+# aren't stored as ints.
+value_columns = {
+    "value_bool": ("bool", lambda v: isinstance(v, (bool, np.bool_))),
+    "value_int": ("int64", lambda v: isinstance(v, numbers.Integral)),
+    "value_float": ("double", lambda v: isinstance(v, numbers.Real)),
+    "value_string": ("string", lambda v: isinstance(v, str)),
+}
+
+
+def get_arrow_table(df):
+    """
+    Converts a query result frame to a pyarrow.Table. Value columns of a single type are kept as
+    is. Values of mixed types, such as numbers and upload urls, are split into the typed columns of
+    value_columns so each keeps its type.
+    """
+    import pyarrow as pa
+
+    if df["value"].dtype != object:
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+    loc = df.columns.get_loc("value")
+    value = df["value"]
+    table = pa.Table.from_pandas(df.drop(columns="value"), preserve_index=False)
+    unmatched = value.notna()
+
+    for i, (col, (alias, is_type)) in enumerate(value_columns.items()):
+        mask = unmatched & value.map(is_type)
+        unmatched &= ~mask
+        values = pa.array(value.where(mask, None).tolist(), type=pa.type_for_alias(alias))
+        table = table.add_column(loc + i, col, values)
+
+    if unmatched.any():
+        raise TypeError(f"unsupported value type {type(value[unmatched].iloc[0]).__name__}")
+
+    return table
+
+
+def get_frame_from_arrow(table):
+    """
+    Converts a pyarrow.Table from get_arrow_table back into a frame in the query result format.
+    """
+    if "value" in table.column_names:
+        return table.to_pandas()
+
+    loc = table.column_names.index("value_bool")
+    df = table.drop_columns(list(value_columns)).to_pandas()
+    # typed columns are combined through python objects, as pandas would turn ints with nulls
+    # into floats and bools into objects
+    value = [None] * table.num_rows
+    for col in value_columns:
+        for i, v in enumerate(table.column(col).to_pylist()):
+            if v is not None:
+                value[i] = v
+    df.insert(loc, "value", pd.Series(value, dtype=object))
+    return df
+
+
+class WindowDataSource(DataSource):
+    """
+    WindowDataSource fetches every record in [start, end) matching filter from source on its first
+    query and answers later queries within the window from them, so several rollups of the same
+    window share a single fetch. Queries it can't answer, such as those outside the window or
+    without filter, are passed through to source.
+    """
+
+    def __init__(self, source, start, end, filter=None):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.filter = filter or {}
+        self.df = None
+
+    def get_name(self):
+        return self.source.get_name()
+
+    def covers(self, start, end, filter, kwargs):
+        if start < self.start or end > self.end or kwargs.get("bucket") is not None:
+            return False
+        # the window's records only include the query's if the query is at least as selective
+        filter = filter or {}
+        return all(filter.get(k) == v for k, v in self.filter.items())
+
+    def query(self, start, end, filter=None, **kwargs):
+        if not self.covers(start, end, filter, kwargs):
+            return self.source.query(start, end, filter=filter, **kwargs)
+
+        if self.df is None:
+            self.df = self.source.query(self.start, self.end, filter=self.filter or None)
+
+        with profiler.stage("window_select") as stage:
+            df = select_records(self.df, start, end, filter=filter, **kwargs)
+            stage["rows"] = len(df)
+        return df
+
+
+_data_source = SageDataSource()
+
+
+def get_data_source():
+    """
+    Returns the data source queries should be made through.
+    """
+    return _data_source
+
+
+def set_data_source(source):
+    global _data_source
+    _data_source = source
+
+
+def add_data_source_arguments(parser):
+    parser.add_argument(
+        "--data-source",
+        default=None,
+        type=Path,
+        help="answer queries from a newline delimited json file of records instead of the data api",
+    )
+    parser.add_argument(
+        "--data-cache",
+        default=None,
+        type=Path,
+        help="path to local arrow cache of query results for completed windows. requires pyarrow.",
+    )
+
+
+def set_data_source_from_args(args):
+    source = SageDataSource()
+    if args.data_source is not None:
+        source = ReplayDataSource(args.data_source)
+    if args.data_cache is not None:
+        source = ArrowCacheDataSource(args.data_cache, source)
+    set_data_source(source)
+
+
+def stream_records(filter=None, endpoint=None, backoff=1.0, max_backoff=60.0):
+    """
+    Yields records from the live data stream as they arrive. If the stream fails, ends or is idle
+    past the read timeout, it's reconnected with exponential backoff from the latest timestamp seen
+    so a dropped connection doesn't lose the records sent while it was down.
+    """
+    import requests
+
+    if endpoint is None:
+        endpoint = f"{SAGE_DATA_URL}/api/v0/stream"
+
+    latest = None
+    delay = backoff
+
+    while True:
+        params = dict(filter or {})
+        if latest is not None:
+            params["start"] = latest.isoformat()
+
+        try:
+            with get_session().get(
+                endpoint,
+                params=params,
+                headers={"Accept": "text/event-stream"},
+                stream=True,
+                timeout=60,
+            ) as r:
+                r.raise_for_status()
+                for line in r.iter_lines(decode_unicode=True):
+                    if not line.startswith("data:"):
+                        continue
+                    item = json.loads(line[len("data:") :])
+                    timestamp = pd.Timestamp(item["timestamp"])
+                    if latest is None or timestamp > latest:
+                        latest = timestamp
+                    delay = backoff
+                    yield item
+            logging.warning("stream ended")
+        except requests.exceptions.RequestException as exc:
+            logging.warning("stream failed: %s", exc)
+
+        logging.info("reconnecting to stream from %s in %0.1fs", latest, delay)
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+
+def replay_records(path):
+    """
+    Yields records from a newline delimited JSON file in the same format as stream_records. This
+    can be used as a local stand-in for the live data stream.
+    """
+    with open(path) as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
 
 def check_publishing_frequency(df, freq, window):
     total_samples = (df.resample(freq, on="timestamp").value.count() > 0).sum()
@@ -38,7 +1161,7 @@ def check_publishing_frequency(df, freq, window):
     return total_samples / expected_samples
 
 
-@dataclass
+@dataclass(slots=True)
 class Node:
     id: str
     vsn: str
@@ -46,10 +1169,86 @@ class Node:
     devices: set
 
 
+# device_names are the devices load_node_table_item can assign to a node. they also order the
+# columns of Fleet.matrix.
+device_names = [
+    "nxcore",
+    "nxagent",
+    "rpi",
+    "dell",
+    "bme280",
+    "bme680",
+    "raingauge",
+    "microphone",
+    "top_camera",
+    "bottom_camera",
+    "left_camera",
+    "right_camera",
+]
+
+
+class Fleet:
+    """
+    Fleet is a compact, array backed view of a list of nodes. ids, vsns and types are arrays of
+    interned strings in the same order as the nodes and matrix is a node x device boolean matrix
+    with a column for each of devices. This lets fleet wide selection and expectations be done as
+    array operations instead of walking each node's device set.
+    """
+
+    __slots__ = ("ids", "vsns", "types", "devices", "matrix")
+
+    def __init__(self, nodes):
+        self.ids = np.array([sys.intern(node.id) for node in nodes], dtype=object)
+        self.vsns = np.array([sys.intern(node.vsn) for node in nodes], dtype=object)
+        self.types = np.array([sys.intern(node.type) for node in nodes], dtype=object)
+
+        extra = sorted({device for node in nodes for device in node.devices} - set(device_names))
+        self.devices = device_names + extra
+
+        column = {device: j for j, device in enumerate(self.devices)}
+        self.matrix = np.zeros((len(nodes), len(self.devices)), dtype=bool)
+        for i, node in enumerate(nodes):
+            self.matrix[i, [column[device] for device in node.devices]] = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_device_mask(self, devices):
+        """
+        Returns a boolean array of which nodes have any of devices.
+        """
+        columns = [j for j, device in enumerate(self.devices) if device in devices]
+        return self.matrix[:, columns].any(axis=1)
+
+    def get_node_devices(self, i):
+        """
+        Returns the devices of the i-th node in column order.
+        """
+        return [self.devices[j] for j in np.flatnonzero(self.matrix[i])]
+
+    def get_device_frame(self, mask=None):
+        """
+        Returns a DataFrame with the meta.node, meta.vsn and device of each device of the nodes
+        in mask, or all nodes if mask is None.
+        """
+        matrix = self.matrix if mask is None else self.matrix & mask[:, None]
+        rows, columns = np.nonzero(matrix)
+        return pd.DataFrame(
+            {
+                "meta.node": self.ids[rows],
+                "meta.vsn": self.vsns[rows],
+                "device": np.array(self.devices, dtype=object)[columns],
+            },
+            columns=["meta.node", "meta.vsn", "device"],
+        )
+
+
 def load_node_table():
-    r = requests.get("https://api.sagecontinuum.org/production")
-    r.raise_for_status()
-    return [load_node_table_item(item) for item in r.json() if item["vsn"] != ""]
+    with profiler.stage("load_node_table") as stage:
+        r = http_get(f"{SAGE_API_URL}/production")
+        nodes = [load_node_table_item(item) for item in r.json() if item["vsn"] != ""]
+        stage["rows"] = len(nodes)
+    return nodes
 
 
 def load_node_table_item(item):
@@ -70,7 +1269,7 @@ def load_node_table_item(item):
 
     # add cameras
     for dir in ["top", "bottom", "left", "right"]:
-        if item[f"{dir}_camera"] not in [None, "", "none"]:
+        if item.get(f"{dir}_camera") not in [None, "", "none"]:
             devices.add(f"{dir}_camera")
 
     # TODO add camera stuff for upload checks
@@ -82,6 +1281,180 @@ def load_node_table_item(item):
     )
 
 
+def get_node_frame(nodes):
+    """
+    Returns a DataFrame with the meta.node and meta.vsn columns for each node so it can be
+    joined against query results.
+    """
+    return pd.DataFrame(
+        {
+            "meta.node": [node.id for node in nodes],
+            "meta.vsn": [node.vsn for node in nodes],
+        },
+        columns=["meta.node", "meta.vsn"],
+    )
+
+
+def get_records_from_frame(df, measurement, tags, field, timestamp):
+    """
+    Builds records from the rows of df. tags maps each tag key to its column. Null tag values
+    are left out of a record's tags so optional columns can be nullable.
+    """
+    tag_keys = list(tags.keys())
+    tag_values = df[list(tags.values())].astype(object)
+    tag_values = tag_values.where(tag_values.notna(), None)
+
+    records = []
+
+    for row, value in zip(tag_values.itertuples(index=False, name=None), df[field]):
+        records.append(
+            {
+                "measurement": measurement,
+                "tags": {k: v for k, v in zip(tag_keys, row) if v is not None},
+                "fields": {
+                    "value": int(value),
+                },
+                "timestamp": timestamp,
+            }
+        )
+
+    return records
+
+
+def add_node_selection_arguments(parser):
+    parser.add_argument(
+        "--vsn",
+        action="append",
+        type=str.upper,
+        help="only include node with vsn. may be repeated.",
+    )
+    parser.add_argument(
+        "--node-type",
+        action="append",
+        type=str.lower,
+        help="only include nodes of type. may be repeated.",
+    )
+    parser.add_argument(
+        "--device",
+        action="append",
+        help="only include nodes with device. may be repeated.",
+    )
+
+
+def has_node_selection(args):
+    return any(x is not None for x in [args.vsn, args.node_type, args.device])
+
+
+def select_nodes(nodes, vsns=None, node_types=None, devices=None):
+    """
+    Returns the nodes matching all of the given selectors. A selector of None matches all nodes.
+    """
+    fleet = Fleet(nodes)
+    mask = np.ones(len(fleet), dtype=bool)
+    if vsns is not None:
+        mask &= np.isin(fleet.vsns, list(vsns))
+    if node_types is not None:
+        mask &= np.isin(fleet.types, list(node_types))
+    if devices is not None:
+        mask &= fleet.get_device_mask(devices)
+    return [nodes[i] for i in np.flatnonzero(mask)]
+
+
+def parse_shard(s):
+    """
+    Parses a shard in i/N format where 0 <= i < N.
+    """
+    try:
+        i, n = map(int, s.split("/"))
+    except ValueError:
+        raise ValueError("invalid shard format")
+    if not (0 <= i < n):
+        raise ValueError("invalid shard index")
+    return i, n
+
+
+def get_shard(vsn, n):
+    # NOTE we use crc32 instead of hash since hash is randomized per python process
+    return zlib.crc32(vsn.encode()) % n
+
+
+def get_nodes_in_shard(nodes, shard):
+    """
+    Returns the nodes which belong to shard. Nodes are deterministically partitioned by VSN,
+    so the set of shards 0/N ... N-1/N covers every node exactly once.
+    """
+    i, n = shard
+    return [node for node in nodes if get_shard(node.vsn, n) == i]
+
+
+def get_vsn_filter(nodes):
+    """
+    Returns a query filter value matching only the given nodes' VSNs.
+    """
+    return "|".join(sorted(node.vsn for node in nodes))
+
+
+def get_nodes_with_changed_totals(index, bucket, nodes, records, start, end):
+    """
+    Compares the totals of each tag set in records, which cover [start, end), against the totals
+    last written to bucket for that range and returns the nodes with any differing total. Totals
+    are compared per tag set, so a changed breakdown is found even when a node's total isn't.
+    Without an index, every node with records has changed.
+    """
+    probed = {}
+    for r in records:
+        key = json.dumps(r["tags"], sort_keys=True)
+        probed[key] = probed.get(key, 0) + r["fields"]["value"]
+
+    written = {}
+    if index is not None:
+        written = index.get_totals_by_tags(bucket, "total", start, end)
+
+    vsns = {
+        parse_write_index_tags(key)["vsn"]
+        for key in probed.keys() | written.keys()
+        if probed.get(key, 0) != written.get(key, 0)
+    }
+    return [node for node in nodes if node.vsn in vsns]
+
+
+def reconcile_windows(index, bucket, nodes, windows, get_counts, pushdown=False):
+    """
+    Finds the windows and nodes whose totals changed since they were last written to bucket and
+    returns a map of (start, end) -> the changed nodes' records for each changed window.
+    get_counts(nodes, start, end, pushdown=...) returns the count records of nodes over [start,
+    end).
+
+    Counts are additive, so the whole range is probed with a single count query. Ranges with
+    changed nodes are split in half and probed again, filtered to only those nodes, until single
+    windows are reached, whose probes are the records to re-roll. Unchanged ranges aren't queried
+    again.
+    """
+    changed = {}
+    pending = [(list(windows), nodes, pushdown)] if len(windows) > 0 else []
+
+    while len(pending) > 0:
+        windows, nodes, pushdown = pending.pop()
+        start, end = windows[0][0], windows[-1][1]
+        records = get_counts(nodes, start, end, pushdown=pushdown)
+        nodes = get_nodes_with_changed_totals(index, bucket, nodes, records, start, end)
+        logging.info("found %d nodes with changed totals for %s %s", len(nodes), start, end)
+
+        if len(nodes) == 0:
+            continue
+
+        if len(windows) == 1:
+            vsns = {node.vsn for node in nodes}
+            changed[windows[0]] = [r for r in records if r["tags"]["vsn"] in vsns]
+            continue
+
+        mid = len(windows) // 2
+        pending.append((windows[mid:], nodes, True))
+        pending.append((windows[:mid], nodes, True))
+
+    return changed
+
+
 def get_time_windows(start, end, freq):
     windows = pd.date_range(start, end, freq=freq)
     return list(zip(windows[:-1], windows[1:]))